@@ -0,0 +1,50 @@
+"""Time rename.do_rename in one directory on a simulated high-latency filesystem.
+
+Usage (from the repo root):
+    python benchmarks/bench_do_rename.py [num_files] [latency_ms]
+
+A temp dir on the local disk stands in for the network mount: the rename call
+is wrapped to sleep latency_ms first (like an SMB/NFS round trip), then the same
+plan is run with different numbers of renames in flight.
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append("grouping_renamer")
+import rename
+import support
+from history import RenameJournal
+
+def run(num_files: int, latency: float, inflight: int) -> float:
+    with tempfile.TemporaryDirectory() as td:
+        names = ['FOO_' + str(n).rjust(5, '0') + '.jpg' for n in range(num_files)]
+        for name in names:
+            open(os.path.join(td, name), 'w').close()
+        plan = rename.make_rename_list(list(reversed(names)), r'\d{2,5}', 'BAR_', 'i', 10, 10, 6)
+        snapshot = support.DirSnapshot(td)
+        journal = RenameJournal('rename_history__bench.csv', 'bench', snapshot.handle)
+        start = time.perf_counter()
+        rename.do_rename(plan, journal, snapshot, inflight)
+        secs = time.perf_counter() - start
+        journal.close()
+        snapshot.close()
+        return secs
+
+if __name__ == '__main__':
+    num_files = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    latency = (float(sys.argv[2]) if len(sys.argv) > 2 else 5.0) / 1000
+
+    real_rename = support.DirHandle.rename
+    def slow_rename(self, src, dst):
+        time.sleep(latency)
+        real_rename(self, src, dst)
+    support.DirHandle.rename = slow_rename
+    support.set_is_dry_run(False)
+
+    print('%d files, %.1f ms per rename' % (num_files, latency * 1000))
+    print('%9s %9s %12s' % ('inflight', 'secs', 'renames/sec'))
+    for inflight in (1, 4, 16, 64):
+        secs = run(num_files, latency, inflight)
+        print('%9d %9.2f %12.0f' % (inflight, secs, num_files / secs))
@@ -0,0 +1,43 @@
+"""Time rename.make_rename_list over growing directory sizes.
+
+Usage (from the repo root): python benchmarks/bench_make_rename_list.py [max_names]
+
+Names look like Epson scans (FOO_0001.jpg, FOO_0001_a.jpg, FOO_0001_b.jpg)
+in shuffled group order; if planning is linear then the per-name time
+stays flat as the name count grows.
+"""
+import random
+import sys
+import time
+
+sys.path.append("grouping_renamer")
+import rename
+
+def make_names(num_names: int, seed: int = 1) -> list[str]:
+    """about num_names scan-style names, groups of 1-3, shuffled by group"""
+    rnd = random.Random(seed)
+    names = []
+    gid = 0
+    while len(names) < num_names:
+        gid += 1
+        base = 'FOO_' + str(gid).rjust(7, '0')
+        names.append(base + '.jpg')
+        if rnd.random() < 0.5: names.append(base + '_a.jpg')
+        if rnd.random() < 0.3: names.append(base + '_b.jpg')
+    names = names[:num_names]
+    rnd.shuffle(names)
+    return names
+
+def time_plan(names: list[str]) -> float:
+    start = time.perf_counter()
+    rename.make_rename_list(names, r'\d{2,7}', 'BAR_', 'i', 10, 10, 7)
+    return time.perf_counter() - start
+
+if __name__ == '__main__':
+    max_names = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    size = 1000
+    print('%10s %10s %12s' % ('names', 'secs', 'usec/name'))
+    while size <= max_names:
+        secs = time_plan(make_names(size))
+        print('%10d %10.3f %12.3f' % (size, secs, secs / size * 1e6))
+        size *= 10
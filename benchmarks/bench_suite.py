@@ -0,0 +1,161 @@
+"""Time each phase of a rename, and its undo, over synthetic trees of growing size.
+
+Usage (from the repo root):
+    python benchmarks/bench_suite.py [--sizes 1000,100000,1000000] [--out results.json]
+                                     [--compare baseline.json] [--memory] [tree options, see --help]
+
+For each size a tree of Epson-style scans is made (see gen_tree.py; that isn't
+timed) and these phases are timed separately, over every dir:
+    list      scan each dir (DirSnapshot)
+    orderfix  read the orderfile and match its names to the dir (fetch_lists, fix_orderlines)
+    plan      group and number the names (make_rename_list; the plans are kept for the next phases)
+    history   write the renames to a history file, batch by batch, with its fsyncs
+    rename    schedule and do the renames (do_rename, with nothing journalled)
+    undo      list each dir again, read its history and put the names back (undo_in_dir)
+Results are written as JSON; with --compare, each phase is checked against an
+earlier run's results, and the exit status is 1 if any got slower than --threshold
+times (ignoring phases under --min-secs, which are mostly noise).
+With --memory, each phase's peak memory use (over what was in use before it;
+what it returns counts) is traced too, and compared the same way; tracing
+slows everything down, so don't compare those times with untraced ones.
+"""
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.append("grouping_renamer")
+import rename
+import support
+import undo
+from history import Journal, RenameJournal
+
+from gen_tree import make_tree, add_tree_args, tree_params
+
+PHASES = ['list', 'orderfix', 'plan', 'history', 'rename', 'undo']
+ID_REGEX = r'\d{2,5}'
+EXCLUDE = ['fssort.ini', r'rename_history.*']
+
+class _NoJournal(Journal):
+    """lets do_rename run without recording anything (history is timed on its own)"""
+    def intend(self, renames): pass
+    def failed(self, fname, tname): pass
+    def done(self, renamed): pass
+    def discard(self): pass
+
+def run_size(root: str, num_files: int, params: dict, memory:bool=False) -> dict:
+    """make a tree of num_files scans under root and time each phase over it
+    (and trace its peak memory use, if memory)"""
+    dirs = max(1, num_files // params['files_per_dir'])
+    folders = make_tree(root, dirs, **params)
+    phases = {}
+    peaks = {}
+    def timed(phase, func, items):
+        if memory:
+            tracemalloc.reset_peak()
+            in_use = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        results = [func(item) for item in items]
+        phases[phase] = time.perf_counter() - start
+        if memory:
+            peaks[phase] = (tracemalloc.get_traced_memory()[1] - in_use) / (1 << 20)
+        return results
+
+    snapshots = timed('list', support.DirSnapshot, folders)
+    def orderfix(snapshot):
+        (dirlist, lines) = support.fetch_lists(snapshot.folder, 'fssort.ini', True, snapshot)
+        return rename.fix_orderlines(lines, dirlist, EXCLUDE, True, ID_REGEX)
+    orderedlines = timed('orderfix', orderfix, snapshots)
+    rename_lists = timed('plan', lambda ol: rename.make_rename_list(ol, ID_REGEX, 'BAR_', 'i', 10, 10, 5),
+                         orderedlines)
+    now_str = datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
+    def write_history(snapshot_and_list):
+        (snapshot, rename_list) = snapshot_and_list
+        journal = RenameJournal(rename.make_bu_name('rename_history.csv', now_str), now_str, snapshot.handle)
+        for batch in journal.batches(list(rename_list)):
+            journal.done(len(batch))
+        journal.close()
+    timed('history', write_history, zip(snapshots, rename_lists))
+    renamed = timed('rename', lambda s_l: rename.do_rename(s_l[1], _NoJournal(), s_l[0]),
+                    zip(snapshots, rename_lists))
+    for snapshot in snapshots:
+        snapshot.close()
+    reverted = timed('undo', lambda folder: undo.undo_in_dir('rename_history.csv', folder)['renamed'],
+                     folders)
+    if sum(reverted) != sum(renamed):
+        print('  (undo reverted %d of %d renames)' % (sum(reverted), sum(renamed)))
+    result = {'dirs': dirs, 'files': num_files, 'renamed': sum(renamed),
+              'phases': {p: round(phases[p], 4) for p in PHASES}}
+    if memory:
+        result['peak_mb'] = {p: round(peaks[p], 2) for p in PHASES}
+    return result
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+def compare(results: dict, baseline: dict, threshold: float, min_secs: float) -> bool:
+    """print each phase's time (and peak memory, if both runs traced it)
+    against the baseline's; True if none regressed"""
+    ok = True
+    print('\n%9s %-9s %-7s %9s %9s %7s' % ('files', 'phase', '', 'before', 'now', 'ratio'))
+    for (size, result) in results['results'].items():
+        before = baseline['results'].get(size)
+        if before is None:
+            continue
+        for (measure, unit, least) in [('phases', 'secs', min_secs), ('peak_mb', 'MB', 1.0)]:
+            for phase in PHASES:
+                (old, new) = (before.get(measure, {}).get(phase), result.get(measure, {}).get(phase))
+                if old is None or new is None:
+                    continue
+                ratio = new / old if old else float('inf')
+                regressed = ratio > threshold and max(old, new) >= least
+                ok = ok and not regressed
+                print('%9s %-9s %-7s %9.3f %9.3f %7.2f%s' % (size, phase, unit, old, new, ratio,
+                                                             '  REGRESSED' if regressed else ''))
+    return ok
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='time rename and undo phases over synthetic trees')
+    parser.add_argument('--sizes', default='1000,100000,1000000', help='files per tree, comma-separated')
+    parser.add_argument('--out', help='write the results (JSON) here')
+    parser.add_argument('--compare', help='results (JSON) of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=1.25, help='slowdown ratio that counts as a regression')
+    parser.add_argument('--min-secs', type=float, default=0.05, help='phases quicker than this are not compared')
+    parser.add_argument('--memory', action='store_true', help="trace each phase's peak memory use too")
+    parser.add_argument('--workdir', help='make the trees under here (default: a temp dir)')
+    add_tree_args(parser)
+    args = parser.parse_args()
+    params = tree_params(args)
+    support.set_is_dry_run(False)
+
+    results = {'meta': {'commit': git_commit(), 'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                        'python': platform.python_version(), 'platform': platform.platform(),
+                        'memory_traced': args.memory},
+               'params': params, 'results': {}}
+    if args.memory:
+        tracemalloc.start()
+    print('%9s %6s %s' % ('files', 'dirs', ' '.join('%9s' % p for p in PHASES)))
+    for size in [int(s) for s in args.sizes.split(',')]:
+        with tempfile.TemporaryDirectory(dir=args.workdir) as td:
+            result = run_size(td, size, params, args.memory)
+        results['results'][str(size)] = result
+        print('%9d %6d %s' % (size, result['dirs'], ' '.join('%9.3f' % result['phases'][p] for p in PHASES)))
+        if args.memory:
+            print('%9s %6s %s' % ('peak MB', '', ' '.join('%9.1f' % result['peak_mb'][p] for p in PHASES)))
+    if args.out:
+        with open(args.out, 'w') as rf:
+            json.dump(results, rf, indent=1)
+    if args.compare:
+        with open(args.compare) as bf:
+            baseline = json.load(bf)
+        if not compare(results, baseline, args.threshold, args.min_secs):
+            sys.exit(1)
@@ -0,0 +1,80 @@
+"""Make a synthetic tree of Epson-style scans to benchmark against.
+
+Usage (from the repo root):
+    python benchmarks/gen_tree.py DEST [--dirs N] [--files-per-dir N] [...]
+
+Each dir holds groups of scans like FastFoto_00012.jpg, FastFoto_00012_a.jpg
+(enhanced) and FastFoto_00012_b.jpg (the back), and an orderfile listing them
+group by group, as after sorting in a viewer: some of the groups moved out of
+scan order (--shuffle-rate) and some names in the wrong case (--case-noise).
+"""
+import argparse
+import os
+import random
+
+def group_names(gid: int, size: int) -> list[str]:
+    """the names in one scan's group: the scan, then _a, _b, ..."""
+    base = 'FastFoto_' + str(gid).rjust(5, '0')
+    return [base + '.jpg'] + [base + '_' + chr(ord('a') + n) + '.jpg' for n in range(size - 1)]
+
+def make_dir(folder: str, num_files: int, group_sizes: list[float], shuffle_rate: float,
+             case_noise: float, orderfile: str, rnd: random.Random) -> int:
+    """fill folder with about num_files scans (group sizes drawn with the
+    weights in group_sizes: 1 file, 2 files, ...) and their orderfile; the
+    number of files made"""
+    groups = []
+    made = 0
+    gid = 0
+    while made < num_files:
+        gid += 1
+        size = min(rnd.choices(range(1, len(group_sizes) + 1), group_sizes)[0], num_files - made)
+        groups.append(group_names(gid, size))
+        made += size
+    for group in groups:
+        for name in group:
+            open(os.path.join(folder, name), 'w').close()
+    # move some groups out of scan order
+    for n in range(int(len(groups) * shuffle_rate)):
+        groups.insert(rnd.randrange(len(groups)), groups.pop(rnd.randrange(len(groups))))
+    with open(os.path.join(folder, orderfile), 'w') as of:
+        for group in groups:
+            for name in group:
+                of.write((name.upper() if rnd.random() < case_noise else name) + '\n')
+    return made
+
+def make_tree(root: str, dirs: int, files_per_dir: int, group_sizes=(0.5, 0.3, 0.2),
+              shuffle_rate:float=0.2, case_noise:float=0.05, orderfile:str='fssort.ini',
+              seed:int=1) -> list[str]:
+    """make dirs dirs (root/d0000, ...) of files_per_dir scans each; the dirs"""
+    rnd = random.Random(seed)
+    folders = []
+    for n in range(dirs):
+        folder = os.path.join(root, 'd' + str(n).rjust(4, '0'))
+        os.makedirs(folder)
+        make_dir(folder, files_per_dir, list(group_sizes), shuffle_rate, case_noise, orderfile, rnd)
+        folders.append(folder)
+    return folders
+
+def add_tree_args(parser: argparse.ArgumentParser):
+    parser.add_argument('--files-per-dir', type=int, default=1000)
+    parser.add_argument('--group-sizes', default='0.5,0.3,0.2',
+                        help='weights of groups of 1, 2, 3, ... files (the scan, _a, _b, ...)')
+    parser.add_argument('--shuffle-rate', type=float, default=0.2,
+                        help='fraction of groups the orderfile moves out of scan order')
+    parser.add_argument('--case-noise', type=float, default=0.05,
+                        help='fraction of orderfile names in the wrong case')
+    parser.add_argument('--seed', type=int, default=1)
+
+def tree_params(args) -> dict:
+    return {'files_per_dir': args.files_per_dir,
+            'group_sizes': [float(w) for w in args.group_sizes.split(',')],
+            'shuffle_rate': args.shuffle_rate, 'case_noise': args.case_noise, 'seed': args.seed}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='make a synthetic tree of Epson-style scans')
+    parser.add_argument('dest')
+    parser.add_argument('--dirs', type=int, default=10)
+    add_tree_args(parser)
+    args = parser.parse_args()
+    folders = make_tree(args.dest, args.dirs, **tree_params(args))
+    print('made %d dirs under %s' % (len(folders), args.dest))
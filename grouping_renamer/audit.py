@@ -0,0 +1,88 @@
+import json
+import time
+import logging
+import itertools
+import threading
+from collections import deque
+from json.encoder import encode_basestring_ascii as _quote # C-coded, so cheap
+from typing import Optional
+
+log = logging.getLogger('audit')
+
+class AuditLog:
+    """a record of every rename, one JSON line per file (ts, action, dir,
+    from, to, result, secs), written by a background thread so the rename
+    loop never waits on it: events go on a bounded queue (a deque, so adding
+    one takes no lock and wakes no thread; the writer empties it every
+    flush_secs) and if the writer falls behind and that fills up, they're
+    dropped (and counted) rather than held. With sample < 1 only that
+    fraction of the successful renames is kept, evenly spread; failures
+    always are. The last line written, on close(), gives the counts."""
+    def __init__(self, path: str, sample:float=1.0, queue_size:int=1 << 16, flush_secs:float=0.2):
+        if not 0 < sample <= 1:
+            raise ValueError('audit sample must be more than 0 and at most 1')
+        self.path = path
+        self.sample = sample
+        self.queue_size = queue_size
+        self.flush_secs = flush_secs
+        self.queue: deque = deque()
+        self.closing = threading.Event()
+        self.file = open(path, 'a', encoding='utf-8')
+        self.offered = itertools.count(1) # successes so far, for sampling (next() is atomic)
+        self.lock = threading.Lock() # for the counters
+        self.sampled_out = 0
+        self.dropped = 0
+        self.written = 0
+        self.writer = threading.Thread(target=self._write, name='audit-writer', daemon=True)
+        self.writer.start()
+
+    def event(self, action: str, folder: str, fname: str, tname: str, result: str, secs: float):
+        if result == 'ok' and self.sample < 1:
+            n = next(self.offered)
+            if int(n * self.sample) == int((n - 1) * self.sample):
+                with self.lock:
+                    self.sampled_out += 1
+                return
+        if len(self.queue) >= self.queue_size: # (racy, so the bound is approximate)
+            with self.lock:
+                self.dropped += 1
+            return
+        self.queue.append((time.time(), action, folder, fname, tname, result, secs))
+
+    def _write(self):
+        while True:
+            closing = self.closing.wait(self.flush_secs)
+            events = [self.queue.popleft() for _ in range(len(self.queue))]
+            # the strings are quoted with json's own (C) quoting, and the
+            # names escaped to ASCII so ones that aren't valid UTF-8 survive
+            self.file.writelines('{"ts": %.6f, "action": %s, "dir": %s, "from": %s, "to": %s, '
+                                 '"result": %s, "secs": %.6f}\n'
+                                 % (ts, _quote(action), _quote(folder), _quote(fname), _quote(tname),
+                                    _quote(result), secs)
+                                 for (ts, action, folder, fname, tname, result, secs) in events)
+            self.file.flush()
+            self.written += len(events)
+            if closing and not self.queue:
+                return
+
+    def close(self):
+        """write out what's queued, and the counts"""
+        self.closing.set()
+        self.writer.join()
+        self.file.write(json.dumps({'ts': round(time.time(), 6), 'action': 'audit_end',
+                                    'written': self.written, 'dropped': self.dropped,
+                                    'sampled_out': self.sampled_out}) + '\n')
+        self.file.close()
+        if self.dropped:
+            log.warning(str(self.dropped) + ' audit events were dropped (the writer fell behind)')
+
+_audit: Optional[AuditLog] = None
+def set_audit(audit: Optional[AuditLog]):
+    """send rename events to audit (None: don't record them)"""
+    global _audit
+    _audit = audit
+
+def record(action: str, folder: str, fname: str, tname: str, error: Optional[Exception], secs: float):
+    """note a rename (or revert) and how it went, if auditing is on"""
+    if _audit is not None:
+        _audit.event(action, folder, fname, tname, 'ok' if error is None else type(error).__name__, secs)
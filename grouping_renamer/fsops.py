@@ -0,0 +1,120 @@
+import os
+import sys
+import errno
+import logging
+from typing import Callable, Optional
+
+log = logging.getLogger('fsops')
+
+AT_FDCWD = -100
+RENAME_NOREPLACE = 1 # from <linux/fs.h>
+
+_renameat2: Optional[Callable] = None
+_get_errno: Optional[Callable] = None
+_renameat2_tried = False
+def _get_renameat2() -> Optional[Callable]:
+    """libc's renameat2, or None if this op sys/libc doesn't have it"""
+    global _renameat2, _get_errno, _renameat2_tried
+    if not _renameat2_tried:
+        _renameat2_tried = True
+        if sys.platform.startswith('linux'):
+            import ctypes # only paid for on first rename
+            import ctypes.util
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+                func = libc.renameat2 # glibc 2.28+
+                func.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+                func.restype = ctypes.c_int
+                _renameat2 = func
+                _get_errno = ctypes.get_errno
+            except (OSError, AttributeError):
+                log.info('no renameat2, so checking for existing files before renaming')
+    return _renameat2
+
+def rename_noreplace(src: str, dst: str, src_dir_fd:Optional[int]=None, dst_dir_fd:Optional[int]=None):
+    """rename src to dst, but never over an existing dst: raises FileExistsError
+    if dst exists and FileNotFoundError if src doesn't. On Linux that's one
+    atomic renameat2(RENAME_NOREPLACE) call; elsewhere (or on a filesystem
+    which doesn't support the flag) it's check-then-rename. Names are relative
+    to the dir_fds, if given, as for os.rename."""
+    renameat2 = _get_renameat2()
+    if renameat2 is not None:
+        if renameat2(AT_FDCWD if src_dir_fd is None else src_dir_fd, os.fsencode(src),
+                     AT_FDCWD if dst_dir_fd is None else dst_dir_fd, os.fsencode(dst),
+                     RENAME_NOREPLACE) == 0:
+            return
+        err = _get_errno()
+        if err not in (errno.EINVAL, errno.ENOSYS): # those mean "can't do NOREPLACE here"
+            raise OSError(err, os.strerror(err), src, None, dst) # FileExistsError for EEXIST, etc
+    if _lexists(dst, dst_dir_fd):
+        raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), src, None, dst)
+    os.rename(src, dst, src_dir_fd=src_dir_fd, dst_dir_fd=dst_dir_fd)
+
+def _lexists(name: str, dir_fd:Optional[int]=None) -> bool:
+    try:
+        os.stat(name, dir_fd=dir_fd, follow_symlinks=False)
+        return True
+    except FileNotFoundError:
+        return False
+
+# can files be named relative to an open directory here? (not on Windows)
+HAVE_DIR_FD = (os.rename in os.supports_dir_fd and os.open in os.supports_dir_fd
+               and os.scandir in os.supports_fd and hasattr(os, 'O_DIRECTORY'))
+
+class DirHandle:
+    """a directory opened once; listing, renaming, opening and deleting files
+    in it are done relative to its file descriptor, so the kernel doesn't look
+    up the whole path again for each one (and the process CWD doesn't matter).
+    Where the op sys can't do that, names are joined onto the path instead."""
+    def __init__(self, path: str):
+        self.path = path
+        self.fd:Optional[int] = None
+        if HAVE_DIR_FD:
+            self.fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def _name(self, name: str) -> str:
+        return name if self.fd is not None else os.path.join(self.path, name)
+
+    def scandir(self):
+        """os.scandir of the directory (entries are named relative to it)"""
+        return os.scandir(self.fd if self.fd is not None else self.path)
+
+    def rename(self, src: str, dst: str):
+        """rename_noreplace() within the directory"""
+        rename_noreplace(self._name(src), self._name(dst), self.fd, self.fd)
+
+    def open(self, name: str, mode:str='r'):
+        """like the builtin open(), for a file in the directory"""
+        flags = {'r': os.O_RDONLY, 'w': os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                 'a': os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                 'x': os.O_WRONLY | os.O_CREAT | os.O_EXCL}[mode[0]]
+        fd = os.open(self._name(name), flags, 0o666, dir_fd=self.fd)
+        return os.fdopen(fd, mode)
+
+    def unlink(self, name: str):
+        os.unlink(self._name(name), dir_fd=self.fd)
+
+    def access(self, name: str, mode: int) -> bool:
+        return os.access(self._name(name), mode, dir_fd=self.fd)
+
+    def fsync(self):
+        """make renames/new files in the directory durable, where the op sys allows"""
+        if self.fd is not None:
+            try:
+                os.fsync(self.fd)
+            except OSError:
+                pass
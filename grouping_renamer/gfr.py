@@ -9,19 +9,18 @@ Usage: see --help
 NOTE: partly written to force me into learning some Python (3.11),
 so apologies if coding sucks/is non-Pythonic (suggestions for improvement?)
 """
+import os
+import sys
 import logging
+import datetime
+from typing import Annotated, Optional
 
-from support import get_dirs_to_process
-from support import fetch_ignore
-from rename import rename_in_dir
-from undo import undo_in_dir
+# each command imports what it needs when it runs, so starting up (gfr is
+# run from per-folder hooks) and --help don't load the rest
+from history import HistoryCatalog, find_catalog, CATALOG_NAME
+from history import set_group_commit
+from stats import set_stats
 
-from support import get_id_match
-
-from support import set_verbosity
-from support import set_is_dry_run
-
-from typing_extensions import Annotated
 import typer
 
 __author    = "Wayne Stidolph"
@@ -30,7 +29,9 @@ __license   = "MIT License (see file LICENSE)"
 __copyright = "Copyright Wayne Stidolph, 2023"
 __status    = "Development"
 
-main=typer.Typer() # for command processing
+# rich-formatted help only for a person at a terminal: loading rich costs more
+# than the rest of startup put together
+main=typer.Typer(rich_markup_mode='rich' if sys.stdout.isatty() else None) # for command processing
 log=logging.getLogger()
 
 @main.command()
@@ -55,39 +56,309 @@ def rename(
         id_per_dir:Annotated[bool,
         typer.Option(help='should ID sequence restart in each dir')]='True',
         
-        verbosity:Annotated[int, typer.Option(help='0: mute, 30: probs, 20: info (per-dir), 10: debug (per-file)')]=1,
+        verbosity:Annotated[int, typer.Option(help='0: mute, 1: problems, 2: per-dir, 3: per-file (10 and up: a logging level)')]=1,
         
         skip_if_no_orderfile:bool=True,
         id_regex:str=r'\d{2,5}',
         idstart:int=10, idstep:int=10,idlen:int=4,
+        jobs:Annotated[int, typer.Option(help='dirs to work on at once')]=1,
+        inflight:Annotated[int, typer.Option(help='renames outstanding at once in a dir (for network filesystems)')]=1,
+        sync_every:Annotated[int, typer.Option(help='most renames per fsync of the history file')]=256,
+        sync_secs:Annotated[float, typer.Option(help='target seconds per fsync of the history file')]=1.0,
+        history_backend:Annotated[str, typer.Option(help="'csv': a HISTORY_FILE in each dir; 'sqlite': one "
+                                                    + CATALOG_NAME + ' for the tree')]='csv',
+        full:Annotated[bool, typer.Option(help='list every dir, even those unchanged since the last run')]=False,
+        stats:Annotated[bool, typer.Option(help='print time per phase and counters (renames, conflicts, ...) at the end')]=False,
+        stats_json:Annotated[Optional[str], typer.Option(help='write those, per dir and for the run, to this JSON file')]=None,
+        audit:Annotated[Optional[str], typer.Option(help='append a JSON line per file renamed to this file')]=None,
+        audit_sample:Annotated[float, typer.Option(help='fraction of successful renames to audit (failures always are)')]=1.0,
         dryrun:bool=True
         ): #TODO add in adapt_case param to pass to do_in_folder()
     """rename files to filename/id per ORDERFILE(s); keep HISTORY_FILE(s)"""
+    from support import walk_dirs, map_dirs, scan_dir, fetch_ignore, set_verbosity, set_is_dry_run
+    from rename import rename_in_dir, plan_dir, apply_plan, allocate_ids
+    from state import TreeState, CachedDir
   
     # #####  GLOBAL VARS ##### #
     set_verbosity(verbosity)
 
     set_is_dry_run(dryrun)
+    set_group_commit(sync_every, sync_secs)
+    set_stats(stats or stats_json is not None)
+    auditing = _start_audit(audit, audit_sample)
     
     idrgx = id_regex
     
     exclude = fetch_ignore('.gfr.ignore')
+    catalog = _open_catalog(history_backend, startdir, create=True, dryrun=dryrun)
+    if catalog is not None:
+        catalog.start_run(datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S"))
+    
+    log.info('processing RENAME from ' + startdir + (' down' if do_subtree else ''))
+
+    # dirs as the last run left them are skipped (unless full), given the same settings
+    state = TreeState(startdir, {'prefix': prefix, 'id_prefix': id_prefix, 'orderfile': orderfile,
+                                 'history_file': history_file, 'id_per_dir': id_per_dir,
+                                 'skip_if_no_orderfile': skip_if_no_orderfile, 'id_regex': id_regex,
+                                 'idstart': idstart, 'idstep': idstep, 'idlen': idlen,
+                                 'history_backend': history_backend}, use_cached=not full)
+    def done_with(snapshot, group_count, start):
+        if not dryrun:
+            # record the IDs a rerun would reserve: none once the orderfile's been used up
+            if skip_if_no_orderfile and snapshot.index.find(orderfile, adapt_case=True) is None:
+                group_count = 0
+            state.record(snapshot, orderfile, group_count, start)
+        snapshot.close()
+
+    # each dir is listed as it's reached
+    dirs = walk_dirs(startdir, exclude, do_subtree, state.cached)
+    if id_per_dir:
+        def rename_one(snapshot):
+            if isinstance(snapshot, CachedDir):
+                return 0
+            try:
+                return rename_in_dir(snapshot.folder, prefix, orderfile, history_file,
+                                     id_prefix, id_regex, idstart, idstep, idlen,
+                                     skip_if_no_orderfile, snapshot=snapshot, inflight=inflight,
+                                     catalog=catalog)
+            finally:
+                done_with(snapshot, 0, idstart)
+        renamed = map_dirs(rename_one, dirs, jobs)
+    else:
+        # plan every dir first (in walk order) so each dir's IDs can be
+        # reserved up front; then the dirs can be renamed in any order
+        def plan_one(snapshot):
+            if isinstance(snapshot, CachedDir):
+                return snapshot # still holds its IDs
+            plan = plan_dir(snapshot.folder, prefix, orderfile, id_regex,
+                            skip_if_no_orderfile, snapshot=snapshot)
+            if plan is None:
+                done_with(snapshot, 0, idstart)
+            return plan
+        def apply_one(plan_and_start):
+            (plan, start) = plan_and_start
+            if isinstance(plan, CachedDir):
+                if plan.group_count == 0 or plan.start == start:
+                    return 0
+                # an earlier dir changed how many IDs it needs, so this one moves
+                snapshot = scan_dir(plan.folder)
+                plan = snapshot and plan_dir(plan.folder, prefix, orderfile, id_regex,
+                                             skip_if_no_orderfile, snapshot=snapshot)
+                if plan is None:
+                    if snapshot:
+                        done_with(snapshot, 0, start)
+                    return 0
+            try:
+                return apply_plan(plan, history_file, id_prefix, start, idstep, idlen, inflight, catalog)
+            finally:
+                done_with(plan.snapshot, plan.group_count, start)
+        plans = map_dirs(plan_one, dirs, jobs)
+        renamed = map_dirs(apply_one, allocate_ids(plans, idstart, idstep, id_per_dir), jobs)
+    renamed_count = sum(renamed)
+    log.info('renamed ' + str(renamed_count) + ' files in all'
+             + (' (' + str(state.kept) + ' dirs unchanged since the last run)' if state.kept else ''))
+    if catalog is not None:
+        catalog.close()
+    if not dryrun:
+        state.save()
+    _stop_audit(auditing)
+    _report_stats(stats, stats_json)
+
+def _start_audit(audit_file: Optional[str], sample: float):
+    if audit_file is None:
+        return None
+    from audit import AuditLog, set_audit
+    try:
+        auditing = AuditLog(audit_file, sample)
+    except ValueError as e:
+        raise typer.BadParameter(str(e), param_hint='--audit-sample')
+    set_audit(auditing)
+    return auditing
+
+def _stop_audit(auditing):
+    if auditing is not None:
+        from audit import set_audit
+        set_audit(None)
+        auditing.close()
+
+def _report_stats(stats: bool, stats_json: Optional[str]):
+    from stats import table as stats_table, write_json as write_stats_json
+    if stats:
+        typer.echo(stats_table(), err=True) # stdout may be carrying --summary
+    if stats_json is not None:
+        write_stats_json(stats_json)
+
+@main.command()
+def plan(
+        startdir:Annotated[str,
+        typer.Argument(help='dir to start planning')]='.',
+        
+        prefix:Annotated[str,
+        typer.Argument(help="prefix for renaming; '.' means use CWD path")]='.',
+        
+        id_prefix:Annotated[str,
+        typer.Argument(help='prefix for new id')]='i',
+        
+        do_subtree:bool=False,
+        
+        orderfile:Annotated[str,
+        typer.Argument(help='file to look for in each dir holding names in desired order')]='fssort.ini',
+        
+        history_file:Annotated[str,
+        typer.Argument(help='file to track name changes (when the plan is applied)')]='rename_history.csv',
+        
+        plan_file:Annotated[str, typer.Option(help='where to write the plan (JSON lines)')]='gfr_plan.jsonl',
+        
+        id_per_dir:Annotated[bool,
+        typer.Option(help='should ID sequence restart in each dir')]='True',
+        
+        verbosity:Annotated[int, typer.Option(help='0: mute, 1: problems, 2: per-dir, 3: per-file (10 and up: a logging level)')]=1,
+        
+        skip_if_no_orderfile:bool=True,
+        id_regex:str=r'\d{2,5}',
+        idstart:int=10, idstep:int=10,idlen:int=4,
+        jobs:Annotated[int, typer.Option(help='dirs to work on at once')]=1,
+        history_backend:Annotated[str, typer.Option(help="'csv': a HISTORY_FILE in each dir; 'sqlite': one "
+                                                    + CATALOG_NAME + ' for the tree')]='csv'
+        ):
+    """work out the renaming rename would do, into PLAN_FILE (to review, then apply)"""
+    from support import walk_dirs, map_dirs, fetch_ignore, set_verbosity, set_is_dry_run
+    from rename import plan_dir, allocate_ids, number_groups
+    from planfile import PlanWriter, fingerprint_unplanned
+    set_verbosity(verbosity)
+    set_is_dry_run(True) # planning never renames anything
+    if history_backend not in ('csv', 'sqlite'):
+        raise typer.BadParameter("must be 'csv' or 'sqlite'", param_hint='--history-backend')
+    exclude = fetch_ignore('.gfr.ignore')
     
-    #TODO as Python-learning, refactor these loops to be cleaenr - maybe w/ lambda and yield?
-    dirs_to_process = get_dirs_to_process(startdir, exclude, do_subtree)
-    log.info('processing RENAME in dirs: ' + str(dirs_to_process))
-
-    used_tnames=[]
-    next_dir_id_start = idstart
-    for dir in dirs_to_process:
-        # TODO don't need to keep entire list just last_used
-        used_tnames += rename_in_dir(dir,prefix, orderfile, history_file,
-                                    id_prefix, id_regex, next_dir_id_start, idstep, idlen,
-                                    skip_if_no_orderfile)
-        if not id_per_dir and len(used_tnames) > 0:
-            last_id_used = get_id_match(used_tnames[-1], id_regex)
-            log.debug('continuing ID number sequence after '+ str(last_id_used))
-            next_dir_id_start = int(last_id_used) + idstep
+    log.info('processing PLAN from ' + startdir + (' down' if do_subtree else ''))
+    # opened before the walk, so the dir it's in is fingerprinted with it there
+    writer = PlanWriter(plan_file, startdir,
+                        {'prefix': prefix, 'id_prefix': id_prefix, 'orderfile': orderfile,
+                         'history_file': history_file, 'id_per_dir': id_per_dir,
+                         'skip_if_no_orderfile': skip_if_no_orderfile, 'id_regex': id_regex,
+                         'idstart': idstart, 'idstep': idstep, 'idlen': idlen,
+                         'history_backend': history_backend},
+                        datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S"))
+    fingerprints = {} # dir -> its fingerprint from before it was planned
+    def plan_one(snapshot):
+        fp = fingerprint_unplanned(snapshot, orderfile)
+        dir_plan = plan_dir(snapshot.folder, prefix, orderfile, id_regex,
+                            skip_if_no_orderfile, snapshot=snapshot)
+        if dir_plan is None:
+            snapshot.close()
+        else:
+            fingerprints[snapshot.folder] = fp
+        return dir_plan
+    try:
+        plans = map_dirs(plan_one, walk_dirs(startdir, exclude, do_subtree), jobs)
+        for (dir_plan, start) in allocate_ids(plans, idstart, idstep, id_per_dir):
+            writer.add(dir_plan, fingerprints.pop(dir_plan.snapshot.folder), start,
+                       number_groups(dir_plan.renames, dir_plan.prefix, id_prefix, start, idstep, idlen))
+            dir_plan.snapshot.close()
+    finally:
+        writer.close()
+    log.info('planned ' + str(writer.renames) + ' renames in ' + str(writer.dirs)
+             + ' dirs into ' + plan_file)
+
+@main.command()
+def apply(
+        plan_file:Annotated[str, typer.Argument(help='plan written by the plan command')]='gfr_plan.jsonl',
+        verbosity:Annotated[int, typer.Option(help='0: mute, 1: problems, 2: per-dir, 3: per-file (10 and up: a logging level)')]=1,
+        jobs:Annotated[int, typer.Option(help='dirs to work on at once')]=1,
+        inflight:Annotated[int, typer.Option(help='renames outstanding at once in a dir (for network filesystems)')]=1,
+        sync_every:Annotated[int, typer.Option(help='most renames per fsync of the history file')]=256,
+        sync_secs:Annotated[float, typer.Option(help='target seconds per fsync of the history file')]=1.0,
+        stats:Annotated[bool, typer.Option(help='print time per phase and counters (renames, conflicts, ...) at the end')]=False,
+        stats_json:Annotated[Optional[str], typer.Option(help='write those, per dir and for the run, to this JSON file')]=None,
+        audit:Annotated[Optional[str], typer.Option(help='append a JSON line per file renamed to this file')]=None,
+        audit_sample:Annotated[float, typer.Option(help='fraction of successful renames to audit (failures always are)')]=1.0,
+        dryrun:Annotated[bool, typer.Option(help='only check the plan (which dirs changed since); --no-dryrun to rename')]=True
+    ):
+    """do the renaming in PLAN_FILE, planning again only the dirs changed since it was written"""
+    from support import map_dirs, scan_dir, set_verbosity, set_is_dry_run
+    from rename import plan_dir, apply_plan, apply_renames, allocate_ids
+    from state import unchanged
+    from planfile import PlannedDir, read_plan
+    set_verbosity(verbosity)
+
+    set_is_dry_run(dryrun)
+    set_group_commit(sync_every, sync_secs)
+    set_stats(stats or stats_json is not None)
+    auditing = _start_audit(audit, audit_sample)
+    try:
+        (header, planned_dirs) = read_plan(plan_file)
+    except (OSError, ValueError) as e:
+        log.error('cannot apply ' + plan_file + ': ' + str(e))
+        raise typer.Exit(1)
+    params = header['params']
+    catalog = _open_catalog(params['history_backend'], header['root'], create=True, dryrun=dryrun)
+    if catalog is not None:
+        catalog.start_run(datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S"))
+
+    log.info('processing APPLY of ' + plan_file + ' (planned ' + header['created'] + ')')
+    def replan(folder, snapshot=None):
+        if snapshot is None:
+            snapshot = scan_dir(folder)
+            if snapshot is None:
+                return None
+        dir_plan = plan_dir(folder, params['prefix'], params['orderfile'], params['id_regex'],
+                            params['skip_if_no_orderfile'], snapshot=snapshot)
+        if dir_plan is None:
+            snapshot.close()
+        return dir_plan
+
+    replanned = [] # dirs changed since the plan was written
+    def check_one(planned):
+        if unchanged(planned.folder, planned.fingerprint):
+            snapshot = scan_dir(planned.folder) # still needed, to rename in
+            return snapshot and planned._replace(snapshot=snapshot)
+        log.info(planned.folder + ' changed since it was planned, so planning it again')
+        replanned.append(planned.folder)
+        return replan(planned.folder)
+    def apply_one(plan_and_start):
+        (dir_plan, start) = plan_and_start
+        try:
+            if isinstance(dir_plan, PlannedDir):
+                if dir_plan.start == start:
+                    return apply_renames(dir_plan.snapshot, dir_plan.orderfile_name, dir_plan.renames,
+                                         params['history_file'], inflight, catalog)
+                # an earlier dir changed how many IDs it needs, so this one moves
+                dir_plan = replan(dir_plan.folder, dir_plan.snapshot)
+                if dir_plan is None:
+                    return 0
+            return apply_plan(dir_plan, params['history_file'], params['id_prefix'], start,
+                              params['idstep'], params['idlen'], inflight, catalog)
+        finally:
+            if dir_plan is not None:
+                dir_plan.snapshot.close()
+    checked = map_dirs(check_one, planned_dirs, jobs)
+    renamed = map_dirs(apply_one, allocate_ids(checked, params['idstart'], params['idstep'],
+                                               params['id_per_dir']), jobs)
+    renamed_count = sum(renamed)
+    log.info('renamed ' + str(renamed_count) + ' files in all'
+             + (' (' + str(len(replanned)) + ' dirs planned again)' if replanned else ''))
+    if catalog is not None:
+        catalog.close()
+    _stop_audit(auditing)
+    _report_stats(stats, stats_json)
+
+def _open_catalog(history_backend: str, startdir: str, create: bool,
+                  dryrun:bool=False) -> Optional[HistoryCatalog]:
+    """the tree's history catalog (the nearest at or above startdir, else a
+    new one in startdir if create) for the 'sqlite' backend; None for 'csv',
+    or for a dry run of renaming (which neither needs nor writes it)"""
+    if history_backend not in ('csv', 'sqlite'):
+        raise typer.BadParameter("must be 'csv' or 'sqlite'", param_hint='--history-backend')
+    if history_backend == 'csv' or dryrun:
+        return None
+    path = find_catalog(startdir)
+    if path is None:
+        if not create:
+            log.error('no history catalog ' + CATALOG_NAME + ' in or above ' + startdir)
+            raise typer.Exit(1)
+        path = os.path.join(os.path.abspath(startdir), CATALOG_NAME)
+    return HistoryCatalog(path)
 
 @main.command()
 def undo(
@@ -102,21 +373,158 @@ def undo(
         history_filename_root:Annotated[str,
         typer.Argument(help='case-sensitive beginning of filename listing files to undo')]='rename_history.csv',
         
-        verbosity:Annotated[int, typer.Option(help='0: mute, 1: probs, 2: per-dir, 3: per-file')]=1,
+        verbosity:Annotated[int, typer.Option(help='0: mute, 1: problems, 2: per-dir, 3: per-file (10 and up: a logging level)')]=1,
 
         keep_rename_hist:bool=False,
+        jobs:Annotated[int, typer.Option(help='dirs to work on at once')]=1,
+        inflight:Annotated[int, typer.Option(help='renames outstanding at once in a dir (for network filesystems)')]=1,
+        summary:Annotated[bool, typer.Option(help='print a JSON line per dir: renamed, skipped, conflicts, failed, history file')]=False,
+        history_backend:Annotated[str, typer.Option(help="'csv': HISTORY_FILEs in each dir; 'sqlite': the tree's "
+                                                    + CATALOG_NAME)]='csv',
+        run:Annotated[Optional[int], typer.Option(help='(sqlite) run to undo; default is the latest')]=None,
+        file:Annotated[Optional[str], typer.Option(help='(sqlite) undo just the rename which gave this file its name')]=None,
+        generations:Annotated[int, typer.Option(min=1, help='(csv) how many of the latest history files to undo, in one pass')]=1,
+        to:Annotated[Optional[str], typer.Option(help='(csv) undo every history file from this date/time on, e.g. 2023_05_02')]=None,
+        stats:Annotated[bool, typer.Option(help='print time per phase and counters (renames, conflicts, ...) at the end')]=False,
+        stats_json:Annotated[Optional[str], typer.Option(help='write those, per dir and for the run, to this JSON file')]=None,
+        audit:Annotated[Optional[str], typer.Option(help='append a JSON line per file renamed to this file')]=None,
+        audit_sample:Annotated[float, typer.Option(help='fraction of successful renames to audit (failures always are)')]=1.0,
         dryrun:bool=True
     ):
-    """undo renaming given in HISTORY_FILE (s)"""
+    """undo renaming given in HISTORY_FILE (s), or in the history catalog"""
+    import json
+    from support import walk_dirs, map_dirs, scan_dir, fetch_ignore, set_verbosity, set_is_dry_run
+    from undo import undo_in_dir, undo_from_catalog
     set_verbosity(verbosity)
 
     set_is_dry_run(dryrun)
+    set_stats(stats or stats_json is not None)
+    auditing = _start_audit(audit, audit_sample)
     exclude = fetch_ignore('.gfr.ignore')
+    catalog = _open_catalog(history_backend, os.path.dirname(os.path.abspath(file)) if file else startdir,
+                            create=False)
     
-    dirs_to_process = get_dirs_to_process(startdir, exclude, do_subtree)
-    log.info('processing UNDO in dirs: ' + str(dirs_to_process))
-    for dir in dirs_to_process:
-        undo_in_dir(history_filename_root, dir, keep_rename_hist)
+    log.info('processing UNDO from ' + (file or startdir) + (' down' if do_subtree else ''))
+    if catalog is None:
+        if file is not None or run is not None: # else it'd quietly undo all of startdir
+            raise typer.BadParameter('only for the sqlite history backend', param_hint='--file/--run')
+        def undo_one(snapshot):
+            try:
+                return undo_in_dir(history_filename_root, snapshot.folder, keep_rename_hist,
+                                   snapshot=snapshot, inflight=inflight,
+                                   generations=generations, to_ts=to)
+            finally:
+                snapshot.close()
+        summaries = map_dirs(undo_one, walk_dirs(startdir, exclude, do_subtree), jobs)
+    else:
+        if generations != 1 or to is not None:
+            raise typer.BadParameter('only for the csv history backend', param_hint='--generations/--to')
+        # the catalog says which dirs the run renamed in, so no need to walk the tree
+        if file:
+            (folder, name, subtree) = (os.path.dirname(os.path.abspath(file)), os.path.basename(file), False)
+        else:
+            (folder, name, subtree) = (startdir, None, do_subtree)
+        run_id = run if run is not None else catalog.last_run(folder, subtree, name)
+        if run_id is None:
+            log.warning('nothing in ' + catalog.path + ' to undo for ' + (file or startdir))
+            _stop_audit(auditing)
+            return
+        def undo_run_in(snapshot):
+            try:
+                return undo_from_catalog(catalog, run_id, snapshot.folder, name,
+                                         snapshot=snapshot, inflight=inflight)
+            finally:
+                snapshot.close()
+        snapshots = (s for s in map(scan_dir, catalog.run_dirs(run_id, folder, subtree)) if s is not None)
+        summaries = map_dirs(undo_run_in, snapshots, jobs)
+    totals = {'renamed': 0, 'skipped': 0, 'conflicts': 0, 'failed': 0}
+    for dir_summary in summaries:
+        for k in totals:
+            totals[k] += dir_summary[k]
+        if summary:
+            typer.echo(json.dumps(dir_summary))
+    log.info('undo reverted ' + str(totals['renamed']) + ' files in all (skipped '
+             + str(totals['skipped']) + ', conflicts ' + str(totals['conflicts'])
+             + ', failed ' + str(totals['failed']) + ')')
+    if catalog is not None:
+        catalog.close()
+    _stop_audit(auditing)
+    _report_stats(stats, stats_json)
+
+@main.command()
+def watch(
+        startdir:Annotated[str,
+        typer.Argument(help='dir to watch')]='.',
+        
+        prefix:Annotated[str,
+        typer.Argument(help="prefix for renaming; '.' means use CWD path")]='.',
+        
+        id_prefix:Annotated[str,
+        typer.Argument(help='prefix for new id')]='i',
+        
+        do_subtree:bool=False,
+        
+        orderfile:Annotated[str,
+        typer.Argument(help='file to look for in each dir holding names in desired order')]='fssort.ini',
+        
+        history_file:Annotated[str,
+        typer.Argument(help='file to track name changes')]='rename_history.csv',
+        
+        verbosity:Annotated[int, typer.Option(help='0: mute, 1: problems, 2: per-dir, 3: per-file (10 and up: a logging level)')]=1,
+        
+        id_regex:str=r'\d{2,5}',
+        idstart:int=10, idstep:int=10,idlen:int=4,
+        inflight:Annotated[int, typer.Option(help='renames outstanding at once in a dir (for network filesystems)')]=1,
+        history_backend:Annotated[str, typer.Option(help="'csv': a HISTORY_FILE in each dir; 'sqlite': one "
+                                                    + CATALOG_NAME + ' for the tree')]='csv',
+        debounce:Annotated[float, typer.Option(help='seconds an orderfile must be left alone before renaming')]=2.0,
+        poll:Annotated[float, typer.Option(help='seconds between looks at the tree when polling')]=5.0,
+        polling:Annotated[bool, typer.Option(help='poll even where inotify is available')]=False,
+        audit:Annotated[Optional[str], typer.Option(help='append a JSON line per file renamed to this file')]=None,
+        audit_sample:Annotated[float, typer.Option(help='fraction of successful renames to audit (failures always are)')]=1.0,
+        dryrun:bool=True
+    ):
+    """rename a dir's files (as rename does, IDs per dir) whenever its ORDERFILE is written"""
+    from support import fetch_ignore, set_verbosity, set_is_dry_run
+    from rename import rename_in_dir
+    from watch import watch_tree
+    set_verbosity(verbosity)
+
+    set_is_dry_run(dryrun)
+    exclude = fetch_ignore('.gfr.ignore')
+    catalog = _open_catalog(history_backend, startdir, create=True, dryrun=dryrun)
+
+    def on_change(folder):
+        if catalog is not None:
+            catalog.start_run(datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S"))
+        try:
+            renamed = rename_in_dir(folder, prefix, orderfile, history_file,
+                                    id_prefix, id_regex, idstart, idstep, idlen,
+                                    True, inflight=inflight, catalog=catalog)
+            log.info('renamed ' + str(renamed) + ' files in ' + folder)
+        except OSError as e: # keep watching
+            log.error('could not rename in ' + folder + ': ' + str(e))
+
+    auditing = _start_audit(audit, audit_sample)
+    try:
+        watch_tree(startdir, exclude, do_subtree, orderfile, on_change,
+                   debounce_secs=debounce, poll_secs=poll, use_inotify=not polling)
+    except KeyboardInterrupt:
+        log.info('stopped watching ' + startdir)
+    finally:
+        _stop_audit(auditing)
+        if catalog is not None:
+            catalog.close()
+
+@main.command()
+def former_names(
+        file:Annotated[str, typer.Argument(help='file to look up')]
+    ):
+    """list what FILE used to be called, newest first, from the history catalog"""
+    catalog = _open_catalog('sqlite', os.path.dirname(os.path.abspath(file)), create=False)
+    for (name, run_id, ts) in catalog.former_names(file):
+        typer.echo(name + '\t(run ' + str(run_id) + ', ' + ts + ')')
+    catalog.close()
     
 if __name__ == "__main__":
     main()
\ No newline at end of file
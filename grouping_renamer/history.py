@@ -0,0 +1,421 @@
+import os
+import abc
+import time
+import locale
+import threading
+import logging
+from typing import BinaryIO, Callable, Iterable, Iterator, Optional
+
+from fsops import DirHandle
+from stats import count, timer
+
+log = logging.getLogger('history')
+
+# marker lines in a history file start with this; undo skips them
+MARK = '#'
+
+sync_every:int = 256 # most renames per fsync'ed batch
+sync_secs:float = 1.0 # aim for batches that take no longer than this
+def set_group_commit(count: int, secs: float):
+    global sync_every, sync_secs
+    sync_every = max(1, count)
+    sync_secs = secs
+
+class Journal(abc.ABC):
+    """where a dir's renames are recorded ahead of being done; subclasses
+    say how a batch is recorded (intend), and how it turned out (failed, done)"""
+    batch_size = 16
+    renamed = 0 # renames marked done so far (parking ones and backups too)
+
+    @abc.abstractmethod
+    def intend(self, renames: list[tuple[str, str]]):
+        """record a batch of renames which are about to be done"""
+
+    @abc.abstractmethod
+    def failed(self, fname: str, tname: str):
+        """record that one of the batch's renames didn't happen"""
+
+    @abc.abstractmethod
+    def done(self, renamed: int):
+        """mark the batch finished, renamed of them having been done"""
+
+    @abc.abstractmethod
+    def discard(self):
+        """forget the whole record (nothing was renamed after all)"""
+
+    def close(self):
+        pass
+
+    def batches(self, renames: list[tuple[str, str]]) -> Iterator[list[tuple[str, str]]]:
+        """split renames into batches, recording each as intended before it's
+        yielded; batches double in size (up to sync_every) while they take
+        less than sync_secs and halve when they take longer"""
+        pos = 0
+        while pos < len(renames):
+            batch = renames[pos:pos + self.batch_size]
+            pos += len(batch)
+            self.intend(batch)
+            started = time.monotonic()
+            yield batch
+            took = time.monotonic() - started
+            if took > sync_secs:
+                self.batch_size = max(1, self.batch_size // 2)
+            elif took < sync_secs / 2:
+                self.batch_size = min(sync_every, self.batch_size * 2)
+
+class RenameJournal(Journal):
+    """the rename history file, written ahead of the renames: a batch of
+    renames is recorded as intended and fsync'ed (one fsync for the whole
+    batch) before any of them is done, then marked done. So after a crash
+    the history covers every rename that might have happened, and undo
+    can reverse them: those of a batch with no #done are only reversed
+    once the disk shows they happened (see last_run_backwards).
+
+    File layout, which undo reads backwards as far as the header:
+        from, to, <timestamp>
+        #intent,<n>
+        <from>,<to>          (n of these)
+        #failed,<from>,<to>  (any that didn't happen)
+        #done,<n renamed>
+    """
+    def __init__(self, path: str, now_str: str, folder:Optional[DirHandle]=None):
+        self.path = path # relative to folder, if that's given
+        self.folder = folder
+        self.dir_path = os.path.dirname(path) if folder is None else folder.path # for stats
+        # a new file (FileExistsError if it isn't): one run's history is never
+        # added to another's, where undo (or discard()) would take both as one
+        if folder is None:
+            self.file = open(path, 'x')
+        else:
+            self.file = folder.open(path, 'x')
+        self.file.write('from, to, %s\n' % now_str)
+        self._sync()
+        # so the new file itself survives a crash
+        if folder is None:
+            _sync_dir(os.path.dirname(path))
+        else:
+            folder.fsync()
+        self.batch_size = min(16, sync_every) # grows while batches are quick
+
+    def _sync(self):
+        with timer(self.dir_path, 'history'):
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def intend(self, renames: list[tuple[str, str]]):
+        """durably record renames which are about to be done"""
+        self.file.write(MARK + 'intent,' + str(len(renames)) + '\n')
+        self.file.writelines(fname + ',' + tname + '\n' for (fname, tname) in renames)
+        self._sync()
+
+    def failed(self, fname: str, tname: str):
+        self.file.write(MARK + 'failed,' + fname + ',' + tname + '\n')
+
+    def done(self, renamed: int):
+        """mark the last intended batch finished (made durable by the next sync)"""
+        self.file.write(MARK + 'done,' + str(renamed) + '\n')
+        self.renamed += renamed
+
+    def close(self):
+        if not self.file.closed:
+            self._sync()
+            count(self.dir_path, 'history_bytes', self.file.tell())
+            self.file.close()
+
+    def discard(self):
+        self.file.close()
+        if self.folder is None:
+            os.remove(self.path)
+        else:
+            self.folder.unlink(self.path)
+
+def _sync_dir(folder: str):
+    """fsync a directory, where the op sys allows that"""
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    try:
+        fd = os.open(folder or '.', os.O_RDONLY | os.O_DIRECTORY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+# the history is written in text mode, so read it back the same way
+_ENCODING = locale.getpreferredencoding(False)
+
+def lines_backwards(file: BinaryIO, chunk_size:int=1<<16) -> Iterator[str]:
+    """the lines of a (binary) file, last first, read from the end a chunk
+    at a time so only what's been yielded so far has been read"""
+    file.seek(0, os.SEEK_END)
+    pos = file.tell()
+    head = b'' # start of the last line seen, which may begin in an earlier chunk
+    while pos > 0:
+        step = min(chunk_size, pos)
+        pos -= step
+        file.seek(pos)
+        lines = (file.read(step) + head).split(b'\n')
+        head = lines.pop(0)
+        for line in reversed(lines):
+            yield line.decode(_ENCODING, 'surrogateescape')
+    yield head.decode(_ENCODING, 'surrogateescape')
+
+def last_run_backwards(lines_last_first: Iterable[str]) -> Iterator[tuple[str, str, bool]]:
+    """the (from, to, done) renames of a history file's last run, newest first,
+    from its lines in reverse (as lines_backwards gives them), less any marked
+    as failed; stops at the header. done is False for those of a batch left
+    unfinished (no #done), which may or may not have happened: undo has to
+    check. Lines from before the journal markers were written are all done"""
+    done: Optional[bool] = None # None until a marker says which it is
+    failed: set[tuple[str, str]] = set()
+    unsure: list[tuple[str, str]] = [] # read before any marker
+    for line in lines_last_first:
+        line = line.strip()
+        if line.startswith(MARK):
+            (kind, *fields) = line[len(MARK):].split(',')
+            if kind == 'failed' and len(fields) == 2:
+                failed.add((fields[0], fields[1]))
+                if done is None: # no #done after it
+                    done = False
+            elif kind in ('done', 'intent'):
+                if done is None: # the renames read so far were a batch with no #done
+                    yield from ((f, t, False) for (f, t) in unsure)
+                    unsure = []
+                (done, failed) = (True, set())
+            continue
+        fields = line.split(',')
+        if len(fields) > 2: # the header, "from, to, <timestamp>"
+            break
+        if len(fields) != 2 or (fields[0], fields[1]) in failed:
+            continue
+        if done is None:
+            unsure.append((fields[0], fields[1]))
+        else:
+            yield (fields[0], fields[1], done)
+    yield from ((f, t, True) for (f, t) in unsure) # no markers at all: an old file
+
+def renames_done(lines: Iterable[str],
+                 confirm:Optional[Callable[[list[tuple[str, str]]], list[tuple[str, str]]]]=None
+                 ) -> Iterator[tuple[str, str]]:
+    """the (from, to) renames of a history file, in the order they were done,
+    less any marked as failed. Those of a batch left unfinished at the end
+    may or may not have happened: confirm (if given) says which did, else
+    they're all kept. Lines from before the journal markers were written
+    are all taken as done"""
+    batch: list[tuple[str, str]] = []
+    failed: set[tuple[str, str]] = set()
+    in_batch = False
+    for line in lines:
+        line = line.strip()
+        if line.startswith(MARK):
+            (kind, *fields) = line[len(MARK):].split(',')
+            if kind == 'failed' and len(fields) == 2:
+                failed.add((fields[0], fields[1]))
+                continue
+            yield from (r for r in batch if r not in failed) # an intent or done ends the batch
+            (batch, failed, in_batch) = ([], set(), kind == 'intent')
+            continue
+        fields = line.split(',')
+        if len(fields) != 2: # a header (or blank)
+            continue
+        if in_batch:
+            batch.append((fields[0], fields[1]))
+        else:
+            yield (fields[0], fields[1])
+    batch = [r for r in batch if r not in failed]
+    if in_batch and confirm is not None: # no #done after it
+        batch = confirm(batch)
+    yield from batch
+
+CATALOG_NAME = '.gfr_history.sqlite'
+
+def find_catalog(startdir: str) -> Optional[str]:
+    """path of the history catalog for startdir: in it, or the nearest dir above"""
+    folder = os.path.abspath(startdir)
+    while True:
+        path = os.path.join(folder, CATALOG_NAME)
+        if os.path.isfile(path):
+            return path
+        parent = os.path.dirname(folder)
+        if parent == folder:
+            return None
+        folder = parent
+
+class HistoryCatalog:
+    """every rename under a tree, in one SQLite file at its root (in place of
+    a history file per dir). Each gfr run is a numbered run; its renames
+    are kept by dir (relative to the root) in the order they were done,
+    with what became of each: 'intent', 'done', 'failed' or 'undone'.
+    One connection is shared by the threads working on dirs, so each
+    transaction holds a lock"""
+    def __init__(self, path: str):
+        import sqlite3 # only needed for this backend
+        self.path = path
+        self.root = os.path.dirname(os.path.abspath(path))
+        self.lock = threading.Lock()
+        self.run_id:Optional[int] = None
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.db.execute('PRAGMA journal_mode=WAL') # commits append; readers don't block
+            self.db.executescript('''
+                CREATE TABLE IF NOT EXISTS runs (
+                    run_id INTEGER PRIMARY KEY, ts TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS renames (
+                    run_id INTEGER NOT NULL, dir TEXT NOT NULL, seq INTEGER NOT NULL,
+                    from_name TEXT NOT NULL, to_name TEXT NOT NULL, state TEXT NOT NULL,
+                    PRIMARY KEY (run_id, dir, seq));
+                CREATE INDEX IF NOT EXISTS renames_by_name ON renames (dir, to_name);
+            ''')
+
+    def close(self):
+        self.db.close()
+
+    def _rel(self, folder: str) -> str:
+        return os.path.relpath(os.path.abspath(folder), self.root).replace(os.sep, '/')
+
+    def _abs(self, rel: str) -> str:
+        return os.path.normpath(os.path.join(self.root, rel))
+
+    def _transaction(self, *statements: tuple[str, Iterable[tuple]]):
+        """run each (sql, rows) statement for all its rows, in one transaction"""
+        with self.lock:
+            self.db.execute('BEGIN')
+            try:
+                for (sql, rows) in statements:
+                    self.db.executemany(sql, rows)
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+
+    def start_run(self, now_str: str) -> int:
+        """number a new run, which journal() then records renames under"""
+        with self.lock:
+            self.run_id = self.db.execute('INSERT INTO runs (ts) VALUES (?)', (now_str,)).lastrowid
+        return self.run_id
+
+    def journal(self, folder: str) -> 'CatalogJournal':
+        """a Journal for folder's renames in the current run"""
+        return CatalogJournal(self, self.run_id, self._rel(folder))
+
+    def _active_in(self, folder: str, subtree: bool) -> tuple[str, tuple]:
+        """SQL condition (and its parameters) for renames in folder (and below
+        it if subtree) which are still to be undone"""
+        rel = self._rel(folder)
+        if subtree and rel == '.':
+            return ("state IN ('intent', 'done')", ())
+        if subtree:
+            return ("state IN ('intent', 'done') AND (dir = ? OR substr(dir, 1, ?) = ?)",
+                    (rel, len(rel) + 1, rel + '/'))
+        return ("state IN ('intent', 'done') AND dir = ?", (rel,))
+
+    def last_run(self, folder: str, subtree:bool=False, name:Optional[str]=None) -> Optional[int]:
+        """the latest run with renames in folder (or below) not yet undone;
+        just those giving a file name, if that's given"""
+        (cond, params) = self._active_in(folder, subtree)
+        if name is not None:
+            (cond, params) = (cond + ' AND to_name = ?', params + (name,))
+        with self.lock:
+            return self.db.execute('SELECT max(run_id) FROM renames WHERE ' + cond, params).fetchone()[0]
+
+    def run_dirs(self, run_id: int, folder: str, subtree:bool=False) -> list[str]:
+        """the dirs, as paths, in which run_id's renames are to be undone"""
+        (cond, params) = self._active_in(folder, subtree)
+        with self.lock:
+            rows = self.db.execute('SELECT DISTINCT dir FROM renames WHERE run_id = ? AND '
+                                   + cond + ' ORDER BY dir', (run_id,) + params).fetchall()
+        return [self._abs(d) for (d,) in rows]
+
+    def renames_newest_first(self, run_id: int, folder: str,
+                             name:Optional[str]=None) -> list[tuple[int, str, str, str]]:
+        """(seq, from, to, state) of run_id's renames in folder which are to be
+        undone, newest first; just the one which gave name, if that's given.
+        State 'intent' means its batch wasn't finished, so it may not have happened"""
+        sql = ("SELECT seq, from_name, to_name, state FROM renames WHERE run_id = ? AND dir = ?"
+               " AND state IN ('intent', 'done')")
+        params:tuple = (run_id, self._rel(folder))
+        if name is not None:
+            sql += ' AND to_name = ?'
+            params += (name,)
+        with self.lock:
+            rows = self.db.execute(sql + ' ORDER BY seq DESC', params).fetchall()
+        return rows[:1] if name is not None else rows
+
+    def run_ts(self, run_id: int) -> str:
+        with self.lock:
+            row = self.db.execute('SELECT ts FROM runs WHERE run_id = ?', (run_id,)).fetchone()
+        return row[0] if row else str(run_id)
+
+    def mark_undone(self, run_id: int, folder: str, seqs: Iterable[int]):
+        rel = self._rel(folder)
+        self._transaction(("UPDATE renames SET state = 'undone' WHERE run_id = ? AND dir = ? AND seq = ?",
+                           ((run_id, rel, seq) for seq in seqs)))
+
+    def former_names(self, path: str) -> list[tuple[str, int, str]]:
+        """what the file at path was called before each rename which led to its
+        current name, newest first, as (old name, run, run's timestamp)"""
+        rel = self._rel(os.path.dirname(os.path.abspath(path)))
+        name = os.path.basename(path)
+        former = []
+        before = (None, None) # only look at renames earlier than the last one found
+        with self.lock:
+            while True:
+                row = self.db.execute(
+                    "SELECT r.from_name, r.run_id, r.seq, runs.ts FROM renames r JOIN runs USING (run_id)"
+                    " WHERE r.dir = ? AND r.to_name = ? AND r.state = 'done'"
+                    " AND (? IS NULL OR r.run_id < ? OR (r.run_id = ? AND r.seq < ?))"
+                    " ORDER BY r.run_id DESC, r.seq DESC LIMIT 1",
+                    (rel, name, before[0], before[0], before[0], before[1])).fetchone()
+                if row is None:
+                    return former
+                (name, run_id, seq, ts) = row
+                former.append((name, run_id, ts))
+                before = (run_id, seq)
+
+class CatalogJournal(Journal):
+    """a dir's renames in one run, recorded in the HistoryCatalog: each
+    batch is one committed transaction before any of it is done"""
+    def __init__(self, catalog: HistoryCatalog, run_id: int, rel_dir: str):
+        self.catalog = catalog
+        self.run_id = run_id
+        self.dir = rel_dir
+        self.seq = 0
+        self.batch_start = 0
+        self.batch_failed: list[tuple[str, str]] = []
+        self.batch_size = min(16, sync_every)
+
+    def intend(self, renames: list[tuple[str, str]]):
+        self.batch_start = self.seq
+        self.batch_failed = []
+        rows = [(self.run_id, self.dir, self.seq + n, fname, tname, 'intent')
+                for (n, (fname, tname)) in enumerate(renames)]
+        self.seq += len(rows)
+        self.catalog._transaction(('INSERT INTO renames VALUES (?, ?, ?, ?, ?, ?)', rows))
+
+    def failed(self, fname: str, tname: str):
+        self.batch_failed.append((fname, tname))
+
+    def done(self, renamed: int):
+        self._settle(done=True)
+        self.renamed += renamed
+
+    def close(self):
+        if self.batch_failed: # a batch given up on part way
+            self._settle(done=False)
+
+    def _settle(self, done: bool):
+        """mark the batch's failures, and (if done) the rest as done"""
+        key = (self.run_id, self.dir, self.batch_start, self.seq)
+        in_batch = "WHERE run_id = ? AND dir = ? AND seq >= ? AND seq < ? AND state = 'intent'"
+        self.catalog._transaction(
+            ("UPDATE renames SET state = 'failed' " + in_batch + " AND from_name = ? AND to_name = ?",
+             (key + f for f in self.batch_failed)),
+            ("UPDATE renames SET state = 'done' " + in_batch, [key] if done else []))
+        self.batch_failed = []
+
+    def discard(self):
+        self.catalog._transaction(('DELETE FROM renames WHERE run_id = ? AND dir = ?',
+                                   [(self.run_id, self.dir)]))
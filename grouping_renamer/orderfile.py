@@ -0,0 +1,134 @@
+import os
+import re
+import csv
+import mmap
+import codecs
+import logging
+from typing import Callable, Iterable, Iterator, Optional
+
+from fsops import DirHandle
+
+log = logging.getLogger('orderfile')
+
+# reading an orderfile: the bytes are mapped (not read into one big buffer),
+# decoded a chunk at a time, split into lines and handed to the parser for
+# the file's format, whose names are handed on as they come; so a 500k entry
+# orderfile is never held as a whole, only its names that are kept (once
+# each, in the set that de-duplicates them)
+
+CHUNK_SIZE = 1 << 20 # bytes decoded at a time
+
+Parser = Callable[[Iterator[str]], Iterator[str]] # lines in, names (maybe blank or repeated) out
+
+def parse_list(lines: Iterator[str]) -> Iterator[str]:
+    """a plain list, a name per line"""
+    for line in lines:
+        yield line.strip()
+
+_SECTION = re.compile(r'\[.*\]$')
+_ENTRY = re.compile(r'[A-Za-z_]*\d+\s*=')
+
+def parse_faststone(lines: Iterator[str]) -> Iterator[str]:
+    """FastStone's .fssort.ini: a name per line, or, once there are [section]
+    headers, the names are the values of its numbered entries (1=FOO_0003.jpg,
+    or File1=...); other key=value settings and ; or # comments are skipped"""
+    in_section = False
+    for line in lines:
+        line = line.strip()
+        if _SECTION.match(line):
+            in_section = True
+        elif not in_section:
+            yield line
+        elif line.startswith((';', '#')):
+            continue
+        else:
+            entry = _ENTRY.match(line)
+            if entry:
+                yield line[entry.end():].strip()
+            elif '=' not in line:
+                yield line
+
+_NAME_COLUMNS = ('filename', 'file', 'name', 'file name')
+
+def parse_csv(lines: Iterator[str]) -> Iterator[str]:
+    """a CSV manifest: the names are in its filename (or file, or name)
+    column if it has a header row naming one, else its first column"""
+    rows = csv.reader(lines)
+    column = 0
+    for row in rows:
+        headers = [h.strip().lower() for h in row]
+        for name in _NAME_COLUMNS:
+            if name in headers:
+                column = headers.index(name)
+                break
+        else: # no header, so this row is a name too
+            yield row[0].strip() if row else ''
+        break
+    for row in rows:
+        yield row[column].strip() if len(row) > column else ''
+
+FORMATS: dict[str, Parser] = {'list': parse_list, 'faststone': parse_faststone, 'csv': parse_csv}
+SUFFIXES: dict[str, str] = {'.ini': 'faststone', '.csv': 'csv'} # anything else is a list
+
+def register_format(name: str, parser: Parser, suffixes: Iterable[str]=()):
+    """add (or replace) a format; orderfiles ending in any of suffixes are read with it"""
+    FORMATS[name] = parser
+    for suffix in suffixes:
+        SUFFIXES[suffix.lower()] = name
+
+def format_for(fname: str) -> str:
+    return SUFFIXES.get(os.path.splitext(fname)[1].lower(), 'list')
+
+def detect_encoding(head: bytes) -> str:
+    """the encoding its byte-order mark says, or UTF-8 if it hasn't one"""
+    if head.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    return 'utf-8'
+
+def decode_lines(data, encoding: str) -> Iterator[str]:
+    """the lines of data (bytes, or a mmap), decoded a chunk at a time. UTF-8
+    bytes that don't decode are kept as surrogates, the way os.listdir()
+    gives names that aren't valid UTF-8, so they still match"""
+    decoder = codecs.getincrementaldecoder(encoding)('replace' if encoding == 'utf-16' else 'surrogateescape')
+    partial = ''
+    for start in range(0, len(data), CHUNK_SIZE):
+        text = partial + decoder.decode(data[start:start + CHUNK_SIZE])
+        lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+        partial = lines.pop()
+        yield from lines
+    partial += decoder.decode(b'', final=True)
+    if partial:
+        yield partial
+
+def unique(names: Iterable[str]) -> Iterator[str]:
+    """names without blanks, and each only the first time it comes"""
+    seen = set()
+    add = seen.add
+    for name in names:
+        if name and name not in seen:
+            add(name)
+            yield name
+
+def read_names(folder: str, fname: str, handle:Optional[DirHandle]=None,
+               fmt:Optional[str]=None, once:bool=True) -> Iterator[str]:
+    """the names listed in orderfile folder/fname, in order, once each (or,
+    if not once, as listed, blanks and repeats too: for a caller that weeds
+    them out itself), read as they're wanted; fmt is one of FORMATS (default:
+    by fname's suffix). Pass the folder's handle if it's open"""
+    try:
+        if handle is not None:
+            file = handle.open(fname, 'rb')
+        else:
+            file = open(os.path.join(folder, fname), 'rb')
+    except (FileNotFoundError, IsADirectoryError):
+        log.error('read_names cannot find ' + folder + ' ' + fname)
+        return
+    parser = FORMATS[fmt or format_for(fname)]
+    with file:
+        if os.fstat(file.fileno()).st_size == 0: # (can't map an empty file)
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            names = parser(decode_lines(data, detect_encoding(data[:4])))
+            yield from unique(names) if once else names
@@ -0,0 +1,87 @@
+import os
+import json
+import logging
+from typing import Iterable, Iterator, NamedTuple, Optional
+
+from support import DirSnapshot
+from rename import DirPlan
+from state import fingerprint
+
+log = logging.getLogger('planfile')
+
+PLAN_VERSION = 1
+
+class PlannedDir(NamedTuple):
+    """one dir's part of a plan file: its renames, already numbered, and its
+    fingerprint() when they were worked out (so apply can tell if it's changed)"""
+    folder: str
+    fingerprint: dict
+    start: int # the ID its groups were numbered from
+    group_count: int
+    renames: list[tuple[str, str]] # (from, to), in plan order
+    snapshot: Optional[DirSnapshot] = None # once it's been listed again, to apply
+
+    @property
+    def orderfile_name(self) -> Optional[str]:
+        return self.fingerprint['orderfile']
+
+def fingerprint_unplanned(snapshot: DirSnapshot, orderfile_name: str) -> Optional[dict]:
+    """fingerprint() of snapshot's dir as it was listed, and of its orderfile
+    before it's read: taken before planning, so any change made while the dir
+    is planned makes the plan stale rather than being taken for what was planned"""
+    return fingerprint(snapshot.folder, snapshot.index.find(orderfile_name, adapt_case=True),
+                       snapshot.stat)
+
+class PlanWriter:
+    """writes a plan file, a line of JSON at a time: first the root dir and
+    the run's settings, then each dir with something to rename"""
+    def __init__(self, path: str, root: str, params: dict, now_str: str):
+        self.path = path
+        self.root = os.path.abspath(root)
+        self.dirs = 0
+        self.renames = 0
+        self.file = open(path, 'w', encoding='utf-8')
+        self._write({'version': PLAN_VERSION, 'root': self.root, 'created': now_str, 'params': params})
+
+    def _write(self, entry: dict):
+        # ASCII-escaped, so names that aren't valid UTF-8 come back as they were
+        self.file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+
+    def add(self, plan: DirPlan, fp: Optional[dict], start: int,
+            rename_list: Iterable[tuple[str, str]]):
+        """add a dir's plan, with its fingerprint from before it was planned
+        (see fingerprint_unplanned), numbered from start into rename_list (of
+        (from, to) filenames, e.g. a RenamePlan)"""
+        folder = plan.snapshot.folder
+        if fp is None:
+            log.warning(folder + ' went away while it was being planned')
+            return
+        self._write({'dir': os.path.relpath(folder, self.root).replace(os.sep, '/'),
+                     'fingerprint': fp, 'start': start, 'group_count': plan.group_count,
+                     'renames': [[f, t] for (f, t) in rename_list]})
+        self.dirs += 1
+        self.renames += len(rename_list)
+
+    def close(self):
+        self.file.close()
+
+def read_plan(path: str) -> tuple[dict, Iterator[PlannedDir]]:
+    """the header of a plan file (root and params), and its dirs as they're read;
+    raises ValueError if it isn't a plan file"""
+    pf = open(path, encoding='utf-8')
+    try:
+        header = json.loads(pf.readline() or 'null')
+    except ValueError:
+        header = None
+    if not isinstance(header, dict) or header.get('version') != PLAN_VERSION:
+        pf.close()
+        raise ValueError(path + ' is not a plan file (version ' + str(PLAN_VERSION) + ')')
+    root = header['root']
+    def planned_dirs() -> Iterator[PlannedDir]:
+        with pf:
+            for line in pf:
+                entry = json.loads(line)
+                yield PlannedDir(os.path.normpath(os.path.join(root, *entry['dir'].split('/'))),
+                                 entry['fingerprint'], entry['start'], entry['group_count'],
+                                 [(f, t) for (f, t) in entry['renames']])
+    return (header, planned_dirs())
@@ -1,13 +1,19 @@
 import os
+import re
 import datetime
-from typing import List
+from array import array
+from typing import Iterable, Iterator, NamedTuple, Optional
 import logging
 
-from support import change_dir,fetch_lists,loadfile_lines
-from support import find_case_insensitive, remove_any_matching, scrub_dups, scrub_not_matching
-from support import get_fullid,get_next_id
+from support import fetch_lists,loadfile_lines,scan_dir,run_renames,DirectoryIndex,DirSnapshot
+from support import as_directory_index, any_matcher
+from orderfile import unique
+from support import get_id_matcher,get_next_id
 
 from support import get_is_dry_run
+from history import Journal, RenameJournal, HistoryCatalog, CATALOG_NAME
+from state import STATE_NAME
+from stats import count, timer
 
 log = logging.getLogger('rename')
 
@@ -19,161 +25,396 @@ def make_bu_name(fn: str, bustr: str):
     else:
         return fn[:ld]+'__'+bustr+fn[ld:]
 
-def make_rename_list(orderednames: list[str], idregex: str, to_pref:str, id_prefix:str,
-                     idstart: int, idstep:int, idlen:int=4):
-    """build replacement list, new names given by
+class RenamePlan:
+    """a dir's renames, group by group, kept compactly for big dirs: the names
+    to rename (the strings the orderfile gave, not copies), each one's group
+    number, and per group the length of its full ID (what's after it is kept)
+    and, once numbered, the start of its new names. The new names are only
+    made as the (from, to) pairs are iterated over"""
+    __slots__ = ('names', 'group_of', 'spans', 'prefixes')
+    def __init__(self, names: list[str], group_of: array, spans: array,
+                 prefixes:Optional[list[str]]=None):
+        self.names = names
+        self.group_of = group_of
+        self.spans = spans
+        self.prefixes = prefixes # None until numbered
+
+    @property
+    def group_count(self) -> int:
+        return len(self.spans)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __iter__(self) -> Iterator[tuple[str, str]]:
+        """(from, to) of each rename, in plan order"""
+        (spans, prefixes) = (self.spans, self.prefixes)
+        for (name, group) in zip(self.names, self.group_of):
+            yield (name, prefixes[group] + name[spans[group]:])
+
+def group_names(orderednames: Iterable[str], idregex: str) -> RenamePlan:
+    """bucket names by their full ID (prefix + ID, e.g. 'a_100') in one pass
+    into a RenamePlan, yet to be numbered; groups (and names within a group)
+    keep their order of first encounter. Names with no embedded ID are left
+    out, so they won't be renamed"""
+    group_ids: dict[str, int] = {}
+    names: list[str] = []
+    group_of = array('I')
+    spans = array('I')
+    fullid_end = get_id_matcher(idregex).fullid_end
+    for name in orderednames:
+        end = fullid_end(name) # -1 if no ID (or name is '')
+        if end >= 0:
+            group = group_ids.setdefault(name[:end], len(spans))
+            if group == len(spans):
+                spans.append(end)
+            names.append(name)
+            group_of.append(group)
+    # put each group's names together, keeping their order: count each
+    # group's names, and so where its first one goes, then place them
+    sizes = array('I', bytes(4 * len(spans)))
+    for group in group_of:
+        sizes[group] += 1
+    (at, grouped_of) = (array('I'), array('I'))
+    for (group, size) in enumerate(sizes):
+        at.append(len(grouped_of))
+        grouped_of.extend(array('I', [group]) * size)
+    grouped: list = [None] * len(names)
+    for (name, group) in zip(names, group_of):
+        grouped[at[group]] = name
+        at[group] += 1
+    return RenamePlan(grouped, grouped_of, spans)
+
+def number_groups(plan: RenamePlan, to_pref:str, id_prefix:str,
+                  idstart: int, idstep:int, idlen:int=4) -> RenamePlan:
+    """the plan numbered (it's left as it was): each group takes the next ID
+    and each name becomes to_pref + id_prefix + ID + end of existing name"""
+    prefixes = [to_pref + id_prefix + get_next_id(idstart, idstep * group, idlen)
+                for group in range(plan.group_count)]
+    return RenamePlan(plan.names, plan.group_of, plan.spans, prefixes)
+
+def make_rename_list(orderednames: Iterable[str], idregex: str, to_pref:str, id_prefix:str,
+                     idstart: int, idstep:int, idlen:int=4) -> RenamePlan:
+    """build the renames, new names given by
        to_pref + id_prefix + calculated ID + end of existing name"""
-    # treat orderfile specially
-    repl_list=[]
-    current_id:str = get_next_id(idstart-idstep,idstep, idlen)
-    used_current_id=False
-    used_id_counter = 0
-    on_len = len(orderednames)
-    
-    for on_idx in range(0, on_len):
-        name_to_update = orderednames[on_idx]
-        
-        if name_to_update: # might be '', a previously a deleted entry
-            fullid = get_fullid(name_to_update, idregex) # e.g., 'a_100'
-
-            if fullid:
-            # note if it doesn't have an embedded IF ID then
-            # fullid won't match and file will not be renamed 
-               
-                newstart=to_pref + id_prefix + current_id
-                for x in range(on_idx, on_len):
-                # for this and every remaining entry in ordered names
-                    origname=orderednames[x]
-
-                    if origname.startswith(fullid.group()):
-                        # if we find another that matches the fullid
-                        # build a 'to' which is the target group and next ID
-                        # then we add to rename list
-                        repl_list.append({
-                            'from': origname,
-                            'to': newstart+origname[fullid.span()[1]:]
-                        })
-                        used_current_id=True
-                        orderednames[x]='' # and delete the entry from 'orderednames'
-        if used_current_id:
-            used_id_counter += 1
-            current_id=get_next_id(int(current_id), idstep, idlen)
-            used_current_id=False
-    return repl_list
+    return number_groups(group_names(orderednames, idregex),
+                         to_pref, id_prefix, idstart, idstep, idlen)
     
-def fix_orderlines(orig_ol: list[str],
-                   dirlist: list[str],
+def fix_orderlines(orig_ol: Iterable[str],
+                   dirlist: DirectoryIndex,
                    exclude_list: list[str],
                    adapt_to_case:bool,
                    must_regex='') -> list[str]:
     """return new array of files to process, based on the original ordered list
     but with:
     * duplicates and blanks removed
-    * case adjusted to match what the OS reports
+    * case (and Unicode normalization) adjusted to match what the OS reports
     * excluding names that start with any entry entry in exclude_list,
     * exluding names that don't match the (option) must_regex (blank or * 
     regex matches all string after the exclud_list is applied)
     """
     
-    ol_de_duped= scrub_dups(orig_ol)
-    ol_excluded = remove_any_matching(ol_de_duped, exclude_list) 
-    processed_ol = scrub_not_matching(ol_excluded, must_regex)
+    # one pass, without copies: orig_ol can be a (long) list or just an
+    # iterator, say of an orderfile's names as read (this is the one place
+    # they're de-duplicated)
+    excluded = any_matcher(exclude_list or [])
+    has_id = get_id_matcher(must_regex).search if must_regex else (lambda s: True)
+    processed_ol = (s for s in unique(orig_ol) if not excluded(s) and has_id(s))
 
     # now, anything in the processed orderlist might be of interest
     # (if, and only if, we find it in the list of filenames ('dirlist'))
-    if adapt_to_case :
-        final_lines = find_case_insensitive(processed_ol, dirlist)
-    else:
-        final_lines = [line for line in processed_ol if line in dirlist]
+    final_lines = as_directory_index(dirlist).find_all(processed_ol, adapt_to_case)
     return final_lines
   
-def do_rename(rename_list, hist_file_obj) -> List[str]:
-    """execute the rename_list (of objects with 'from' and 'to' filenames) """
-    used_newnames=[] # array of used to-names
-    for rename_item in rename_list:
-        fname = rename_item['from']
-        tname = rename_item['to']
-        
-        is_sane = True
-        if os.path.isfile(tname):
+def schedule_renames(rename_list: Iterable[tuple[str, str]],
+                     snapshot:DirSnapshot) -> list[tuple[str, str]]:
+    """order the rename_list (of (from, to) filenames, e.g. a RenamePlan) into
+    (from, to) steps which can be done one after another: a rename comes after
+    the rename that frees up its 'to' name, and each cycle of renames (say,
+    swapping FOO_i0010 and FOO_i0020 on a re-run) is broken with one temporary
+    name. Renames whose 'from' is missing, or whose 'to' name is taken by a file
+    that isn't itself being renamed, are dropped (and logged). The snapshot
+    is updated to match, so later checks (and a dry run) see the steps done."""
+    moves: dict[str, str] = {} # from -> to, in plan order
+    targets: dict[str, str] = {} # to -> from
+    for (fname, tname) in rename_list:
+        if fname == tname:
+            log.debug('already named: %s', fname)
+        elif not snapshot.is_file(fname):
+            log.info('"from" file missing: %s', fname)
+        elif tname in targets:
             log.warning('"to" file already exists: ' + tname)
-            is_sane=False
-        if not os.path.exists(fname):
-            log.info('"from" file missing: ' + fname)
-            is_sane= False
-        if is_sane :
-            log.debug('renaming: '+ fname + ' to '+ tname)
-            used_newnames.append(tname)
-            if not get_is_dry_run():
-                os.rename(fname, tname)
-                hist_file_obj.write(fname+','+tname+'\n')
-    log.info('dir '+os.getcwd()+' renamed '+ str(len(used_newnames)) + ' files')
+            count(snapshot.folder, 'conflicts')
+        else:
+            moves[fname] = tname
+            targets[tname] = fname
+
+    # a 'to' name that's on disk must be renamed out of the way first, else the
+    # rename into it is dropped - as is any rename waiting on *that* one, etc
+    blocked = [f for (f, t) in moves.items() if snapshot.exists(t) and t not in moves]
+    while blocked:
+        fname = blocked.pop()
+        tname = moves.pop(fname)
+        del targets[tname]
+        log.warning('"to" file already exists: ' + tname)
+        count(snapshot.folder, 'conflicts')
+        if fname in targets: # someone wanted fname, which now won't be vacated
+            blocked.append(targets[fname])
+
+    steps: list[tuple[str, str]] = []
+    done: set[str] = set()
+    for start in moves:
+        if start in done:
+            continue
+        chain = [start] # each one's 'to' is the next one's 'from'
+        next_from = moves[start]
+        while next_from in moves and next_from not in done and next_from != start:
+            chain.append(next_from)
+            next_from = moves[next_from]
+        done.update(chain)
+        if next_from == start: # a cycle: park one file, then shift the rest along
+            parked = _temp_name(start, snapshot, moves, targets)
+            steps.append((start, parked))
+            steps += [(f, moves[f]) for f in reversed(chain[1:])]
+            steps.append((parked, moves[start]))
+        else: # free the end of the chain first
+            steps += [(f, moves[f]) for f in reversed(chain)]
+
+    for (fname, tname) in steps:
+        log.debug('renaming: %s to %s', fname, tname)
+        snapshot.renamed(fname, tname)
+    return steps
+
+def _temp_name(fname: str, snapshot:DirSnapshot, moves: dict[str, str],
+               targets: dict[str, str]) -> str:
+    """a name that isn't on disk or in the plan (as a 'from' or a 'to'), for parking fname"""
+    n = 0
+    while True:
+        tmp = make_bu_name(fname, 'gfr_swap' + (str(n) if n else ''))
+        if not snapshot.exists(tmp) and tmp not in moves and tmp not in targets:
+            return tmp
+        n += 1
+
+def do_rename(rename_list: Iterable[tuple[str, str]], journal:Optional[Journal], snapshot:DirSnapshot,
+              inflight:int=1) -> int:
+    """execute the rename_list (of (from, to) filenames, e.g. a RenamePlan)
+    in the snapshot's folder, in the order schedule_renames() gives, with up
+    to inflight renames outstanding at once, recording them in the journal
+    (None for a dry run) batch by batch before they're done; files are
+    checked against the snapshot rather than the disk. The number of files
+    renamed (to their new names; parking them doesn't count)"""
+    folder = snapshot.folder
+    with timer(folder, 'schedule'):
+        to_do = schedule_renames(rename_list, snapshot)
+    parked = set() # temporary names, which a later step renames on
+    later_froms = set()
+    for (fname, tname) in reversed(to_do):
+        if tname in later_froms:
+            parked.add(tname)
+        later_froms.add(fname)
+
+    if get_is_dry_run():
+        used_newnames = sum(1 for (fname, tname) in to_do if tname not in parked)
+    else:
+        used_newnames = 0 # renamed to their new names
+        for batch in journal.batches(to_do):
+            renamed = 0
+            with timer(folder, 'rename'):
+                for (fname, tname, error) in run_renames(snapshot.handle, batch, inflight):
+                    if error is None:
+                        if tname not in parked:
+                            used_newnames += 1
+                        renamed += 1
+                    else:
+                        if isinstance(error, FileExistsError): # appeared since the dir was listed
+                            log.warning('"to" file already exists: ' + tname)
+                            count(folder, 'conflicts')
+                        elif isinstance(error, FileNotFoundError): # gone since the dir was listed
+                            log.info('"from" file missing: %s', fname)
+                            count(folder, 'failed')
+                        else:
+                            log.warning('could not rename ' + fname + ' to ' + tname + ': ' + str(error))
+                            count(folder, 'failed')
+                        journal.failed(fname, tname)
+            count(folder, 'renames', renamed)
+            journal.done(renamed)
+    log.info('dir '+folder+' renamed '+ str(used_newnames) + ' files')
     return used_newnames
                     
-def rename_in_dir(path, prefix_ctl,
-                 orderfile_name, history_file,
-                 id_prefix, id_regex, idstart, idstep, idlen,
-                 skip_if_no_orderfile,
-                 adapt_case=True) -> list[str]:
-    """execute renaming in a single folder"""
+class DirPlan(NamedTuple):
+    """what's to be renamed in one dir, before any IDs are given out"""
+    snapshot: DirSnapshot
+    orderfile_name: Optional[str] # as the op sys spells it; None if there isn't one
+    prefix: str
+    renames: RenamePlan # from group_names(), not yet numbered
+
+    @property
+    def group_count(self) -> int:
+        """how many IDs applying this plan uses up"""
+        return self.renames.group_count
+
+def plan_dir(path, prefix_ctl, orderfile_name, id_regex,
+             skip_if_no_orderfile, adapt_case=True,
+             snapshot:Optional[DirSnapshot]=None) -> Optional[DirPlan]:
+    """work out the renaming for a single folder (named by path; the process
+    CWD is not used or changed) or None if there's nothing to do there;
+    pass its snapshot if it's already been listed"""
     log.info('do_in_folder ' + path)
-    if not change_dir(path): # TODO change to pass path, not changing directory
-       return []
+    if snapshot is None:
+        snapshot = scan_dir(path) # the one listing of this dir
+        if snapshot is None:
+            return None
 
-    is_orderfile = os.path.isfile(orderfile_name)
-    if (not is_orderfile or not os.access(orderfile_name, os.R_OK)) and skip_if_no_orderfile:
+    found_orderfile = snapshot.index.find(orderfile_name, adapt_case)
+    if found_orderfile is not None:
+        orderfile_name = found_orderfile # as the op sys spells it
+    if (found_orderfile is None or not snapshot.handle.access(orderfile_name, os.R_OK)) \
+            and skip_if_no_orderfile:
         log.info('skipping '+path+ ' because no readable orderfile '+orderfile_name)
-        log.info('is_orderfile is'+ str(is_orderfile))
-        return []
+        log.info('is_orderfile is'+ str(found_orderfile is not None))
+        count(path, 'dirs_skipped')
+        return None
     
-    (dirlist, orderedlines_init) = fetch_lists('.', orderfile_name)
+    (dirlist, orderedlines_init) = fetch_lists(path, orderfile_name, adapt_case, snapshot)
     if not orderedlines_init: orderedlines_init = sorted(dirlist) # TODO other sort flags?
     
-    exclude_from_renaming = [orderfile_name, r'rename_history.*','.gitignore'] # TODO make a param?  
+    exclude_from_renaming = [orderfile_name, r'rename_history.*','.gitignore', # TODO make a param?
+                             re.escape(CATALOG_NAME), re.escape(STATE_NAME)]
     # WORKING HERE ON THE rename/undo/rename sequnce generating date-appended fssort__...  
         
-    orderedlines=fix_orderlines(orderedlines_init,
-                dirlist, exclude_from_renaming, adapt_case, id_regex)
+    with timer(path, 'match'):
+        orderedlines=fix_orderlines(orderedlines_init,
+                    dirlist, exclude_from_renaming, adapt_case, id_regex)
     # orderedlines holds list of files which exist in dir, with no duplicates,
     # are not in the exclude_from_renaming list, and meet the must_regex 
 
     if len(orderedlines) == 0:  # nothing to rename, no need to do a history file
-        return [] # no used IDs
+        count(path, 'dirs_skipped')
+        return None # no used IDs
 
     if prefix_ctl == '.':
-       prefix = os.path.split(os.getcwd())[1]+'_' # or os.path.basename?
+       prefix = os.path.basename(os.path.abspath(path))+'_'
     else:
        prefix = prefix_ctl
-    rename_list = make_rename_list(orderedlines, id_regex, prefix, id_prefix, idstart, idstep, idlen )
+    with timer(path, 'plan'):
+        renames = group_names(orderedlines, id_regex)
+    return DirPlan(snapshot, found_orderfile, prefix, renames)
+
+def allocate_ids(plans: Iterable[Optional[DirPlan]], idstart:int, idstep:int,
+                 id_per_dir:bool) -> Iterator[tuple[DirPlan, int]]:
+    """pair each plan with its starting ID. Unless id_per_dir, each dir gets the
+    next run of IDs after the previous dir's, reserved by its group count, so
+    the plans can then be applied in any order and give the same numbering"""
+    next_dir_id_start = idstart
+    for plan in plans:
+        if plan is None:
+            continue
+        yield (plan, next_dir_id_start)
+        if not id_per_dir:
+            next_dir_id_start += plan.group_count * idstep
+
+def apply_plan(plan: DirPlan, history_file,
+               id_prefix, idstart, idstep, idlen, inflight:int=1,
+               catalog:Optional[HistoryCatalog]=None) -> int:
+    """number the plan's groups from idstart and do the renaming (with up to
+    inflight renames outstanding at once), keeping history in a history_file
+    in the dir or, if given, in the catalog; the number of files renamed"""
+    with timer(plan.snapshot.folder, 'plan'):
+        rename_list = number_groups(plan.renames, plan.prefix, id_prefix, idstart, idstep, idlen)
+    return apply_renames(plan.snapshot, plan.orderfile_name, rename_list, history_file,
+                         inflight, catalog)
+
+def run_stamp(snapshot: DirSnapshot, names: list[str]) -> str:
+    """the date/time to mark a run's backups of names (with make_bu_name) with:
+    now, or if any of those are already in the dir, now_1, now_2, ..."""
+    now_str = datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
+    stamp = now_str
+    n = 0
+    while any(snapshot.exists(make_bu_name(name, stamp)) for name in names):
+        n += 1
+        stamp = now_str + '_' + str(n)
+    return stamp
 
-    now = datetime.datetime.now()
-    now_str = now.strftime("%Y_%m_%d_%H_%M_%S")
+def apply_renames(snapshot: DirSnapshot, orderfile_name: Optional[str],
+                  rename_list: Iterable[tuple[str, str]], history_file, inflight:int=1,
+                  catalog:Optional[HistoryCatalog]=None) -> int:
+    """back up the orderfile (if any) and do the renames in rename_list (of
+    (from, to) filenames) in the snapshot's dir, as
+    apply_plan() does once it's numbered the groups"""
+    path = snapshot.folder
+    folder = snapshot.handle
+    is_orderfile = orderfile_name is not None
+
+    # a run in the same second as the last one (say, from watch) gets its own names
+    now_str = run_stamp(snapshot, [history_file] + ([orderfile_name] if is_orderfile else []))
        
     #now, we have the order file out of the way, let's rename and keep track
     if not get_is_dry_run():
-        orderfile_bak = make_bu_name(orderfile_name, now_str)
-        hist_file_name = make_bu_name(history_file, now_str)
-        hist_file_obj =  open(hist_file_name, 'a')
-        hist_file_obj.write('from, to, %s\n' % now_str)
+        if catalog is None:
+            hist_file_name = make_bu_name(history_file, now_str)
+            try:
+                journal = RenameJournal(hist_file_name, now_str, folder)
+            except FileExistsError: # made since the dir was listed; never add to it
+                log.warning("History file: {0} already exists in {1}".format(hist_file_name, path))
+                return 0
+            snapshot.added(hist_file_name)
+        else:
+            journal = catalog.journal(path)
+
+        def give_up():
+            """forget the history: nothing (bar the orderfile backup, which is put back) was renamed"""
+            journal.discard()
+            if catalog is None:
+                snapshot.removed(hist_file_name)
         
         if is_orderfile:
+            orderfile_bak = make_bu_name(orderfile_name, now_str)
+            journal.intend([(orderfile_name, orderfile_bak)])
             try:
-                os.rename(orderfile_name, orderfile_bak) 
-                hist_file_obj.write(orderfile_name+','+orderfile_bak+'\n')
+                folder.rename(orderfile_name, orderfile_bak)
+                journal.done(1)
+                snapshot.renamed(orderfile_name, orderfile_bak)
             except FileNotFoundError:
                 log.warning("Orderfile: {0} magically does not exist during in rename_in_dir()".format(path))
-                return []
+                give_up()
+                return 0
             except PermissionError:
                 log.warning("You do not have permissions to rename (back up) {0}".format(path))
-                return []
+                give_up()
+                return 0
+            except FileExistsError:
+                log.warning("Orderfile backup: {0} already exists in {1}".format(orderfile_bak, path))
+                give_up()
+                return 0
                     
-        used_ids = do_rename(rename_list, hist_file_obj) # the real action!
+        used_ids = do_rename(rename_list, journal, snapshot, inflight) # the real action!
         
-        hist_file_obj.close()
-        if len(used_ids) ==0:
-            # didn't find anything to rename
-            os.remove(hist_file_name)
-            os.rename(orderfile_bak, orderfile_name)
+        journal.close()
+        if journal.renamed == (1 if is_orderfile else 0):
+            # didn't rename anything but the orderfile (no file was even parked)
+            give_up()
+            if is_orderfile:
+                folder.rename(orderfile_bak, orderfile_name)
+                snapshot.renamed(orderfile_bak, orderfile_name)
     else: # dry run, don't worry about "history" at all
-        used_ids = do_rename(rename_list, None)
+        used_ids = do_rename(rename_list, None, snapshot)
     return used_ids
+
+def rename_in_dir(path, prefix_ctl,
+                 orderfile_name, history_file,
+                 id_prefix, id_regex, idstart, idstep, idlen,
+                 skip_if_no_orderfile,
+                 adapt_case=True, snapshot:Optional[DirSnapshot]=None,
+                 inflight:int=1, catalog:Optional[HistoryCatalog]=None) -> int:
+    """execute renaming in a single folder (named by path; the process CWD is
+    not used or changed); pass its snapshot if it's already been listed.
+    The number of files renamed"""
+    plan = plan_dir(path, prefix_ctl, orderfile_name, id_regex,
+                    skip_if_no_orderfile, adapt_case, snapshot)
+    if plan is None:
+        return 0
+    try:
+        return apply_plan(plan, history_file, id_prefix, idstart, idstep, idlen, inflight, catalog)
+    finally:
+        if snapshot is None: # we listed (and opened) the dir, so we close it
+            plan.snapshot.close()
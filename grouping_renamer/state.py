@@ -0,0 +1,126 @@
+import os
+import json
+import logging
+import threading
+from typing import NamedTuple, Optional
+
+from support import DirSnapshot
+from stats import count
+
+log = logging.getLogger('state')
+
+STATE_NAME = '.gfr_state.json'
+STATE_VERSION = 1
+
+class CachedDir(NamedTuple):
+    """stands in for a dir that hasn't changed since the last run, so isn't
+    listed: enough to walk below it and to reserve its IDs"""
+    folder: str
+    dirs: list[str]
+    links: set[str]
+    group_count: int # IDs it used last time
+    start: int # the ID it started from
+
+def _stat_or_none(path: str) -> Optional[os.stat_result]:
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+def fingerprint(folder: str, orderfile: Optional[str],
+                dir_stat:Optional[os.stat_result]=None) -> Optional[dict]:
+    """folder's inode and mtime (which change when any entry in it is created,
+    deleted or renamed), and the mtime and size of its orderfile, if it has
+    one (as editing that doesn't touch the dir); None if folder's gone.
+    Pass dir_stat if folder's already been stat'ed (say, as it was listed)"""
+    st = dir_stat or _stat_or_none(folder)
+    if st is None:
+        return None
+    fp = {'dir': [st.st_ino, st.st_mtime_ns], 'orderfile': None, 'orderfile_stat': None}
+    if orderfile is not None:
+        of_st = _stat_or_none(os.path.join(folder, orderfile))
+        if of_st is None:
+            return None
+        fp['orderfile'] = orderfile
+        fp['orderfile_stat'] = [of_st.st_mtime_ns, of_st.st_size]
+    return fp
+
+def unchanged(folder: str, fp: dict) -> bool:
+    """is folder still as its fingerprint fp says?"""
+    now = fingerprint(folder, fp['orderfile'])
+    return now is not None and all(now[k] == fp[k] for k in ('dir', 'orderfile_stat'))
+
+class TreeState:
+    """what each dir under root looked like when the last (real) run left it,
+    kept in STATE_NAME at the root as its fingerprint(). A dir whose
+    fingerprint still matches would be left as it is by another run with the
+    same params, so it needn't even be listed. The state is only used if
+    params (the run's settings) are the same."""
+    def __init__(self, root: str, params: dict, use_cached:bool=True):
+        self.root = os.path.abspath(root)
+        self.path = os.path.join(self.root, STATE_NAME)
+        self.params = params
+        self.use_cached = use_cached
+        self.old: dict[str, dict] = {}
+        self.new: dict[str, dict] = {} # becomes the saved state
+        self.lock = threading.Lock()
+        self.kept = 0
+        if use_cached:
+            self.old = self._load()
+
+    def _load(self) -> dict[str, dict]:
+        try:
+            with open(self.path) as sf:
+                saved = json.load(sf)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            log.warning('ignoring unreadable ' + self.path + ': ' + str(e))
+            return {}
+        if saved.get('version') != STATE_VERSION or saved.get('params') != self.params:
+            log.info('settings differ from the last run, so every dir is listed')
+            return {}
+        return saved.get('dirs', {})
+
+    def _rel(self, folder: str) -> str:
+        return os.path.relpath(folder, self.root).replace(os.sep, '/')
+
+    def cached(self, folder: str) -> Optional[CachedDir]:
+        """a CachedDir for folder if it's as the last run left it, else None
+        (for walk_dirs)"""
+        entry = self.old.get(self._rel(folder))
+        if entry is None:
+            return None
+        count(folder, 'stats', 1 if entry['orderfile'] is None else 2)
+        if not unchanged(folder, entry):
+            return None
+        count(folder, 'dirs_unchanged')
+        with self.lock:
+            self.new[self._rel(folder)] = entry
+            self.kept += 1
+        return CachedDir(folder, entry['subdirs'], set(entry['links']),
+                         entry['group_count'], entry['start'])
+
+    def record(self, snapshot: DirSnapshot, orderfile_name: str, group_count:int, start:int):
+        """fingerprint the snapshot's dir as this run leaves it"""
+        entry = fingerprint(snapshot.folder, snapshot.index.find(orderfile_name, adapt_case=True))
+        if entry is None:
+            return
+        entry.update({'group_count': group_count, 'start': start,
+                      'subdirs': snapshot.dirs, 'links': sorted(snapshot.links)})
+        with self.lock:
+            self.new[self._rel(snapshot.folder)] = entry
+
+    def save(self):
+        """write the state; dirs not seen in this run are dropped from it"""
+        if not os.path.exists(self.path):
+            open(self.path, 'w').close()
+        # creating the file changed the root dir's mtime (and other files at the
+        # root may have come and gone since it was recorded), so refresh that;
+        # overwriting the file in place below doesn't change it again
+        root_entry = self.new.get('.')
+        st = _stat_or_none(self.root)
+        if root_entry is not None and st is not None:
+            root_entry['dir'] = [st.st_ino, st.st_mtime_ns]
+        with open(self.path, 'w') as sf:
+            json.dump({'version': STATE_VERSION, 'params': self.params, 'dirs': self.new}, sf)
@@ -0,0 +1,84 @@
+import json
+import time
+import threading
+from contextlib import nullcontext
+
+# per-dir timers and counters, for --stats / --stats-json. Off unless
+# set_stats(True): then timer() hands back a shared do-nothing context and
+# count() returns at once, so the calls can stay in place for free
+
+_on = False
+_lock = threading.Lock()
+_dirs: dict[str, dict[str, float]] = {} # dir -> counter (or phase + '_secs') -> value
+_started = 0.0
+_NO_TIMER = nullcontext()
+
+def set_stats(on: bool):
+    """start (or stop) collecting; starting forgets anything collected before"""
+    global _on, _started
+    _on = on
+    _dirs.clear()
+    _started = time.perf_counter()
+
+def count(folder: str, name: str, n:float=1):
+    """add n to the folder's counter name"""
+    if _on:
+        with _lock:
+            counters = _dirs.setdefault(folder, {})
+            counters[name] = counters.get(name, 0) + n
+
+class _Timer:
+    __slots__ = ('folder', 'phase', 'start')
+    def __init__(self, folder: str, phase: str):
+        self.folder = folder
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.perf_counter() # monotonic
+        return self
+
+    def __exit__(self, *exc_info):
+        count(self.folder, self.phase + '_secs', time.perf_counter() - self.start)
+
+def timer(folder: str, phase: str):
+    """with timer(folder, phase): adds the time taken to the folder's phase"""
+    return _Timer(folder, phase) if _on else _NO_TIMER
+
+def per_dir() -> dict[str, dict[str, float]]:
+    with _lock:
+        return {folder: dict(counters) for (folder, counters) in _dirs.items()}
+
+def totals() -> dict[str, float]:
+    """each counter summed over the dirs, and the run's wall time"""
+    summed: dict[str, float] = {}
+    for counters in per_dir().values():
+        for (name, value) in counters.items():
+            summed[name] = summed.get(name, 0) + value
+    summed['dirs'] = len(_dirs)
+    summed['wall_secs'] = time.perf_counter() - _started
+    return summed
+
+def _fmt(name: str, value: float) -> str:
+    return '%.3f' % value if name.endswith('_secs') else str(int(value))
+
+def table(slowest:int=10) -> str:
+    """the run's totals, then the slowest dirs, as text"""
+    summed = totals()
+    width = max(len(name) for name in summed)
+    lines = ['%-*s %12s' % (width, name, _fmt(name, value)) for (name, value) in sorted(summed.items())]
+    dirs = per_dir()
+    secs = {folder: sum(v for (k, v) in counters.items() if k.endswith('_secs'))
+            for (folder, counters) in dirs.items()
+            if any(k.endswith('_secs') for k in counters)} # only dirs that were timed
+    if secs and slowest:
+        lines += ['', 'slowest dirs (secs):']
+        for folder in sorted(secs, key=lambda f: -secs[f])[:slowest]:
+            counters = dirs[folder]
+            lines.append('  ' + folder + '  ' + ', '.join(k[:-5] + ' ' + _fmt(k, counters[k])
+                                                         for k in sorted(counters) if k.endswith('_secs')))
+    return '\n'.join(lines)
+
+def write_json(path: str):
+    """the run's totals and every dir's counters, as JSON"""
+    with open(path, 'w') as sf:
+        json.dump({'run': totals(), 'dirs': per_dir()}, sf, indent=1)
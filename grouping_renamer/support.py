@@ -1,9 +1,19 @@
 import os
 import re
+import time
 import logging
-from typing import List
-from collections import OrderedDict
-import typer # temp, should go away with migrate to logging
+import functools
+import itertools
+import threading
+import unicodedata
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, List, NamedTuple, Optional
+from collections import deque
+
+from fsops import DirHandle
+from stats import count, timer
+from audit import record
+from orderfile import read_names
 
 __author    = "Wayne Stidolph"
 __email     = "wayne@stidolph.com"
@@ -13,10 +23,20 @@ __status    = "Development"
 
 log = logging.getLogger('support')
 
-verbose_level:int=3
+verbose_level:int=1
 def set_verbosity(level: int):
+    """0: mute, 1: problems (warnings), 2: per-dir (info), 3: per-file (debug);
+    10 and up are taken as a logging level"""
+    global verbose_level
     verbose_level = level
-    logging.basicConfig(level=level)
+    if level <= 0:
+        log_level = logging.CRITICAL + 1
+    elif level < 10:
+        log_level = {1: logging.WARNING, 2: logging.INFO}.get(level, logging.DEBUG)
+    else:
+        log_level = level
+    logging.basicConfig(level=log_level)
+    logging.getLogger().setLevel(log_level) # in case logging was already set up
     
 is_dry_run=True
 def set_is_dry_run(dryrun):
@@ -29,19 +49,48 @@ def get_is_dry_run():
     return is_dry_run
     
 # move to 'id_handling' module?
+class IdMatcher:
+    """an id_regex compiled once; finds the *last* ID embedded in filenames"""
+    def __init__(self, id_regex: str):
+        self.id_regex = id_regex
+        self.rx = re.compile(id_regex)
+        # the greedy lead-in makes the engine try id_regex at each position
+        # from the end of the name backwards, and stop at the first hit
+        self._tail_rx = re.compile('(?s:.*)(' + id_regex + ')')
+
+    def search(self, name: str) -> bool:
+        """does the name contain an ID at all"""
+        return self.rx.search(name) is not None
+
+    def fullid_end(self, name: str) -> int:
+        """index just past the last ID in name (-1 if there's no ID)"""
+        m = self._tail_rx.match(name)
+        return m.end(1) if m else -1
+
+    def last_id(self, name: str) -> Optional[str]:
+        """the text of the last non-overlapping match, as re.findall would give"""
+        last = None
+        for last in self.rx.finditer(name):
+            pass
+        return last.group() if last else None
+
+@functools.lru_cache(maxsize=32)
+def get_id_matcher(id_regex: str) -> IdMatcher:
+    """shared, compiled matcher for an id_regex"""
+    return IdMatcher(id_regex)
+
+_ANY = re.compile('.*', re.DOTALL)
+
 def get_id_match(filename, id_regex):
     """extract the embedded ID, which is the *last* match to the id_regex"""
-    id_matchs=re.findall(id_regex,filename)
-    if len(id_matchs) > 0:
-        return id_matchs[-1]
-    else:
-        return None
+    return get_id_matcher(id_regex).last_id(filename)
 
 def get_fullid(filename, idrgx):
     """extract the entire prefix and ID as a single string"""
-    rex = '.*'+idrgx
-    p = re.compile(rex)
-    return  p.match(filename)
+    end = get_id_matcher(idrgx).fullid_end(filename)
+    if end < 0:
+        return None
+    return _ANY.match(filename, 0, end) # match object, like re.match gives
 
 def get_next_id(current_id, id_step, id_len) -> str:
     """get the string ID that follows the current ID"""
@@ -65,18 +114,52 @@ def change_dir(path) -> bool:
         log.error("You do not have permissions to change to {0}".format(path))
         return False
 
+class DirectoryIndex:
+    """the names in one directory, hashed for O(1) lookups that are exact,
+    Unicode-normalization-blind (NFC vs NFD) or also case-blind;
+    lookups return the name as the op sys spells it"""
+    def __init__(self, names: Iterable[str]):
+        self.names = list(names)
+        self._exact = set(self.names)
+        self._normal: dict[str, str] = {} # NFC form -> on-disk name
+        self._folded: dict[str, str] = {} # casefolded NFC form -> on-disk name
+        for name in self.names:
+            nfc = unicodedata.normalize('NFC', name)
+            self._normal.setdefault(nfc, name) # first one wins, as list.index() did
+            self._folded.setdefault(nfc.casefold(), name)
+
+    def __contains__(self, name) -> bool:
+        return name in self._exact
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def find(self, name: str, adapt_case: bool=False) -> Optional[str]:
+        """on-disk spelling of name, or None if it's not in the directory"""
+        if name in self._exact:
+            return name
+        nfc = unicodedata.normalize('NFC', name)
+        found = self._normal.get(nfc)
+        if found is None and adapt_case:
+            found = self._folded.get(nfc.casefold())
+        return found
+
+    def find_all(self, names: Iterable[str], adapt_case: bool=False) -> list[str]:
+        """on-disk spellings of those names which are in the directory"""
+        find = self.find
+        return [f for f in (find(n, adapt_case) for n in names) if f is not None]
+
+def as_directory_index(dlist) -> DirectoryIndex:
+    """use dlist if it's already indexed, else index it"""
+    return dlist if isinstance(dlist, DirectoryIndex) else DirectoryIndex(dlist)
+
 def find_case_insensitive(orig_list: list[str], dlist: list[str])-> list[str]:
     """compare case insensitive but return entry from dirlist"""
-    return_lines = [] 
-    lower_ol = [x.lower() for x in orig_list]
-    lower_dl = [x.lower() for x in dlist]
-    # match based on lower cased but return from dirlist at that index
-    for ol in lower_ol:
-        try: 
-            return_lines.append(dlist[lower_dl.index(ol)])
-        except: # might not be in dirlist at all, in which case forget this entry
-            pass 
-    return return_lines    
+    # might not be in dirlist at all, in which case forget this entry
+    return as_directory_index(dlist).find_all(orig_list, adapt_case=True)
 
 def fetch_ignore(ignore_file_name = 'gfr.ignore') -> list[str]:
     
@@ -85,56 +168,326 @@ def fetch_ignore(ignore_file_name = 'gfr.ignore') -> list[str]:
     excluded_dir = loadfile_lines(folder, ignore_file_name)
     return excluded_dir
            
-def get_dirs_to_process(startdir: str, exclude: list[str], do_subtree:bool) -> list[str]:
-    dirs_to_process = [os.path.abspath(startdir)] # always do startdir
-    if do_subtree: # then just add to subdir list 
-        for node, dirs, files in os.walk(startdir, topdown=True):
-            dirs_to_process = dirs_to_process + [
-                os.path.abspath(os.path.join(node, d))
-                for d in dirs if d not in exclude]
-            dirs[:]=[d for d in dirs if d not in exclude] # assign to dirs to prune
-    log.info('processing dirs: ' + str(dirs_to_process))
-    return dirs_to_process
       
-def fetch_lists(folder, orderfile_name, adapt_case=False) -> list[List[str], List[str]]:
+class FileStat(NamedTuple):
+    inode: int
+    size: int
+    mtime_ns: int
+
+class DirSnapshot:
+    """what one os.scandir pass says is in a folder: file names (and, if
+    with_stat, their inode/size/mtime) and subdir names. Lets the rename and
+    undo code check for files in memory rather than stat'ing each one; keep
+    it current by telling it about renames/new files as they happen.
+    The folder is held open (as .handle) for working on its files until
+    close() is called; .stat is the folder's os.stat_result as it was listed."""
+    def __init__(self, folder='.', with_stat:bool=False):
+        self.folder = folder
+        self.handle = DirHandle(folder)
+        self.files: dict[str, Optional[FileStat]] = {}
+        self.dirs: list[str] = []
+        self.links: set[str] = set() # those dirs which are symlinks
+        self._index: Optional[DirectoryIndex] = None
+        # the folder's own stat from just before the listing, so a change made
+        # while (or after) it's listed shows as a newer mtime than this one
+        self.stat = os.fstat(self.handle.fd) if self.handle.fd is not None else os.stat(folder)
+        with timer(folder, 'list'), self.handle.scandir() as entries:
+            for entry in entries:
+                # DirEntry caches the type from the listing, so no stat here
+                # (except for symlinks, which are followed as isfile() did)
+                if entry.is_file():
+                    self.files[entry.name] = self._file_stat(entry) if with_stat else None
+                elif entry.is_dir():
+                    self.dirs.append(entry.name)
+                    if entry.is_symlink():
+                        self.links.add(entry.name)
+        count(folder, 'entries', len(self.files) + len(self.dirs))
+        if with_stat:
+            count(folder, 'stats', len(self.files))
+
+    @staticmethod
+    def _file_stat(entry: os.DirEntry) -> FileStat:
+        st = entry.stat()
+        return FileStat(entry.inode(), st.st_size, st.st_mtime_ns)
+
+    @property
+    def index(self) -> DirectoryIndex:
+        """the file names, indexed for lookup"""
+        if self._index is None:
+            self._index = DirectoryIndex(self.files)
+        return self._index
+
+    def close(self):
+        """let go of the open folder"""
+        self.handle.close()
+
+    def is_file(self, name: str) -> bool:
+        return name in self.files
+
+    def exists(self, name: str) -> bool:
+        return name in self.files or name in self.dirs
+
+    def added(self, name: str):
+        """record that file name was created"""
+        self.files[name] = None
+        self._index = None
+
+    def renamed(self, fname: str, tname: str):
+        """record that file fname is now called tname"""
+        self.files[tname] = self.files.pop(fname, None)
+        self._index = None
+
+    def removed(self, name: str):
+        """record that file name was deleted"""
+        self.files.pop(name, None)
+        self._index = None
+
+def scan_dir(folder: str) -> Optional[DirSnapshot]:
+    """DirSnapshot of folder, or None (and log why) if it can't be listed"""
+    try:
+        return DirSnapshot(folder)
+    except FileNotFoundError:
+        log.error("Directory: {0} does not exist".format(folder))
+    except NotADirectoryError:
+        log.error("{0} is not a directory".format(folder))
+    except PermissionError:
+        log.error("You do not have permissions to list {0}".format(folder))
+    return None
+
+def walk_dirs(startdir: str, exclude: list[str], do_subtree:bool,
+              cached:Optional[Callable[[str], Any]]=None) -> Iterator[DirSnapshot]:
+    """lazily yield a DirSnapshot of startdir and, if do_subtree, of every dir
+    below it (pruning names in exclude), each listed just once as it's reached.
+    Dirs come in the order the old up-front list had them: startdir, its
+    subdirs, then the subdirs of each of those in turn. Symlinked dirs are
+    yielded but, as with os.walk, not descended into. Close() each snapshot
+    when done with it.
+    cached(folder), if given, can return a stand-in for a dir which needn't
+    be listed this time (with .folder, .dirs and .links, as a snapshot has);
+    that's yielded instead, and its dirs are walked as if they'd been listed"""
+    top = _scan_or_cached(os.path.abspath(startdir), cached) # always do startdir
+    if top is None:
+        return
+    yield top
+    if do_subtree:
+        yield from _walk_below(top, exclude, cached)
+
+def _scan_or_cached(folder: str, cached:Optional[Callable[[str], Any]]):
+    if cached is not None:
+        stand_in = cached(folder)
+        if stand_in is not None:
+            return stand_in
+    return scan_dir(folder)
+
+def _walk_below(parent: 'DirSnapshot | _DirsOnly', exclude: list[str],
+                cached:Optional[Callable[[str], Any]]=None) -> Iterator[DirSnapshot]:
+    to_descend = [] # just what's needed to go further down, not the file lists
+    for d in parent.dirs:
+        if d in exclude:
+            continue
+        snapshot = _scan_or_cached(os.path.join(parent.folder, d), cached)
+        if snapshot is None:
+            continue
+        yield snapshot
+        if d not in parent.links:
+            to_descend.append(_DirsOnly(snapshot.folder, snapshot.dirs, snapshot.links))
+    for below in to_descend:
+        yield from _walk_below(below, exclude, cached)
+
+class _DirsOnly(NamedTuple):
+    folder: str
+    dirs: list[str]
+    links: set[str]
+
+_worker_logs = threading.local() # .records is set on map_dirs worker threads
+
+class _HoldWorkerRecords(logging.Filter):
+    """put on the root handlers while map_dirs runs; a record logged on a
+    worker thread is kept in that thread's list rather than emitted"""
+    def filter(self, record) -> bool:
+        held = getattr(_worker_logs, 'records', None)
+        if held is None:
+            return True
+        if not held or held[-1] is not record: # once, however many handlers
+            held.append(record)
+        return False
+
+def _call_holding_logs(func: Callable, item):
+    _worker_logs.records = []
+    try:
+        return (_worker_logs.records, func(item), None)
+    except Exception as e:
+        return (_worker_logs.records, None, e)
+    finally:
+        _worker_logs.records = None
+
+def _replay(held: list[logging.LogRecord]):
+    for record in held:
+        for handler in logging.getLogger().handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+_END = object()
+
+def map_dirs(func: Callable, items: Iterable, jobs:int=1) -> Iterator:
+    """yield func(item) for each item (typically a dir's snapshot), in item
+    order. With jobs > 1 the calls run on that many threads, taking at most
+    2*jobs items ahead of the one being yielded; the log records of each call
+    are held and emitted in item order, so output is the same as with one job.
+    That holds when items is itself (fed by) a map_dirs, too: what's logged
+    while an item is taken from items goes out just before its call's records,
+    as it would with one job"""
+    if jobs <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    handlers = logging.getLogger().handlers[:]
+    hold = _HoldWorkerRecords()
+    for handler in handlers:
+        handler.addFilter(hold)
+    items = iter(items)
+    def take():
+        """the next item (or _END) and the records logged getting it"""
+        outer = getattr(_worker_logs, 'records', None)
+        _worker_logs.records = held = []
+        try:
+            return (next(items, _END), held)
+        except BaseException:
+            _worker_logs.records = outer
+            _replay(held)
+            raise
+        finally:
+            _worker_logs.records = outer
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            pending = deque()
+            def next_done():
+                (before, done) = pending.popleft()
+                (held, result, error) = done.result()
+                _replay(before + held)
+                if error is not None:
+                    raise error
+                return result
+            while True:
+                (item, before) = take()
+                if item is _END: # what was logged getting here goes out last
+                    while pending:
+                        yield next_done()
+                    _replay(before)
+                    break
+                pending.append((before, pool.submit(_call_holding_logs, func, item)))
+                if len(pending) >= 2*jobs:
+                    yield next_done()
+    finally:
+        for handler in handlers:
+            handler.removeFilter(hold)
+
+def _rename_after(folder: DirHandle, fname: str, tname: str, after: list[Future],
+                  action:str='rename') -> Optional[Exception]:
+    """rename once the renames in 'after' are done; return what went wrong, if anything"""
+    error: Optional[Exception] = None
+    for earlier in after:
+        if earlier.result() is not None:
+            error = RuntimeError('an earlier rename it depends on failed')
+    started = time.perf_counter()
+    if error is None:
+        try:
+            folder.rename(fname, tname)
+        except OSError as e:
+            error = e
+    record(action, folder.path, fname, tname, error, time.perf_counter() - started)
+    return error
+
+def run_renames(folder: DirHandle, renames: Iterable[tuple[str, str]],
+                inflight:int=1, action:str='rename') -> Iterator[tuple[str, str, Optional[Exception]]]:
+    """do the (from, to) renames in the (open) folder, yielding (from, to, error) for each,
+    in the order given; error is None if it was renamed, FileExistsError if
+    something else already has the 'to' name. With inflight > 1 that
+    many renames can be outstanding at once (which pays on high-latency network
+    filesystems), but a rename still waits for any earlier one that frees up its
+    'to' name or creates its 'from' name. Each rename is audited as action"""
+    if inflight <= 1:
+        for (fname, tname) in renames:
+            yield (fname, tname, _rename_after(folder, fname, tname, [], action))
+        return
+
+    last_use: dict[str, Future] = {} # name -> latest rename from or to it
+    with ThreadPoolExecutor(max_workers=inflight) as pool:
+        pending = deque()
+        for (fname, tname) in renames:
+            after = [last_use[n] for n in (fname, tname) if n in last_use]
+            done = pool.submit(_rename_after, folder, fname, tname, after, action)
+            last_use[fname] = last_use[tname] = done
+            pending.append((fname, tname, done))
+            if len(pending) >= 2*inflight:
+                (f, t, d) = pending.popleft()
+                yield (f, t, d.result())
+        while pending:
+            (f, t, d) = pending.popleft()
+            yield (f, t, d.result())
+
+def fetch_lists(folder, orderfile_name, adapt_case=False,
+                snapshot:Optional[DirSnapshot]=None) -> list[DirectoryIndex, Iterable[str]]:
     """Get the contents of the name-ordering file and the directory's actual files list;
     if adapt_case then load the orderfile even if it's under a
-    differently-cased name."""
+    differently-cased name. Pass a snapshot if the folder has already been listed,
+    and use up the names while it's open: they're read from the orderfile as they're
+    wanted, blanks and repeats included (rename.fix_orderlines drops those), and are
+    [] if there's no orderfile or it lists nothing."""
     
-    dirlist = [f for f in os.listdir(folder) if os.path.isfile(os.path.join(folder,f))]
+    if snapshot is None:
+        snapshot = DirSnapshot(folder)
+    dirlist = snapshot.index
     
-    orderedlines_init = []  # Create an empty list to store the candidate filenames  
+    orderedlines_init = []  # the candidate filenames, if any
     # if we have an orderfile, let's read in the lines as the initial value
-    have_ofile = os.path.exists(os.path.join(folder, orderfile_name))
+    have_ofile = snapshot.is_file(orderfile_name)
     if not have_ofile and adapt_case: # since adapt_case we'll try alternate case
         # try alternate-case versions for the orderfile
-        alt_case_matches = find_case_insensitive([orderfile_name], dirlist)
-        if alt_case_matches:
-            orderfile_name = alt_case_matches[0] # get op sys case'd filename
+        alt_case_match = dirlist.find(orderfile_name, adapt_case)
+        if alt_case_match:
+            orderfile_name = alt_case_match # get op sys case'd filename
             have_ofile = True
         
     if have_ofile:
-        orderedlines_init = loadfile_lines(folder, orderfile_name)
+        names = _counted(folder, read_names(folder, orderfile_name, snapshot.handle, once=False))
+        first = next(names, None) # so an empty orderfile gives []
+        if first is not None:
+            orderedlines_init = itertools.chain([first], names)
 
     else: # never found the order file, so we'll use the
           # sorted-by-name dirlist as the initial ordering value
         log.info('no orderfile ' + orderfile_name + ' in '+ folder)
           
     return [dirlist, orderedlines_init]
+
+def _counted(folder: str, names: Iterator[str]) -> Iterator[str]:
+    """names, counting them (as orderfile_names) once they've all been read"""
+    n = 0
+    for n, name in enumerate(names, 1):
+        yield name
+    count(folder, 'orderfile_names', n)
   
-def loadfile_lines(folder, fname)->list[str]:
+def loadfile_lines(folder, fname, handle:Optional[DirHandle]=None)->list[str]:
+    """the stripped lines of folder/fname; pass the folder's handle if it's open"""
     return_lines=[]
-    path_to_file=os.path.join(folder, fname)
-    if os.path.isfile(path_to_file):
-        with open(path_to_file, 'r') as file:
-            # Iterate over the lines of the file
-            for line in file:
-                # Remove the newline character at the end of the line
-                line = line.strip()
-                return_lines.append(line)
-    else:
+    try:
+        if handle is not None:
+            file = handle.open(fname)
+        else:
+            file = open(os.path.join(folder, fname), 'r')
+    except (FileNotFoundError, IsADirectoryError):
         log.error('loadfile_lines cannot find '+folder+ ' '+fname)
+        return return_lines
+    with file:
+        # Iterate over the lines of the file
+        for line in file:
+            # Remove the newline character at the end of the line
+            line = line.strip()
+            return_lines.append(line)
     return return_lines
+
 def remove_any_matching(tgt: list[str], exclude_patterns: list[str]) -> list[str]:
     """from a list of strings remove all which match any of a list of regexs;
         return new list of non-matched strings"""
@@ -143,39 +496,31 @@ def remove_any_matching(tgt: list[str], exclude_patterns: list[str]) -> list[str
     if not exclude_patterns:
         return tgt.copy()
 
-    regs = [re.compile(ex) for ex in exclude_patterns]
+    match_any = any_matcher(exclude_patterns)
+    unmatched = [tstr for tstr in tgt if not match_any(tstr)] 
+    
+    return unmatched
+
+def any_matcher(patterns: list[str]) -> Callable[[str], bool]:
+    """a test of whether a string matches any of a list of regexs"""
+    regs = [re.compile(ex) for ex in patterns]
     
     def match_any(s: str) -> bool:
         for rx in regs:
             if rx.search(s): return True
         return False
-    unmatched = [tstr for tstr in tgt if not match_any(tstr)] 
-    
-    return unmatched
+    return match_any
     
 def scrub_dups(strlist: list[str])-> list[str]:
-    ol_de_duped = list(OrderedDict.fromkeys(strlist))
-    if '' in ol_de_duped: ol_de_duped.remove('')
+    ol_de_duped = dict.fromkeys(strlist) # (keeps the order)
+    ol_de_duped.pop('', None)
       
-    return ol_de_duped   
+    return list(ol_de_duped)
 
 def scrub_not_matching(strlist: list[str], must_regex: str) -> list[str]:
     if not must_regex or must_regex == '': # just shortcut
         processed_sl = strlist.copy()
     else: # needs checking
-        p = re.compile(must_regex)
-        processed_sl= [s for s in strlist if p.search(s) ]
+        has_id = get_id_matcher(must_regex).search
+        processed_sl= [s for s in strlist if has_id(s) ]
     return processed_sl
-
-def find_case_insensitive(orig_list: list[str], dlist: list[str])-> list[str]:
-    """compare case insensitive but return entry from dirlist"""
-    return_lines = [] 
-    lower_ol = [x.lower() for x in orig_list]
-    lower_dl = [x.lower() for x in dlist]
-    # match based on lower cased but return from dirlist at that index
-    for ol in lower_ol:
-        try: 
-            return_lines.append(dlist[lower_dl.index(ol)])
-        except: # might not be in dirlist at all, in which case forget this entry
-            pass 
-    return return_lines
\ No newline at end of file
@@ -1,64 +1,275 @@
 import os
 import logging
+from typing import Iterable, Iterator, Optional
 
-from support import change_dir,loadfile_lines, get_is_dry_run
+from history import lines_backwards, last_run_backwards, renames_done, HistoryCatalog
+from fsops import rename_noreplace
+from support import scan_dir, run_renames, get_is_dry_run, DirectoryIndex, DirSnapshot
+from stats import timer
 
 log=logging.getLogger('undo')
 
-def get_history_filename(history_filename_root:str, dirlist: list[str]):
-    """find one (oldest) renaming file (there may be 0..)"""
+def get_history_filenames(history_filename_root:str, dirlist: DirectoryIndex) -> list[str]:
+    """the renaming files (there may be 0..), oldest first"""
     (hfr_noext, hfr_ext) = os.path.splitext(history_filename_root)
     dirlist_noext = [os.path.splitext(f)[0] for f in dirlist]
     histfiles = [h for h in dirlist_noext if h.startswith(hfr_noext)]
+    return [hf + hfr_ext for hf in sorted(histfiles)]
+
+def get_history_filename(history_filename_root:str, dirlist: DirectoryIndex, folder:str='.'):
+    """find one (latest) renaming file (there may be 0..)"""
+    histfiles = get_history_filenames(history_filename_root, dirlist)
     if histfiles:
-        hf = sorted(histfiles)
-        return hf[-1] + hfr_ext # should be oldest
+        return histfiles[-1]
     else:
-        log.warning('no history '+ history_filename_root + ' to reverse in '+ os.getcwd())
+        log.warning('no history '+ history_filename_root + ' to reverse in '+ folder)
         return None
+
+def history_timestamp(hfilename: str) -> str:
+    """the date/time a history file was written, as in its name"""
+    return os.path.splitext(hfilename)[0].split('__')[-1]
   
-def undo_rename(curr_name:str, prev_name:str, appender_str:str='new'):
+def undo_rename(curr_name:str, prev_name:str, appender_str:str='new',
+                snapshot:Optional[DirSnapshot]=None):
     # if conflict, rename to <to_name>__<appender_str>
-    # does rename in CWD
-    if not os.path.exists(curr_name):
+    # names are in the snapshot's folder (and checked against it, not the disk)
+    # or, with no snapshot, are paths
+    exists = snapshot.exists if snapshot else os.path.exists
+    rename = snapshot.handle.rename if snapshot else rename_noreplace
+    if not exists(curr_name):
          log.warning("file to revert: {0} (from history) does not exist".format(curr_name))
          return
      
     tgt_name = prev_name
-    if os.path.exists(prev_name):
+    if exists(prev_name):
         tgt_name += '__' + appender_str
         
-    log.debug('reverting name '+ curr_name+ '  to '+ tgt_name)
+    log.debug('reverting name %s  to %s', curr_name, tgt_name)
   
     if not get_is_dry_run():
         try:
-            os.rename(curr_name, tgt_name)
+            rename(curr_name, tgt_name)
         except:
             log.warning('could not revert ' + curr_name + ' to ' + prev_name)
+            return
+    if snapshot:
+        snapshot.renamed(curr_name, tgt_name)
       
+def new_summary(path:str) -> dict:
+    """what undo_in_dir reports for a dir; 'history_file' is the (oldest)
+    history file undone, of 'generations' of them, and 'history' is what was
+    done with them: 'removed', 'kept' (as u_<name>), or None if untouched"""
+    return {'dir': path, 'history_file': None, 'generations': 0, 'renamed': 0,
+            'skipped': 0, 'conflicts': 0, 'failed': 0, 'history': None}
+
+def plan_undo(renames_newest_first: Iterable[tuple[str, str, bool]], appender_str:str,
+              snapshot:DirSnapshot, adapt_case:bool=False,
+              summary:Optional[dict]=None) -> Iterator[tuple[str, str]]:
+    """the (current, reverted) renames which undo the (from, to, done) renames
+    given, worked out against the snapshot rather than the disk (and updating
+    it as if each were done): a file that's gone is skipped, and one whose old
+    name is taken goes to <old name>__<appender_str>. Those are counted in
+    summary. A rename that isn't done (its batch was cut short) is only undone
+    if it happened: its 'to' is there and its 'from' isn't, once the later
+    ones have been put back (a rename waits for the ones before it that use
+    its names, so one that didn't happen left both as they were)"""
+    if summary is None:
+        summary = new_summary(snapshot.folder)
+    dirlist = snapshot.index # as listed; history may spell names differently
+    for (prev_name, curr_name, done) in renames_newest_first:
+        curr_name = dirlist.find(curr_name, adapt_case) or curr_name
+        if not snapshot.exists(curr_name):
+            log.warning("file to revert: {0} (from history) does not exist".format(curr_name))
+            summary['skipped'] += 1
+            continue
+        if not done and snapshot.exists(prev_name):
+            log.info('not reverting %s to %s: its batch was cut short before it was renamed',
+                     curr_name, prev_name)
+            summary['skipped'] += 1
+            continue
+        tgt_name = prev_name
+        if snapshot.exists(prev_name):
+            tgt_name += '__' + appender_str
+            summary['conflicts'] += 1
+        log.debug('reverting name %s  to %s', curr_name, tgt_name)
+        snapshot.renamed(curr_name, tgt_name)
+        yield (curr_name, tgt_name)
+
+def do_reverts(steps: Iterable[tuple[str, str]], snapshot:DirSnapshot,
+               summary: dict, inflight:int=1):
+    """do plan_undo's renames in the snapshot's dir (unless it's a dry run),
+    counting them in summary"""
+    if get_is_dry_run():
+        summary['renamed'] = sum(1 for _ in steps)
+        return
+    with timer(snapshot.folder, 'undo'):
+        for (curr_name, tgt_name, error) in run_renames(snapshot.handle, steps, inflight, 'undo'):
+            if error is None:
+                summary['renamed'] += 1
+            else:
+                log.warning('could not revert ' + curr_name + ' to ' + tgt_name + ': ' + str(error))
+                snapshot.renamed(tgt_name, curr_name) # it's still where it was
+                summary['failed'] += 1
+
+def renames_that_happened(batch: list[tuple[str, str]], snapshot:DirSnapshot) -> list[tuple[str, str]]:
+    """those of the (from, to) renames of a batch cut short which happened,
+    going by the snapshot (as plan_undo decides, working back from the last)"""
+    there: dict[str, bool] = {} # as if the later ones found were put back
+    happened = set()
+    for (fname, tname) in reversed(batch):
+        if there.get(tname, snapshot.exists(tname)) and not there.get(fname, snapshot.exists(fname)):
+            happened.add((fname, tname))
+            (there[tname], there[fname]) = (False, True)
+    return [r for r in batch if r in happened]
+
+def compose_history(histories: Iterable[Iterable[tuple[str, str]]]) -> dict[str, str]:
+    """current name -> original name, from the (from, to) renames of several
+    runs given oldest first; names that came back to where they started are
+    left out. Entries come in order of when the file was last renamed"""
+    orig_of: dict[str, str] = {}
+    for renames in histories:
+        for (fname, tname) in renames:
+            orig_of[tname] = orig_of.pop(fname, fname)
+    return {curr: orig for (curr, orig) in orig_of.items() if curr != orig}
+
+def plan_net_undo(net: dict[str, str], appender_str:str, snapshot:DirSnapshot,
+                  adapt_case:bool=False, summary:Optional[dict]=None) -> list[tuple[str, str]]:
+    """the renames which take each file in net (as compose_history gives it)
+    straight back to its original name, ordered (with any temporary names
+    needed) by schedule_renames. As with plan_undo, a file that's gone is
+    skipped and one whose name is taken goes to <name>__<appender_str>;
+    if two files want one name the one renamed last gets it"""
+    if summary is None:
+        summary = new_summary(snapshot.folder)
+    dirlist = snapshot.index
+    moves: dict[str, str] = {}
+    for (curr_name, orig_name) in reversed(net.items()):
+        curr_name = dirlist.find(curr_name, adapt_case) or curr_name
+        if not snapshot.exists(curr_name):
+            log.warning("file to revert: {0} (from history) does not exist".format(curr_name))
+            summary['skipped'] += 1
+            continue
+        moves[curr_name] = orig_name
+    claimed = set()
+    for (curr_name, orig_name) in moves.items():
+        if orig_name in claimed or (snapshot.exists(orig_name) and orig_name not in moves):
+            moves[curr_name] = orig_name = orig_name + '__' + appender_str
+            summary['conflicts'] += 1
+        claimed.add(orig_name)
+        log.debug('reverting name %s  to %s', curr_name, orig_name)
+    from rename import schedule_renames # only multi-generation undo needs the rename code
+    return schedule_renames(moves.items(), snapshot)
+
 def undo_in_dir(history_filename_root:str, path:str='.',
-                keep_rename_history=False, adapt_case:bool=False):
-    # change into the dir
-    if not change_dir(path):
-       return []
-    # load the history file
-    dirlist = [f for f in os.listdir(path) if os.path.isfile(f)]
-    hfilename = get_history_filename(history_filename_root, dirlist)
+                keep_rename_history=False, adapt_case:bool=False,
+                snapshot:Optional[DirSnapshot]=None, inflight:int=1,
+                generations:int=1, to_ts:Optional[str]=None) -> dict:
+    """revert the last run recorded in the dir's history files (or the last
+    generations of them, or all made at or after to_ts); return a summary
+    of what was done (see new_summary). The CWD is not used"""
+    # list the dir (unless that's already been done)
+    if snapshot is None:
+        snapshot = scan_dir(path)
+        if snapshot is None:
+            return new_summary(path)
+        try:
+            return undo_in_dir(history_filename_root, path, keep_rename_history,
+                               adapt_case, snapshot, inflight, generations, to_ts)
+        finally:
+            snapshot.close()
+    if generations < 1:
+        raise ValueError('generations must be at least 1, not ' + str(generations))
+    folder = snapshot.handle
+    dirlist = snapshot.index
+    if generations != 1 or to_ts is not None:
+        return _undo_generations(history_filename_root, path, keep_rename_history,
+                                 adapt_case, snapshot, inflight, generations, to_ts)
+    # find the history file
+    hfilename = get_history_filename(history_filename_root, dirlist, path)
+    summary = new_summary(path)
 
     if hfilename:
+        summary['history_file'] = hfilename
+        summary['generations'] = 1
         log.info('using history file '+ hfilename)
-        hfile_lines = loadfile_lines(path, hfilename)
-        if hfile_lines: # this is the lines for one particular rename
-            # process rename actions in reverse order
-            appender_str=hfilename.split('__')[-1] # last bit after a double underscore
-            for line in reversed(hfile_lines):
-                (prev_name, curr_name, *datetime)=line.split(',') # datetime will be empty most lines
-                if datetime: # then we have just read in the header
-                    break
-                else:
-                    undo_rename(curr_name, prev_name, appender_str)
-        if not get_is_dry_run():
-            if keep_rename_history:
-                os.rename(hfilename, 'u_'+ hfilename)
-            else:
-                os.remove(hfilename)
\ No newline at end of file
+        appender_str=history_timestamp(hfilename) # as _undo_generations has it
+        # the history is read from its end back to the header of its last run,
+        # and the reverting renames are worked out and done as it's read
+        with folder.open(hfilename, 'rb') as hfile:
+            steps = plan_undo(last_run_backwards(lines_backwards(hfile)),
+                              appender_str, snapshot, adapt_case, summary)
+            do_reverts(steps, snapshot, summary, inflight)
+        _retire_history(folder, [hfilename], keep_rename_history, summary)
+    return summary
+
+def _retire_history(folder, hfilenames: list[str], keep_rename_history: bool, summary: dict):
+    """remove (or keep as u_<name>) the history files which have been undone"""
+    if get_is_dry_run():
+        return
+    for hfilename in hfilenames:
+        if keep_rename_history:
+            folder.rename(hfilename, 'u_'+ hfilename)
+        else:
+            folder.unlink(hfilename)
+    summary['history'] = 'kept' if keep_rename_history else 'removed'
+
+def _undo_generations(history_filename_root:str, path:str, keep_rename_history: bool,
+                      adapt_case: bool, snapshot:DirSnapshot, inflight: int,
+                      generations: int, to_ts:Optional[str]) -> dict:
+    """undo several history files at once: compose them into one net rename
+    per file, so each file is renamed (at most) once whatever it went through"""
+    summary = new_summary(path)
+    hfilenames = get_history_filenames(history_filename_root, snapshot.index)
+    if to_ts is not None:
+        hfilenames = [h for h in hfilenames if history_timestamp(h) >= to_ts]
+    else:
+        hfilenames = hfilenames[-generations:]
+    if not hfilenames:
+        log.warning('no history '+ history_filename_root + ' to reverse in '+ path)
+        return summary
+    summary['history_file'] = hfilenames[0] # the one taking us furthest back
+    summary['generations'] = len(hfilenames)
+    log.info('using history files '+ ', '.join(hfilenames))
+
+    histories = []
+    for hfilename in hfilenames:
+        # only the newest file's unfinished batch can be checked against the disk
+        confirm = ((lambda batch: renames_that_happened(batch, snapshot))
+                   if hfilename == hfilenames[-1] else None)
+        with snapshot.handle.open(hfilename) as hfile:
+            histories.append(list(renames_done(hfile, confirm)))
+    net = compose_history(histories)
+    steps = plan_net_undo(net, history_timestamp(hfilenames[0]), snapshot, adapt_case, summary)
+    do_reverts(steps, snapshot, summary, inflight)
+    _retire_history(snapshot.handle, hfilenames, keep_rename_history, summary)
+    return summary
+
+def undo_from_catalog(catalog: HistoryCatalog, run_id: int, path:str='.',
+                      name:Optional[str]=None, adapt_case:bool=False,
+                      snapshot:Optional[DirSnapshot]=None, inflight:int=1) -> dict:
+    """revert run_id's renames in the dir, as recorded in the catalog (or
+    just the rename which gave the file name); return a summary of what
+    was done, as undo_in_dir does"""
+    if snapshot is None:
+        snapshot = scan_dir(path)
+        if snapshot is None:
+            return new_summary(path)
+        try:
+            return undo_from_catalog(catalog, run_id, path, name, adapt_case, snapshot, inflight)
+        finally:
+            snapshot.close()
+    summary = new_summary(path)
+    summary['history_file'] = catalog.path
+    rows = catalog.renames_newest_first(run_id, path, name)
+    if not rows:
+        log.warning('nothing from run ' + str(run_id) + ' to reverse in ' + path)
+        return summary
+    log.info('undoing run ' + str(run_id) + ' in ' + path)
+    steps = plan_undo(((fname, tname, state == 'done') for (seq, fname, tname, state) in rows),
+                      catalog.run_ts(run_id), snapshot, adapt_case, summary)
+    do_reverts(steps, snapshot, summary, inflight)
+    if get_is_dry_run():
+        return summary
+    catalog.mark_undone(run_id, path, (seq for (seq, fname, tname, state) in rows))
+    summary['history'] = 'undone'
+    return summary
@@ -0,0 +1,246 @@
+import os
+import sys
+import abc
+import time
+import select
+import struct
+import logging
+from typing import Callable, Optional
+
+from support import scan_dir
+
+log = logging.getLogger('watch')
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_EVENT = struct.Struct('iIII') # wd, mask, cookie, len (then the name)
+
+_libc = None
+_libc_tried = False
+def _get_inotify_libc():
+    """libc, if it has inotify (Linux), else None"""
+    global _libc, _libc_tried
+    if not _libc_tried:
+        _libc_tried = True
+        if sys.platform.startswith('linux'):
+            import ctypes # only paid for by gfr watch
+            import ctypes.util
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+                libc.inotify_init1.argtypes = [ctypes.c_int]
+                libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+                _libc = libc
+            except (OSError, AttributeError):
+                log.info('no inotify, so polling for orderfile changes')
+    return _libc
+
+def _errno() -> int:
+    """errno as the last libc call left it (libc returns -1, and sets that)"""
+    import ctypes
+    return ctypes.get_errno()
+
+def _is_orderfile(name: str, orderfile_name: str) -> bool:
+    return name.casefold() == orderfile_name.casefold() # as rename_in_dir adapts case
+
+class _Watcher(abc.ABC):
+    """finds the dirs under startdir (those not excluded, and not below it
+    unless do_subtree) whose orderfile has been written"""
+    def __init__(self, startdir: str, exclude: list[str], do_subtree: bool, orderfile_name: str):
+        self.startdir = os.path.abspath(startdir)
+        self.exclude = exclude
+        self.do_subtree = do_subtree
+        self.orderfile_name = orderfile_name
+
+    def _walk(self, top: str, known=()) -> list[tuple[str, Optional[str]]]:
+        """(dir, its orderfile or None) for top and, if do_subtree, the dirs
+        below it (but not those in known, or below them)"""
+        found = []
+        to_do = [top]
+        while to_do:
+            snapshot = scan_dir(to_do.pop())
+            if snapshot is None:
+                continue
+            found.append((snapshot.folder, snapshot.index.find(self.orderfile_name, adapt_case=True)))
+            if self.do_subtree:
+                subdirs = [os.path.join(snapshot.folder, d) for d in snapshot.dirs
+                           if d not in self.exclude and d not in snapshot.links]
+                to_do += [d for d in subdirs if d not in known]
+            snapshot.close()
+        return found
+
+    @abc.abstractmethod
+    def changes(self, timeout: float) -> list[str]:
+        """wait up to timeout secs for orderfiles to be written; the dirs they're in"""
+
+    @abc.abstractmethod
+    def settle(self, folder: str):
+        """forget changes so far in folder (those it's made itself)"""
+
+    def close(self):
+        pass
+
+class InotifyWatcher(_Watcher):
+    """is told of changes by the kernel (Linux inotify): one watch per dir,
+    so a change costs the same however big the tree is"""
+    MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+
+    def __init__(self, startdir: str, exclude: list[str], do_subtree: bool, orderfile_name: str):
+        super().__init__(startdir, exclude, do_subtree, orderfile_name)
+        self.libc = _get_inotify_libc()
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = _errno()
+            raise OSError(err, 'inotify_init1 failed: ' + os.strerror(err))
+        self.folders: dict[int, str] = {} # watch descriptor -> dir
+        self.backlog: list[str] = [] # changes found while settling
+        self._add(self.startdir)
+
+    def _add(self, top: str) -> list[str]:
+        """watch top (and below it); the dirs which already have an orderfile"""
+        with_orderfile = []
+        for (folder, orderfile) in self._walk(top):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), self.MASK)
+            if wd < 0:
+                log.warning('cannot watch ' + folder + ': ' + os.strerror(_errno()))
+                continue
+            self.folders[wd] = folder
+            if orderfile is not None:
+                with_orderfile.append(folder)
+        return with_orderfile
+
+    def _read(self, timeout: float, ignore:Optional[str]=None) -> Optional[list[str]]:
+        """the changes in the events that come within timeout; None if none came"""
+        changed = []
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return None
+        try:
+            buf = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return None
+        pos = 0
+        while pos < len(buf):
+            (wd, mask, cookie, name_len) = _EVENT.unpack_from(buf, pos)
+            name = os.fsdecode(buf[pos + _EVENT.size:pos + _EVENT.size + name_len].rstrip(b'\0'))
+            pos += _EVENT.size + name_len
+            folder = self.folders.get(wd)
+            if mask & IN_IGNORED: # the dir's gone
+                self.folders.pop(wd, None)
+            elif folder is None:
+                continue
+            elif mask & IN_ISDIR:
+                if self.do_subtree and name not in self.exclude:
+                    changed += self._add(os.path.join(folder, name)) # may have come with its orderfile
+            elif _is_orderfile(name, self.orderfile_name) and folder != ignore:
+                changed.append(folder)
+        return changed
+
+    def changes(self, timeout: float) -> list[str]:
+        (changed, self.backlog) = (self.backlog, [])
+        return changed + (self._read(0 if changed else timeout) or [])
+
+    def settle(self, folder: str):
+        while True:
+            changed = self._read(0, ignore=folder)
+            if changed is None:
+                return
+            self.backlog += changed
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher(_Watcher):
+    """looks at every dir each poll: its mtime (which changes when an
+    orderfile is created or renamed into it) and its orderfile's mtime and
+    size (which change when it's edited); only a changed dir is re-listed"""
+    def __init__(self, startdir: str, exclude: list[str], do_subtree: bool, orderfile_name: str):
+        super().__init__(startdir, exclude, do_subtree, orderfile_name)
+        self.seen: dict[str, tuple] = {} # dir -> (dir mtime, its orderfile, orderfile stat)
+        self.backlog: list[str] = [] # changes found while settling
+        for (folder, orderfile) in self._walk(self.startdir):
+            self.seen[folder] = self._look(folder, orderfile)
+
+    @staticmethod
+    def _look(folder: str, orderfile: Optional[str]) -> tuple:
+        try:
+            mtime = os.stat(folder).st_mtime_ns
+            if orderfile is None:
+                return (mtime, None, None)
+            of_st = os.stat(os.path.join(folder, orderfile))
+            return (mtime, orderfile, (of_st.st_mtime_ns, of_st.st_size))
+        except OSError:
+            return (None, None, None)
+
+    def _poll(self, ignore:Optional[str]=None) -> list[str]:
+        changed = []
+        for (folder, (mtime, orderfile, of_stat)) in list(self.seen.items()):
+            now = self._look(folder, orderfile)
+            if now == (mtime, orderfile, of_stat):
+                continue
+            if now[0] is None: # the dir's gone
+                del self.seen[folder]
+                continue
+            if now[0] != mtime: # something came or went: list it (and any new dirs) again
+                for (d, of) in self._walk(folder, self.seen):
+                    prev = self.seen.get(d)
+                    self.seen[d] = self._look(d, of)
+                    if of is not None and d != ignore and (prev is None or prev[1:] != self.seen[d][1:]):
+                        changed.append(d)
+            else: # just the orderfile written
+                self.seen[folder] = now
+                if now[1] is not None and folder != ignore:
+                    changed.append(folder)
+        return changed
+
+    def changes(self, timeout: float) -> list[str]:
+        (changed, self.backlog) = (self.backlog, [])
+        changed += self._poll()
+        if not changed:
+            time.sleep(timeout)
+        return changed
+
+    def settle(self, folder: str):
+        self.backlog += self._poll(ignore=folder)
+
+def make_watcher(startdir: str, exclude: list[str], do_subtree: bool, orderfile_name: str,
+                 use_inotify:bool=True) -> _Watcher:
+    """an InotifyWatcher where that works, else a PollingWatcher"""
+    if use_inotify and _get_inotify_libc() is not None:
+        try:
+            return InotifyWatcher(startdir, exclude, do_subtree, orderfile_name)
+        except OSError as e:
+            log.warning('inotify unavailable (' + str(e) + '), so polling for orderfile changes')
+    return PollingWatcher(startdir, exclude, do_subtree, orderfile_name)
+
+def watch_tree(startdir: str, exclude: list[str], do_subtree: bool, orderfile_name: str,
+               on_change: Callable[[str], None], debounce_secs:float=2.0, poll_secs:float=5.0,
+               use_inotify:bool=True, stop:Callable[[], bool]=lambda: False):
+    """call on_change(dir) whenever a dir's orderfile is written, once it's
+    been left alone for debounce_secs (so a burst of saves is one change);
+    changes on_change itself makes there don't count. Runs until stop() (which
+    is checked at least every poll_secs)"""
+    watcher = make_watcher(startdir, exclude, do_subtree, orderfile_name, use_inotify)
+    log.info('watching ' + startdir + (' and below' if do_subtree else '') + ' for ' + orderfile_name
+             + (' (polling)' if isinstance(watcher, PollingWatcher) else ''))
+    pending: dict[str, float] = {} # dir -> when its orderfile was last written
+    try:
+        while not stop():
+            timeout = poll_secs
+            if pending:
+                timeout = max(0.0, min(min(pending.values()) + debounce_secs - time.monotonic(), poll_secs))
+            for folder in watcher.changes(timeout):
+                pending[folder] = time.monotonic()
+            now = time.monotonic()
+            for folder in [f for (f, t) in pending.items() if now - t >= debounce_secs]:
+                del pending[folder]
+                log.info('orderfile written in ' + folder)
+                on_change(folder)
+                watcher.settle(folder)
+    finally:
+        watcher.close()
@@ -0,0 +1,48 @@
+import unittest
+import sys
+sys.path.append("grouping_renamer") # so modules can import each other
+                                    # when run from tests/
+import os
+import json
+import tempfile
+
+import grouping_renamer.audit as audit_mod
+
+class TestAudit(unittest.TestCase):
+    def read_events(self, path):
+        with open(path) as af:
+            return [json.loads(line) for line in af]
+
+    def test_sampling_keeps_failures(self):
+        """a sampled audit keeps that share of the successes, all the failures,
+        and says how many it left out"""
+        with tempfile.TemporaryDirectory() as td:
+            path = os.path.join(td, 'audit.jsonl')
+            audit = audit_mod.AuditLog(path, sample=0.25)
+            odd = os.fsdecode(b'b_\xff.jpg') # not valid UTF-8
+            for n in range(8):
+                audit.event('rename', td, 'a' + str(n), 'b' + str(n), 'ok', 0.001)
+            audit.event('rename', td, 'x', odd, 'FileExistsError', 0.002)
+            audit.close()
+            events = self.read_events(path)
+        self.assertEqual([(e['from'], e['result']) for e in events[:-1]],
+                         [('a3', 'ok'), ('a7', 'ok'), ('x', 'FileExistsError')])
+        self.assertEqual(events[2]['to'], odd)
+        self.assertEqual((events[-1]['action'], events[-1]['written'], events[-1]['sampled_out'],
+                          events[-1]['dropped']), ('audit_end', 3, 6, 0))
+
+    def test_full_queue_drops(self):
+        """events that don't fit while the writer's behind are counted, not waited for"""
+        with tempfile.TemporaryDirectory() as td:
+            path = os.path.join(td, 'audit.jsonl')
+            audit = audit_mod.AuditLog(path, queue_size=2, flush_secs=60) # writer won't get to it
+            for n in range(5):
+                audit.event('undo', td, 'a' + str(n), 'b' + str(n), 'ok', 0.001)
+            self.assertEqual(audit.dropped, 3)
+            audit.close() # still writes what was queued
+            events = self.read_events(path)
+        self.assertEqual([e['from'] for e in events[:-1]], ['a0', 'a1'])
+        self.assertEqual((events[-1]['written'], events[-1]['dropped']), (2, 3))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+import sys
+sys.path.append("grouping_renamer") # so modules can import each other
+                                    # when run from tests/
+import os
+import tempfile
+from unittest import mock
+
+import grouping_renamer.fsops as fsops
+
+class TestFsops(unittest.TestCase):
+    def make_files(self, td, names):
+        for n in names:
+            with open(os.path.join(td, n), 'w') as f:
+                f.write(n)
+
+    def check_noreplace(self):
+        with tempfile.TemporaryDirectory() as td:
+            self.make_files(td, ['a', 'b'])
+            def p(n):
+                return os.path.join(td, n)
+            with self.assertRaises(FileExistsError):
+                fsops.rename_noreplace(p('a'), p('b'))
+            with open(p('b')) as f:
+                self.assertEqual(f.read(), 'b') # not clobbered
+            with self.assertRaises(FileNotFoundError):
+                fsops.rename_noreplace(p('nope'), p('c'))
+            fsops.rename_noreplace(p('a'), p('c'))
+            self.assertEqual(sorted(os.listdir(td)), ['b', 'c'])
+
+    def test_rename_noreplace(self):
+        """existing target -> FileExistsError, missing source -> FileNotFoundError"""
+        self.check_noreplace()
+
+    def test_rename_noreplace_fallback(self):
+        """same results by check-then-rename where renameat2 isn't available"""
+        with mock.patch.object(fsops, '_get_renameat2', return_value=None):
+            self.check_noreplace()
+
+    def check_dir_handle(self):
+        with tempfile.TemporaryDirectory() as td:
+            self.make_files(td, ['a', 'b'])
+            with fsops.DirHandle(td) as folder:
+                self.assertEqual(sorted(e.name for e in folder.scandir()), ['a', 'b'])
+                with self.assertRaises(FileExistsError):
+                    folder.rename('a', 'b')
+                folder.rename('a', 'c')
+                with folder.open('d', 'w') as f:
+                    f.write('d')
+                with folder.open('d') as f:
+                    self.assertEqual(f.read(), 'd')
+                self.assertTrue(folder.access('c', os.R_OK))
+                folder.unlink('b')
+                folder.fsync()
+            self.assertIsNone(folder.fd) # closed
+            self.assertEqual(sorted(os.listdir(td)), ['c', 'd'])
+
+    def test_dir_handle(self):
+        """files are listed, renamed, opened and deleted relative to the open dir"""
+        self.check_dir_handle()
+        if fsops.HAVE_DIR_FD: # the dir can even move, as its fd is what's used
+            with tempfile.TemporaryDirectory() as td:
+                os.mkdir(os.path.join(td, 'x'))
+                self.make_files(os.path.join(td, 'x'), ['a'])
+                with fsops.DirHandle(os.path.join(td, 'x')) as folder:
+                    os.rename(os.path.join(td, 'x'), os.path.join(td, 'y'))
+                    folder.rename('a', 'b')
+                self.assertEqual(os.listdir(os.path.join(td, 'y')), ['b'])
+
+    def test_dir_handle_without_dir_fd(self):
+        """same results with joined paths where there's no dir_fd support"""
+        with mock.patch.object(fsops, 'HAVE_DIR_FD', False):
+            self.check_dir_handle()
+
+if __name__ == '__main__':
+    unittest.main()
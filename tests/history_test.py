@@ -0,0 +1,165 @@
+import unittest
+import sys
+sys.path.append("grouping_renamer") # so modules can import each other
+                                    # when run from tests/
+import os
+import tempfile
+from unittest import mock
+
+import grouping_renamer.history as hist_mod
+from grouping_renamer import undo
+
+class TestHistory(unittest.TestCase):
+    def test_journal_records_intent_before_renames(self):
+        """each batch is written and fsync'ed before it is handed out to be renamed"""
+        with tempfile.TemporaryDirectory() as td:
+            hpath = os.path.join(td, 'rename_history__now.csv')
+            journal = hist_mod.RenameJournal(hpath, 'now')
+            renames = [('a_%d' % n, 'b_%d' % n) for n in range(40)]
+            batches = []
+            with mock.patch('os.fsync') as fsync:
+                for batch in journal.batches(renames):
+                    with open(hpath) as hf: # intents are already on disk
+                        self.assertIn(batch[-1][0] + ',' + batch[-1][1] + '\n', hf.read())
+                    batches.append(batch)
+                    journal.done(len(batch))
+                self.assertEqual(fsync.call_count, len(batches)) # one per batch
+            journal.close()
+            self.assertEqual(sum(batches, []), renames)
+            self.assertEqual(len(batches[0]), 16)
+            self.assertEqual(len(batches[1]), 24) # grew, as batches are quick
+
+            with open(hpath) as hf:
+                lines = hf.read().splitlines()
+            self.assertEqual(lines[0], 'from, to, now')
+            self.assertEqual(lines[1], '#intent,16')
+            self.assertEqual(lines[-1], '#done,24')
+            self.assertEqual([line for line in lines[1:] if not line.startswith(hist_mod.MARK)],
+                             [f + ',' + t for (f, t) in renames])
+
+    def test_last_run_read_backwards(self):
+        """the last run's renames come newest first, across chunk boundaries,
+        stopping at its header"""
+        with tempfile.TemporaryDirectory() as td:
+            hpath = os.path.join(td, 'hf.csv')
+            with open(hpath, 'w') as hf:
+                hf.write('from, to, earlier\nold,older\n')
+                hf.write('from, to, later\n#intent,3\n')
+                hf.write(''.join('f_%d,t_%d\n' % (n, n) for n in range(3)))
+                hf.write('#done,3\n')
+            with open(hpath, 'rb') as hf:
+                lines = list(hist_mod.lines_backwards(hf, chunk_size=5))
+                hf.seek(0)
+                self.assertEqual(lines, hf.read().decode().split('\n')[::-1])
+            self.assertEqual(list(hist_mod.last_run_backwards(lines)),
+                             [('f_2', 't_2', True), ('f_1', 't_1', True), ('f_0', 't_0', True)])
+
+    def test_last_run_backwards_marks(self):
+        """failed renames are left out, and those of a batch with no #done
+        come as not done; a file without markers is all done"""
+        lines = ['from, to, now', '#intent,2', 'a,b', 'c,d', '#failed,c,d', '#done,1',
+                 '#intent,2', 'e,f', 'g,h', '#failed,g,h']
+        self.assertEqual(list(hist_mod.last_run_backwards(reversed(lines))),
+                         [('e', 'f', False), ('a', 'b', True)])
+        self.assertEqual(list(hist_mod.last_run_backwards(reversed(lines[:6] + ['#intent,1', 'e,f']))),
+                         [('e', 'f', False), ('a', 'b', True)])
+        self.assertEqual(list(hist_mod.last_run_backwards(['c,d', 'a,b', 'from, to, now', 'x,y'])),
+                         [('c', 'd', True), ('a', 'b', True)])
+
+    def test_renames_done_drops_failed(self):
+        """reading forwards, failed renames are left out; an unfinished batch is kept"""
+        lines = ['from, to, now', 'a,b', '#intent,2', 'c,d', 'e,f', '#failed,c,d', '#done,1',
+                 '#intent,1', 'g,h']
+        self.assertEqual(list(hist_mod.renames_done(lines)), [('a', 'b'), ('e', 'f'), ('g', 'h')])
+
+    @mock.patch('grouping_renamer.undo.get_is_dry_run', return_value=False)
+    def test_undo_skips_journal_markers(self, mock_dr):
+        """undo reverses what was renamed, including a batch left unfinished"""
+        with tempfile.TemporaryDirectory() as td:
+            for n in ['new_1', 'new_2']:
+                open(os.path.join(td, n), 'w').close()
+            journal = hist_mod.RenameJournal(os.path.join(td, 'hf__now.csv'), 'now')
+            journal.intend([('old_1', 'new_1')])
+            journal.done(1)
+            journal.intend([('old_2', 'new_2'), ('old_3', 'new_3')]) # then "crashed"
+            journal.failed('old_3', 'new_3')
+            journal.close()
+
+            undo.undo_in_dir('hf.csv', td)
+            self.assertEqual(sorted(os.listdir(td)), ['old_1', 'old_2'])
+
+    @mock.patch('grouping_renamer.undo.get_is_dry_run', return_value=False)
+    def test_undo_skips_failed_renames(self, mock_dr):
+        """a rename marked failed isn't reversed, even if its target is there"""
+        with tempfile.TemporaryDirectory() as td:
+            for n in ['A_0010.jpg', 'X_i0010.jpg']:
+                open(os.path.join(td, n), 'w').close()
+            with open(os.path.join(td, 'hf__now.csv'), 'w') as hf:
+                hf.write('from, to, now\n#intent,1\nA_0010.jpg,X_i0010.jpg\n'
+                         '#failed,A_0010.jpg,X_i0010.jpg\n#done,0\n')
+            summary = undo.undo_in_dir('hf.csv', td)
+            self.assertEqual(summary['renamed'], 0)
+            self.assertEqual(sorted(os.listdir(td)), ['A_0010.jpg', 'X_i0010.jpg'])
+
+    @mock.patch('grouping_renamer.undo.get_is_dry_run', return_value=False)
+    def test_undo_checks_unfinished_batch(self, mock_dr):
+        """of a batch with no #done, only the renames which happened are
+        reversed, even along a chain"""
+        chain = [('F_i0010.jpg', 'F_i0020.jpg'), ('F_0005.jpg', 'F_i0010.jpg'),
+                 ('F_0001.jpg', 'F_0005.jpg')]
+        for happened in range(4):
+            for generations in (1, 2):
+                with tempfile.TemporaryDirectory() as td:
+                    for n in ['F_i0010.jpg', 'F_0005.jpg', 'F_0001.jpg']:
+                        with open(os.path.join(td, n), 'w') as f:
+                            f.write(n)
+                    journal = hist_mod.RenameJournal(os.path.join(td, 'hf__now.csv'), 'now')
+                    journal.intend(chain) # then "crashed" after some of them
+                    for (f, t) in chain[:happened]:
+                        os.rename(os.path.join(td, f), os.path.join(td, t))
+                    journal.close()
+
+                    summary = undo.undo_in_dir('hf.csv', td, generations=generations)
+                    self.assertEqual(summary['renamed'], happened)
+                    self.assertEqual(sorted(os.listdir(td)), ['F_0001.jpg', 'F_0005.jpg', 'F_i0010.jpg'])
+                    for n in os.listdir(td):
+                        with open(os.path.join(td, n)) as f:
+                            self.assertEqual(f.read(), n)
+
+    @mock.patch('grouping_renamer.undo.get_is_dry_run', return_value=False)
+    def test_catalog_records_and_undoes_runs(self, mock_dr):
+        """renames go in the tree's catalog by run and dir; undo goes back a
+        run (or just one file's rename) at a time"""
+        with tempfile.TemporaryDirectory() as td:
+            sub = os.path.join(td, 'sub')
+            os.mkdir(sub)
+            open(os.path.join(sub, 'a'), 'w').close()
+            catalog = hist_mod.HistoryCatalog(os.path.join(td, hist_mod.CATALOG_NAME))
+            self.assertEqual(hist_mod.find_catalog(sub), catalog.path)
+            for (run, renames) in [(1, [('a', 'b')]), (2, [('b', 'c'), ('x', 'y')])]:
+                self.assertEqual(catalog.start_run('ts%d' % run), run)
+                journal = catalog.journal(sub)
+                for batch in journal.batches(renames):
+                    for (f, t) in batch:
+                        if f == 'x':
+                            journal.failed(f, t)
+                        else:
+                            os.rename(os.path.join(sub, f), os.path.join(sub, t))
+                    journal.done(1)
+            self.assertEqual(catalog.former_names(os.path.join(sub, 'c')),
+                             [('b', 2, 'ts2'), ('a', 1, 'ts1')])
+            self.assertEqual(catalog.last_run(td, subtree=True), 2)
+            self.assertEqual(catalog.run_dirs(2, td, subtree=True), [sub])
+            self.assertEqual(catalog.renames_newest_first(2, sub), [(0, 'b', 'c', 'done')]) # not the failed one
+
+            summary = undo.undo_from_catalog(catalog, 2, sub)
+            self.assertEqual(summary['renamed'], 1)
+            self.assertEqual(os.listdir(sub), ['b'])
+            self.assertEqual(catalog.last_run(sub), 1) # run 2 is undone
+            undo.undo_from_catalog(catalog, 1, sub, name='b')
+            self.assertEqual(os.listdir(sub), ['a'])
+            self.assertIsNone(catalog.last_run(sub))
+            catalog.close()
+
+if __name__ == '__main__':
+    unittest.main()
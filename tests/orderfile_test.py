@@ -0,0 +1,78 @@
+import unittest
+import sys
+sys.path.append("grouping_renamer") # so modules can import each other
+                                    # when run from tests/
+import os
+import codecs
+import tempfile
+
+import grouping_renamer.orderfile as of_mod
+
+class TestOrderfile(unittest.TestCase):
+    def read(self, fname: str, data: bytes, fmt=None) -> list[str]:
+        with tempfile.TemporaryDirectory() as td:
+            with open(os.path.join(td, fname), 'wb') as f:
+                f.write(data)
+            return list(of_mod.read_names(td, fname, fmt=fmt))
+
+    def test_plain_list(self):
+        """names in order, without blanks or repeats; any line ending"""
+        self.assertEqual(self.read('order.txt', b'b.jpg\r\na.jpg\n\n  b.jpg \rc.jpg'),
+                         ['b.jpg', 'a.jpg', 'c.jpg'])
+        self.assertEqual(self.read('order.txt', b''), [])
+        with tempfile.TemporaryDirectory() as td:
+            self.assertEqual(list(of_mod.read_names(td, 'missing.txt')), [])
+
+    def test_as_listed(self):
+        """not once: blanks and repeats are left for the caller"""
+        with tempfile.TemporaryDirectory() as td:
+            with open(os.path.join(td, 'order.txt'), 'wb') as f:
+                f.write(b'b.jpg\n\nb.jpg\na.jpg\n')
+            self.assertEqual(list(of_mod.read_names(td, 'order.txt', once=False)),
+                             ['b.jpg', '', 'b.jpg', 'a.jpg'])
+
+    def test_encodings(self):
+        """BOMs are followed, and bytes that aren't UTF-8 come back as os.listdir() gives them"""
+        names = ['c_0003.jpg', 'é_0001.jpg']
+        text = '\n'.join(names) + '\n'
+        self.assertEqual(self.read('o.txt', codecs.BOM_UTF8 + text.encode()), names)
+        self.assertEqual(self.read('o.txt', text.encode('utf-16')), names)
+        self.assertEqual(self.read('o.txt', codecs.BOM_UTF16_BE + text.encode('utf-16-be')), names)
+        odd = b'x_0010_\xff.jpg'
+        self.assertEqual(self.read('o.txt', b'a.jpg\n' + odd + b'\n'), ['a.jpg', os.fsdecode(odd)])
+
+    def test_chunks(self):
+        """lines (and UTF-8 characters) split across chunks are put back together"""
+        names = ['é_%05d.jpg' % n for n in range(3000)]
+        saved = of_mod.CHUNK_SIZE
+        of_mod.CHUNK_SIZE = 7
+        try:
+            self.assertEqual(self.read('o.txt', '\n'.join(names + names).encode()), names)
+        finally:
+            of_mod.CHUNK_SIZE = saved
+
+    def test_faststone(self):
+        """a list with no sections; else the numbered entries of its sections"""
+        self.assertEqual(self.read('.fssort.ini', b'b.jpg\na.jpg\n'), ['b.jpg', 'a.jpg'])
+        ini = (b'[Settings]\nSortBy=5\n; a comment\n[Files]\n1=b.jpg\n2 = a=1.jpg\n'
+               b'File3=c.jpg\nd.jpg\n4=b.jpg\n')
+        self.assertEqual(self.read('.fssort.ini', ini), ['b.jpg', 'a=1.jpg', 'c.jpg', 'd.jpg'])
+
+    def test_csv(self):
+        """a manifest's filename column if it has a header row, else its first column"""
+        self.assertEqual(self.read('order.csv', b'Rating,File Name\n5,"b, 2.jpg"\n3,a.jpg\n'),
+                         ['b, 2.jpg', 'a.jpg'])
+        self.assertEqual(self.read('order.csv', b'b.jpg,5\na.jpg,3\n\n'), ['b.jpg', 'a.jpg'])
+        # the format can be given, whatever the suffix
+        self.assertEqual(self.read('order.txt', b'b.jpg,5\n', fmt='csv'), ['b.jpg'])
+
+    def test_register_format(self):
+        saved = (dict(of_mod.FORMATS), dict(of_mod.SUFFIXES))
+        try:
+            of_mod.register_format('reversed', lambda lines: reversed(list(lines)), ['.rev'])
+            self.assertEqual(self.read('o.REV', b'a\nb\n'), ['b', 'a'])
+        finally:
+            (of_mod.FORMATS, of_mod.SUFFIXES) = saved
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+import sys
+sys.path.append("grouping_renamer") # so modules can import each other
+                                    # when run from tests/
+import os
+import subprocess
+import tempfile
+
+import grouping_renamer.planfile as plan_mod
+import grouping_renamer.rename as ren_mod
+import grouping_renamer.state as state_mod
+
+GFR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'grouping_renamer', 'gfr.py')
+
+class TestPlanFile(unittest.TestCase):
+    def test_plan_round_trip_and_staleness(self):
+        """a plan reads back as written (odd names too), and its fingerprint
+        goes stale when the orderfile is edited"""
+        with tempfile.TemporaryDirectory() as td:
+            os.mkdir(os.path.join(td, 'a'))
+            odd = os.fsdecode(b'x_0010_\xff.jpg') # not valid UTF-8
+            for n in [odd, 'y_0020.jpg']:
+                open(os.path.join(td, 'a', n), 'w').close()
+            with open(os.path.join(td, 'a', 'fssort.ini'), 'w') as of:
+                of.write('y_0020.jpg\n')
+            plan_path = os.path.join(td, 'plan.jsonl')
+            writer = plan_mod.PlanWriter(plan_path, td, {'idstart': 10}, 'now')
+            snapshot = ren_mod.scan_dir(os.path.join(td, 'a'))
+            fp = plan_mod.fingerprint_unplanned(snapshot, 'FSSORT.INI')
+            dir_plan = ren_mod.plan_dir(os.path.join(td, 'a'), 'p_', 'FSSORT.INI', r'\d{2,5}', True,
+                                        snapshot=snapshot)
+            rename_list = list(ren_mod.number_groups(dir_plan.renames, dir_plan.prefix, 'i', 30, 10, 4))
+            rename_list.append((odd, 'p_i0040_\udcff.jpg'))
+            writer.add(dir_plan, fp, 30, rename_list)
+            writer.close()
+            dir_plan.snapshot.close()
+
+            (header, planned_dirs) = plan_mod.read_plan(plan_path)
+            self.assertEqual((header['root'], header['params']), (td, {'idstart': 10}))
+            [planned] = list(planned_dirs)
+            self.assertEqual((planned.folder, planned.orderfile_name, planned.start, planned.group_count),
+                             (os.path.join(td, 'a'), 'fssort.ini', 30, 1))
+            self.assertEqual(planned.renames, [('y_0020.jpg', 'p_i0030.jpg'),
+                                               (odd, 'p_i0040_\udcff.jpg')])
+            self.assertTrue(state_mod.unchanged(planned.folder, planned.fingerprint))
+            with open(os.path.join(td, 'a', 'fssort.ini'), 'a') as of:
+                of.write('z_0030.jpg\n')
+            self.assertFalse(state_mod.unchanged(planned.folder, planned.fingerprint))
+
+    def test_change_while_planning_is_stale(self):
+        """the fingerprint is the dir as listed, so a file that turns up while
+        it's being planned makes the plan stale"""
+        with tempfile.TemporaryDirectory() as td:
+            open(os.path.join(td, 'y_0020.jpg'), 'w').close()
+            snapshot = ren_mod.scan_dir(td)
+            fp = plan_mod.fingerprint_unplanned(snapshot, 'fssort.ini')
+            open(os.path.join(td, 'y_0030.jpg'), 'w').close() # after listing, before planning's done
+            snapshot.close()
+            self.assertFalse(state_mod.unchanged(td, fp))
+
+    def test_apply_is_a_dry_run_by_default(self):
+        with tempfile.TemporaryDirectory() as td:
+            open(os.path.join(td, 'y_0020.jpg'), 'w').close()
+            with open(os.path.join(td, 'fssort.ini'), 'w') as of:
+                of.write('y_0020.jpg\n')
+            plan_path = os.path.join(td, 'plan.jsonl')
+            def gfr(*args):
+                proc = subprocess.run([sys.executable, GFR] + list(args), capture_output=True, text=True,
+                                      stdin=subprocess.DEVNULL, cwd=td)
+                self.assertEqual(proc.returncode, 0, proc.stderr)
+            gfr('plan', td, 'p_', '--plan-file', plan_path)
+            gfr('apply', plan_path)
+            self.assertIn('y_0020.jpg', os.listdir(td))
+            gfr('apply', plan_path, '--no-dryrun')
+            self.assertNotIn('y_0020.jpg', os.listdir(td))
+
+    def test_not_a_plan(self):
+        with tempfile.TemporaryDirectory() as td:
+            path = os.path.join(td, 'notes.txt')
+            with open(path, 'w') as f:
+                f.write('hello\n')
+            with self.assertRaises(ValueError):
+                plan_mod.read_plan(path)
+
+if __name__ == '__main__':
+    unittest.main()
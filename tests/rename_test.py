@@ -39,6 +39,7 @@ class TestRename(unittest.TestCase):
         # check the ordered file loaded
         adapt_case=True
         (filenames, orderednames) = ren_mod.fetch_lists(folder, orderfile, adapt_case)
+        orderednames = list(orderednames) # (read as they're wanted)
         self.assertNotEqual(orderednames, [])
         self.assertIn('fssort_test.dat', orderednames)
         self.assertIn('FSSORT_TEST.DAT', orderednames)
@@ -51,6 +52,20 @@ class TestRename(unittest.TestCase):
         self.assertNotEqual(filenames, [])
         self.assertIn('fssort_test.dat', filenames)
     
+    def test_fetch_lists_streams_orderfile(self, mock_dr):
+        """the orderfile's names are read as they're matched, and de-duplicated
+        there; an empty orderfile gives [] (so the dir's own order is used)"""
+        with tempfile.TemporaryDirectory() as td:
+            for n in ['a.jpg', 'b.jpg']:
+                open(os.path.join(td, n), 'w').close()
+            with open(os.path.join(td, 'fssort.ini'), 'w') as f:
+                f.write('b.jpg\n\nb.jpg\na.jpg\n')
+            (dirlist, names) = ren_mod.fetch_lists(td, 'fssort.ini')
+            self.assertNotIsInstance(names, list)
+            self.assertEqual(ren_mod.fix_orderlines(names, dirlist, None, False), ['b.jpg', 'a.jpg'])
+            open(os.path.join(td, 'fssort.ini'), 'w').close()
+            self.assertEqual(ren_mod.fetch_lists(td, 'fssort.ini')[1], [])
+
     def test_fetch_lists_adapts_case(self, mock_dr):
         """ test that we find the orderfile if case mismatch on case-sensitive filesys"""
         
@@ -87,20 +102,38 @@ class TestRename(unittest.TestCase):
         id_start=10
         id_len=4
         id_step=4
-        expected=[{'from':orderednames[0], 'to':'b_1965_i0010.jpg'},
-            {'from':orderednames[2], 'to':'b_1965_i0010_a.jpg'},
-            {'from':orderednames[1], 'to':'b_1965_i0014_a.jpg'}
+        expected=[(orderednames[0], 'b_1965_i0010.jpg'),
+            (orderednames[2], 'b_1965_i0010_a.jpg'),
+            (orderednames[1], 'b_1965_i0014_a.jpg')
             ]
         
         rd = ren_mod.make_rename_list(orderednames.copy(),id_regex,
                                  to_prefix, id_prefix,
                                  id_start,id_step,id_len)
-        self.assertEqual(rd[0]['from'], expected[0]['from'])
-        self.assertEqual(rd[0]['to'], expected[0]['to'])
-        self.assertEqual(rd[1]['from'], expected[1]['from'])
-        self.assertEqual(rd[1]['to'], expected[1]['to'])
-        self.assertEqual(rd[2]['from'], expected[2]['from'])
-        self.assertEqual(rd[2]['to'], expected[2]['to'])
+        self.assertEqual(len(rd), 3)
+        self.assertEqual(rd.group_count, 2)
+        self.assertEqual(list(rd), expected)
+        # the groups can be numbered again, from elsewhere
+        renumbered = ren_mod.number_groups(rd, 'z_', '', 100, 1, 3)
+        self.assertEqual([t for (f, t) in renumbered], ['z_100.jpg', 'z_100_a.jpg', 'z_101_a.jpg'])
+        self.assertEqual(list(rd), expected)
+
+    def test_make_rename_list_keeps_split_groups_together(self, mock_dr):
+        """groups are numbered in order of first encounter, even if split up
+        by the orderfile; and the input list is left alone"""
+        orderednames=['FOO_0003.jpg', 'FOO_0001.jpg', 'FOO_0002.jpg', 'FOO_0004.jpg',
+                      'notes.txt', 'FOO_0002_a.jpg', 'FOO_0001_b.jpg', 'FOO_0004_b.jpg']
+        orig=orderednames.copy()
+        rd = ren_mod.make_rename_list(orderednames, r'\d{2,5}', 'FOO_', 'i', 10, 10, 4)
+        self.assertEqual(orderednames, orig)
+        self.assertEqual(list(rd),
+            [('FOO_0003.jpg', 'FOO_i0010.jpg'),
+             ('FOO_0001.jpg', 'FOO_i0020.jpg'),
+             ('FOO_0001_b.jpg', 'FOO_i0020_b.jpg'),
+             ('FOO_0002.jpg', 'FOO_i0030.jpg'),
+             ('FOO_0002_a.jpg', 'FOO_i0030_a.jpg'),
+             ('FOO_0004.jpg', 'FOO_i0040.jpg'),
+             ('FOO_0004_b.jpg', 'FOO_i0040_b.jpg')])
 
     def test_rename_base_case(self, mock_dr):
         # will need dir with files to be renamed
@@ -115,8 +148,137 @@ class TestRename(unittest.TestCase):
             dlist=os.listdir(td)
             hflist = [f for f in dlist if f.startswith(history_filename_root)]
             self.assertNotEqual(hflist, []) # there must be at *least* the history file!
-            
-            
-            
+
+    def test_rename_in_dir_follows_orderfile(self, mock_dr):
+        """files are renamed in orderfile order, and the renames go in the history"""
+        start_dir=os.getcwd()
+        with tempfile.TemporaryDirectory() as td:
+            for f in ['FOO_0001.jpg', 'FOO_0001_b.jpg', 'FOO_0002.jpg', 'FOO_0003.jpg']:
+                open(os.path.join(td, f), 'w').close()
+            with open(os.path.join(td, 'fssort.ini'), 'w') as of:
+                of.write('FOO_0003.jpg\nfoo_0001.JPG\nFOO_0002.jpg\nFOO_0001_b.jpg\n')
+            used = ren_mod.rename_in_dir(td, 'BAR_', 'fssort.ini', 'rename_history.csv',
+                                         'i', r'\d{2,5}', 10, 10, 4, True)
+            self.assertEqual(os.getcwd(), start_dir) # works by path, not chdir
+            self.assertEqual(used, 4)
+            dlist=os.listdir(td)
+            for u in ['BAR_i0010.jpg', 'BAR_i0020.jpg', 'BAR_i0020_b.jpg', 'BAR_i0030.jpg']:
+                self.assertIn(u, dlist)
+            self.assertNotIn('fssort.ini', dlist) # backed up
+            hflist = [f for f in dlist if f.startswith('rename_history')]
+            self.assertEqual(len(hflist), 1)
+            with open(os.path.join(td, hflist[0])) as hf:
+                self.assertIn('FOO_0003.jpg,BAR_i0010.jpg\n', hf.read())
+
+    def test_failed_orderfile_backup_leaves_no_history(self, mock_dr):
+        """a second run in the same second gets its own history file; if it
+        can't back up the orderfile it leaves none, and the first run can
+        still be undone"""
+        from grouping_renamer import undo
+        with tempfile.TemporaryDirectory() as td, \
+                mock.patch('grouping_renamer.rename.datetime') as mock_dt, \
+                mock.patch('grouping_renamer.undo.get_is_dry_run', return_value=False):
+            mock_dt.datetime.now.return_value.strftime.return_value = 'now'
+            for f in ['FOO_0001.jpg', 'FOO_0002.jpg']:
+                open(os.path.join(td, f), 'w').close()
+            def run():
+                with open(os.path.join(td, 'fssort.ini'), 'w') as of:
+                    of.write('FOO_0002.jpg\nFOO_0001.jpg\n')
+                return ren_mod.rename_in_dir(td, 'BAR_', 'fssort.ini', 'rename_history.csv',
+                                             'i', r'\d{2,5}', 10, 10, 4, True)
+            self.assertEqual(run(), 2)
+            snapshot = ren_mod.DirSnapshot(td)
+            self.assertEqual(ren_mod.run_stamp(snapshot, ['rename_history.csv', 'fssort.ini']), 'now_1')
+            snapshot.close()
+            with mock.patch.object(type(snapshot.handle), 'rename', side_effect=PermissionError):
+                self.assertEqual(run(), 0) # can't back up the orderfile
+            with mock.patch.object(ren_mod.DirSnapshot, 'exists', return_value=False): # as if run_stamp missed it
+                self.assertEqual(run(), 0)
+            self.assertEqual(sorted(f for f in os.listdir(td) if f.startswith('rename_history')),
+                             ['rename_history__now.csv'])
+            os.remove(os.path.join(td, 'fssort.ini'))
+            undo.undo_in_dir('rename_history.csv', td)
+            self.assertEqual(sorted(os.listdir(td)), ['FOO_0001.jpg', 'FOO_0002.jpg', 'fssort.ini'])
+
+    def test_allocate_ids_reserves_ranges(self, mock_dr):
+        """without id_per_dir each dir starts after the IDs the dirs before it need"""
+        def plan(num_groups):
+            names = ['G_%03d.jpg' % g for g in range(num_groups)]
+            return ren_mod.DirPlan(None, None, 'P_', ren_mod.group_names(names, r'\d{2,5}'))
+        plans = [plan(3), None, plan(0), plan(2), plan(1)]
+        starts = [start for (p, start) in ren_mod.allocate_ids(plans, 10, 10, False)]
+        self.assertEqual(starts, [10, 40, 40, 60])
+        starts = [start for (p, start) in ren_mod.allocate_ids(plans, 10, 10, True)]
+        self.assertEqual(starts, [10, 10, 10, 10])
+
+    def test_schedule_renames_resolves_swaps_and_chains(self, mock_dr):
+        """a swap takes one temporary name; a chain goes end first; a rename
+        into a file that stays put is dropped, along with what waits on it"""
+        with tempfile.TemporaryDirectory() as td:
+            for f in ['A', 'B', 'C', 'D', 'E', 'X', 'Y', 'KEEP']:
+                open(os.path.join(td, f), 'w').close()
+            snapshot = ren_mod.DirSnapshot(td)
+            plan = [('A', 'B'), ('B', 'A'), # swap
+                    ('C', 'D'), ('D', 'E'), ('E', 'F'), # chain
+                    ('X', 'Y'), ('Y', 'KEEP'), # blocked by KEEP
+                    ('Z', 'W')] # Z is missing
+            steps = ren_mod.schedule_renames(plan, snapshot)
+            self.assertEqual(steps, [('A', 'A__gfr_swap'), ('B', 'A'), ('A__gfr_swap', 'B'),
+                                     ('E', 'F'), ('D', 'E'), ('C', 'D')])
+            self.assertEqual(sorted(snapshot.files), ['A', 'B', 'D', 'E', 'F', 'KEEP', 'X', 'Y'])
+
+    def test_swap_name_avoids_planned_targets(self, mock_dr):
+        with tempfile.TemporaryDirectory() as td:
+            for f in ['A', 'B', 'C']:
+                open(os.path.join(td, f), 'w').close()
+            snapshot = ren_mod.DirSnapshot(td)
+            steps = ren_mod.schedule_renames([('A', 'B'), ('B', 'A'), ('C', 'A__gfr_swap')], snapshot)
+            self.assertEqual(steps, [('A', 'A__gfr_swap1'), ('B', 'A'), ('A__gfr_swap1', 'B'),
+                                     ('C', 'A__gfr_swap')])
+            snapshot.close()
+
+    def test_history_kept_for_a_parking_rename(self, mock_dr):
+        """a swap that gets no further than parking a file renames no file to
+        its new name, but the history is kept so that can be undone"""
+        with tempfile.TemporaryDirectory() as td:
+            for f in ['A', 'B']:
+                with open(os.path.join(td, f), 'w') as fo:
+                    fo.write(f)
+            snapshot = ren_mod.DirSnapshot(td)
+            real_rename = type(snapshot.handle).rename
+            def rename(folder, src, dst):
+                if src == 'B':
+                    raise PermissionError(src)
+                real_rename(folder, src, dst)
+            with mock.patch.object(type(snapshot.handle), 'rename', autospec=True, side_effect=rename):
+                used = ren_mod.apply_renames(snapshot, None, [('A', 'B'), ('B', 'A')], 'hf.csv')
+            snapshot.close()
+            self.assertEqual(used, 0)
+            [hf] = [f for f in os.listdir(td) if f.startswith('hf')]
+            self.assertEqual(sorted(os.listdir(td)), ['A__gfr_swap', 'B', hf])
+            from grouping_renamer import undo
+            with mock.patch('grouping_renamer.undo.get_is_dry_run', return_value=False):
+                undo.undo_in_dir('hf.csv', td)
+            self.assertEqual(sorted(os.listdir(td)), ['A', 'B'])
+            with open(os.path.join(td, 'A')) as f:
+                self.assertEqual(f.read(), 'A')
+
+    def test_do_rename_permutes_in_one_pass(self, mock_dr):
+        """re-numbering already-renamed files (a 3-cycle) needs just one extra rename"""
+        with tempfile.TemporaryDirectory() as td:
+            for n in [10, 20, 30]:
+                with open(os.path.join(td, 'F_i%04d.jpg' % n), 'w') as f:
+                    f.write(str(n))
+            plan = ren_mod.make_rename_list(['F_i0030.jpg', 'F_i0010.jpg', 'F_i0020.jpg'],
+                                            r'\d{2,5}', 'F_', 'i', 10, 10, 4)
+            journal = mock.Mock()
+            journal.batches.side_effect = lambda to_do: [to_do]
+            used = ren_mod.do_rename(plan, journal, ren_mod.DirSnapshot(td))
+            self.assertEqual(used, 3)
+            self.assertEqual(journal.done.call_args[0][0], 4) # 3 renames + 1 parking
+            for (n, was) in [(10, 30), (20, 10), (30, 20)]:
+                with open(os.path.join(td, 'F_i%04d.jpg' % n)) as f:
+                    self.assertEqual(f.read(), str(was))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
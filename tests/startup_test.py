@@ -0,0 +1,57 @@
+import unittest
+import os
+import sys
+import subprocess
+import tempfile
+
+GFR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'grouping_renamer', 'gfr.py')
+
+# gfr runs from per-folder hooks, so keep its startup cheap: total import time
+# (generous, for slow CI machines) and modules which must not be loaded unless
+# the command that needs them runs
+IMPORT_BUDGET_US = 250_000
+NOT_AT_STARTUP = {'rename', 'undo', 'state', 'planfile', 'watch', 'sqlite3', 'rich', 'typing_extensions'}
+
+def import_times(*args) -> dict[str, int]:
+    """module -> its own import time (usec), from python -X importtime gfr.py args"""
+    proc = subprocess.run([sys.executable, '-X', 'importtime', GFR] + list(args),
+                          capture_output=True, text=True, stdin=subprocess.DEVNULL)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if line.startswith('import time:') and 'self [us]' not in line:
+            (self_us, cumulative, name) = line[len('import time:'):].split('|')
+            times[name.strip()] = int(self_us)
+    return times
+
+class TestStartup(unittest.TestCase):
+    def check_startup(self, times: dict[str, int], not_loaded: set[str]):
+        self.assertIn('typer', times) # it did run
+        self.assertEqual({m for m in times if m.split('.')[0] in not_loaded}, set())
+        self.assertLess(sum(times.values()), IMPORT_BUDGET_US)
+
+    def test_help_is_cheap(self):
+        self.check_startup(import_times('--help'), NOT_AT_STARTUP | {'support'})
+
+    def test_noop_undo_is_cheap(self):
+        """undo with nothing to do loads the undo code, but not rename's"""
+        with tempfile.TemporaryDirectory() as td:
+            times = import_times('undo', td)
+        self.assertIn('undo', times)
+        self.check_startup(times, NOT_AT_STARTUP - {'undo'})
+
+    def test_dry_run_leaves_catalog_alone(self):
+        """a dry run with the sqlite backend neither needs a catalog nor
+        writes one (or even loads sqlite3)"""
+        with tempfile.TemporaryDirectory() as td:
+            open(os.path.join(td, 'A_0001.jpg'), 'w').close()
+            with open(os.path.join(td, 'fssort.ini'), 'w') as of:
+                of.write('A_0001.jpg\n')
+            proc = subprocess.run([sys.executable, '-X', 'importtime', GFR, 'rename', td,
+                                   '--history-backend', 'sqlite'],
+                                  capture_output=True, text=True, stdin=subprocess.DEVNULL, cwd=td)
+            self.assertEqual(proc.returncode, 0, proc.stderr)
+            self.assertNotIn('sqlite3', proc.stderr)
+            self.assertEqual(sorted(os.listdir(td)), ['A_0001.jpg', 'fssort.ini'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+import sys
+sys.path.append("grouping_renamer") # so modules can import each other
+                                    # when run from tests/
+import os
+import tempfile
+
+import grouping_renamer.state as state_mod
+import grouping_renamer.support as spt
+
+class TestState(unittest.TestCase):
+    def test_unchanged_dirs_are_not_listed(self):
+        """a dir is skipped while it and its orderfile are as recorded, but the
+        walk still goes below it; an edit to the orderfile, a new file in the
+        dir, or different settings mean it's listed again"""
+        with tempfile.TemporaryDirectory() as td:
+            for d in ['a/a1', 'b']:
+                os.makedirs(os.path.join(td, d))
+            with open(os.path.join(td, 'a', 'fssort.ini'), 'w') as of:
+                of.write('x\n')
+            params = {'idstart': 10}
+            state = state_mod.TreeState(td, params)
+            for snapshot in spt.walk_dirs(td, [], True, state.cached):
+                state.record(snapshot, 'FSSORT.INI', 2, 10)
+                snapshot.close()
+            state.save()
+
+            def walk(params):
+                state = state_mod.TreeState(td, params)
+                return [(os.path.relpath(d.folder, td), isinstance(d, state_mod.CachedDir))
+                        for d in spt.walk_dirs(td, [], True, state.cached)]
+            self.assertEqual(sorted(walk(params)),
+                             [('.', True), ('a', True), ('a/a1', True), ('b', True)])
+
+            with open(os.path.join(td, 'a', 'fssort.ini'), 'a') as of:
+                of.write('y\n')
+            open(os.path.join(td, 'b', 'new.jpg'), 'w').close()
+            self.assertEqual(sorted(walk(params)),
+                             [('.', True), ('a', False), ('a/a1', True), ('b', False)])
+            self.assertTrue(all(not cached for (d, cached) in walk({'idstart': 20})))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+import sys
+sys.path.append("grouping_renamer") # so modules can import each other
+                                    # when run from tests/
+import os
+import tempfile
+import threading
+
+import grouping_renamer.support as spt
+import stats as stats_mod # the copy the grouping_renamer modules count into
+
+class TestStats(unittest.TestCase):
+    def tearDown(self):
+        stats_mod.set_stats(False)
+
+    def test_off_costs_nothing(self):
+        """when off, timers are one shared do-nothing context and nothing is kept"""
+        stats_mod.set_stats(False)
+        self.assertIs(stats_mod.timer('a', 'list'), stats_mod.timer('b', 'plan'))
+        with stats_mod.timer('a', 'list'):
+            stats_mod.count('a', 'renames', 5)
+        self.assertEqual(stats_mod.per_dir(), {})
+
+    def test_counts_per_dir_and_run(self):
+        """counters add up per dir, from any thread, and over the run"""
+        stats_mod.set_stats(True)
+        def work(folder):
+            for n in range(100):
+                stats_mod.count(folder, 'renames')
+            with stats_mod.timer(folder, 'rename'):
+                pass
+        threads = [threading.Thread(target=work, args=(f,)) for f in ['a', 'b', 'a']]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        dirs = stats_mod.per_dir()
+        self.assertEqual((dirs['a']['renames'], dirs['b']['renames']), (200, 100))
+        self.assertGreaterEqual(dirs['a']['rename_secs'], 0)
+        totals = stats_mod.totals()
+        self.assertEqual((totals['renames'], totals['dirs']), (300, 2))
+        self.assertIn('slowest dirs', stats_mod.table())
+
+    def test_no_slowest_dirs_without_timings(self):
+        stats_mod.set_stats(True)
+        stats_mod.count('a', 'renames', 3)
+        self.assertNotIn('slowest dirs', stats_mod.table())
+        with stats_mod.timer('b', 'rename'):
+            pass
+        table = stats_mod.table()
+        self.assertIn('slowest dirs', table)
+        self.assertNotIn('  a  ', table)
+
+    def test_listing_is_counted(self):
+        stats_mod.set_stats(True)
+        with tempfile.TemporaryDirectory() as td:
+            for n in ['a.jpg', 'b.jpg']:
+                open(os.path.join(td, n), 'w').close()
+            spt.DirSnapshot(td, with_stat=True).close()
+            counters = stats_mod.per_dir()[td]
+            self.assertEqual((counters['entries'], counters['stats']), (2, 2))
+            self.assertIn('list_secs', counters)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,12 @@
 import unittest
+import sys
+sys.path.append("grouping_renamer") # so modules can import each other
+                                    # when run from tests/
 import os
+import time
+import logging
 import tempfile
+from unittest import mock
 
 import grouping_renamer.support as spt
 
@@ -11,7 +17,20 @@ class TestSupport(unittest.TestCase):
         dl=['A','b'] # as from a dirlist
         rl=spt.find_case_insensitive(ol, dl)
         self.assertEqual(rl, ['A'])
-        
+
+    def test_directory_index_normalization(self):
+        """NFD and NFC spellings match each other; lookups give the on-disk name"""
+        nfd_name = 'Jose\u0301_0010.jpg' # e + combining acute, as macOS writes it
+        nfc_name = 'Jos\u00e9_0010.jpg'
+        dindex = spt.DirectoryIndex([nfd_name, 'b.JPG'])
+        self.assertIn(nfd_name, dindex)
+        self.assertNotIn(nfc_name, dindex) # membership is exact
+        self.assertEqual(dindex.find(nfc_name), nfd_name)
+        self.assertIsNone(dindex.find('B.jpg'))
+        self.assertEqual(dindex.find('B.jpg', adapt_case=True), 'b.JPG')
+        self.assertEqual(dindex.find_all(['B.jpg', 'c', nfc_name.upper()], True),
+                         ['b.JPG', nfd_name])
+
     def test_scrub_dups(self):
         """test that we remove duplicates and blanks, keep others"""
         # verify all-blanks is sane
@@ -86,7 +105,118 @@ class TestSupport(unittest.TestCase):
         # here's how to get the remainder
         rem_string = name_w_suffix[idm.span()[1]:]
         self.assertEqual(rem_string, suffix)
-      
+
+    def test_id_matcher(self):
+        """the *last* ID is found (compiled once per id_regex)"""
+        idm = spt.get_id_matcher(r'\d{2,5}')
+        self.assertIs(idm, spt.get_id_matcher(r'\d{2,5}')) # compiled once
+        self.assertEqual(idm.fullid_end('a_1965_1003_b.jpg'), len('a_1965_1003'))
+        self.assertEqual(idm.last_id('a_1965_1003_b.jpg'), '1003')
+        self.assertEqual(idm.fullid_end('no_id.jpg'), -1)
+        self.assertFalse(idm.search('no_id.jpg'))
+
+    def test_id_matcher_alternation(self):
+        """an id_regex with alternation applies as a whole"""
+        idm = spt.get_id_matcher(r'id\d+|\d{3}')
+        self.assertEqual(idm.fullid_end('a_id7_x.jpg'), len('a_id7'))
+        self.assertEqual(idm.fullid_end('a_id7_123.jpg'), len('a_id7_123'))
+
+    def test_dir_snapshot(self):
+        """one scan gives files and subdirs; renames are tracked in memory"""
+        with tempfile.TemporaryDirectory() as td:
+            open(os.path.join(td, 'a.jpg'), 'w').close()
+            os.mkdir(os.path.join(td, 'sub'))
+            snap = spt.DirSnapshot(td, with_stat=True)
+            self.assertEqual(list(snap.files), ['a.jpg'])
+            self.assertEqual(snap.dirs, ['sub'])
+            self.assertEqual(snap.files['a.jpg'].size, 0)
+            self.assertTrue(snap.exists('sub'))
+            self.assertFalse(snap.is_file('sub'))
+            snap.renamed('a.jpg', 'b.jpg')
+            self.assertFalse(snap.is_file('a.jpg'))
+            self.assertIn('b.jpg', snap.index)
+
+    def test_walk_dirs_order_and_pruning(self):
+        """dirs come lazily, in the order the old os.walk-built list had them,
+        without the excluded ones (or anything below them)"""
+        with tempfile.TemporaryDirectory() as td:
+            for d in ['a/a1/a11', 'a/a2', 'b/b1', '.git/objects']:
+                os.makedirs(os.path.join(td, d))
+            expected = [td]
+            for node, dirs, files in os.walk(td):
+                dirs[:] = [d for d in dirs if d != '.git']
+                expected += [os.path.join(node, d) for d in dirs]
+            walker = spt.walk_dirs(td, ['.git'], True)
+            self.assertEqual(next(walker).folder, td)
+            self.assertEqual([td] + [s.folder for s in walker], expected)
+            self.assertEqual([s.folder for s in spt.walk_dirs(td, [], False)], [td])
+
+    def test_map_dirs_keeps_order(self):
+        """results, and what each call logs, come out in input order whatever order
+        the worker threads finish in"""
+        def work(n):
+            time.sleep(0.01 * (5 - n)) # later items finish first
+            logging.getLogger('support').info('dir %d', n)
+            return n * 10
+        with self.assertLogs(level='INFO') as lc:
+            results = list(spt.map_dirs(work, range(5), jobs=3))
+        self.assertEqual(results, [0, 10, 20, 30, 40])
+        self.assertEqual(lc.output, ['INFO:support:dir %d' % n for n in range(5)])
+
+    def test_map_dirs_feeding_map_dirs(self):
+        """one map_dirs taking its items from another (plan, then apply) logs
+        each dir's lines together, in the same order as with one job"""
+        def plan(n):
+            time.sleep(0.01 * (5 - n))
+            logging.getLogger('support').info('plan %d', n)
+            return n
+        def apply(n):
+            time.sleep(0.01 * (n % 2))
+            logging.getLogger('support').info('apply %d', n)
+            return n
+        outputs = []
+        for jobs in [1, 2]:
+            with self.assertLogs(level='INFO') as lc:
+                self.assertEqual(list(spt.map_dirs(apply, spt.map_dirs(plan, range(5), jobs), jobs)), list(range(5)))
+            outputs.append(lc.output)
+        self.assertEqual(outputs[1], outputs[0])
+        self.assertEqual(outputs[0][:4], ['INFO:support:plan 0', 'INFO:support:apply 0',
+                                          'INFO:support:plan 1', 'INFO:support:apply 1'])
+
+    def test_run_renames_waits_for_dependencies(self):
+        """with renames in flight at once, a rename still waits for the one
+        that vacates its target; results come back in the order given"""
+        with tempfile.TemporaryDirectory() as td:
+            for n in ['a', 'b', 'x']:
+                with open(os.path.join(td, n), 'w') as f:
+                    f.write(n)
+            real_rename = spt.DirHandle.rename
+            def slow_rename(folder, src, dst):
+                if src.endswith('b'): time.sleep(0.05) # 'b' is slow to move out of the way
+                real_rename(folder, src, dst)
+            with spt.DirHandle(td) as folder, \
+                    mock.patch.object(spt.DirHandle, 'rename', autospec=True, side_effect=slow_rename):
+                results = list(spt.run_renames(folder, [('b', 'c'), ('a', 'b'), ('x', 'y'), ('nope', 'z')], 4))
+            self.assertEqual([(f, t, e is None) for (f, t, e) in results],
+                             [('b', 'c', True), ('a', 'b', True), ('x', 'y', True), ('nope', 'z', False)])
+            self.assertIsInstance(results[3][2], FileNotFoundError)
+            with open(os.path.join(td, 'b')) as f:
+                self.assertEqual(f.read(), 'a')
+            with open(os.path.join(td, 'c')) as f:
+                self.assertEqual(f.read(), 'b')
+
+    def test_set_verbosity_levels(self):
+        """0 mutes, 1-3 are problems/per-dir/per-file, 10 and up are logging levels"""
+        root = logging.getLogger()
+        was = root.level
+        try:
+            for (verbosity, level) in [(0, logging.CRITICAL + 1), (1, logging.WARNING),
+                                       (2, logging.INFO), (3, logging.DEBUG), (20, 20)]:
+                spt.set_verbosity(verbosity)
+                self.assertEqual(root.level, level)
+        finally:
+            root.setLevel(was)
+
     def test_change_dir(self):
         """ensure we can change dirctories"""  
         start_dir=os.getcwd()
@@ -3,6 +3,7 @@ import sys
 sys.path.append("grouping_renamer") # so modules can import each other
                                     # when run from tests/
 import os
+import subprocess
 import tempfile
 from pathlib import Path
 
@@ -135,6 +136,72 @@ class TestUndo(unittest.TestCase):
             hflist = [f for f in dlist if f.startswith(history_filename_root)]
             self.assertEqual(hflist, [])
 
+    def test_undo_in_dir_resolves_conflicts_in_memory(self, mock_dr):
+        """names are checked against the one listing, including those freed or
+        taken by earlier reverts, rather than stat'ed"""
+        with tempfile.TemporaryDirectory() as td:
+            for n in ['B', 'C', 'D', 'E']: # E (not in the history) has since appeared
+                with open(os.path.join(td, n), 'w') as f:
+                    f.write(n)
+            with open(os.path.join(td, 'hf__now.csv'), 'w') as hf:
+                hf.write('from, to, now\nB,C\nA,B\nE,D\nGONE,F\n')
+            with mock.patch('os.path.exists', side_effect=AssertionError), \
+                    mock.patch('os.stat', side_effect=AssertionError):
+                summary = undo.undo_in_dir('hf.csv', td)
+            self.assertEqual(summary, {'dir': td, 'history_file': 'hf__now.csv', 'generations': 1, 'renamed': 3,
+                                       'skipped': 1, 'conflicts': 1, 'failed': 0,
+                                       'history': 'removed'})
+            contents = {}
+            for n in os.listdir(td):
+                with open(os.path.join(td, n)) as f:
+                    contents[n] = f.read()
+            # C goes back to B once B has moved on to A
+            self.assertEqual(contents, {'A': 'B', 'B': 'C', 'E': 'E', 'E__now': 'D'})
+
+    def test_conflict_name_whatever_the_generations(self, mock_dr):
+        """a reverted file whose old name is taken gets the same name undoing one
+        generation or several; fewer than one generation isn't allowed"""
+        for generations in [1, 2]:
+            with tempfile.TemporaryDirectory() as td:
+                for n in ['D', 'E']:
+                    open(os.path.join(td, n), 'w').close()
+                with open(os.path.join(td, 'hf__2023_01.csv'), 'w') as hf:
+                    hf.write('from, to, 2023_01\nE,D\n')
+                summary = undo.undo_in_dir('hf.csv', td, generations=generations)
+                self.assertEqual(summary['conflicts'], 1)
+                self.assertEqual(sorted(os.listdir(td)), ['E', 'E__2023_01'])
+        with tempfile.TemporaryDirectory() as td:
+            with self.assertRaises(ValueError):
+                undo.undo_in_dir('hf.csv', td, generations=0)
+
+    def test_undo_generations_composes_history(self, mock_dr):
+        """several history files are undone as one net rename per file: a file
+        that ends up back where it was isn't touched, and a swap still works"""
+        with tempfile.TemporaryDirectory() as td:
+            for n in ['B', 'C', 'X', 'Y', 'new']:
+                with open(os.path.join(td, n), 'w') as f:
+                    f.write(n)
+            histories = {'hf__2023_01.csv': 'a,B\nold,gone\n',
+                         'hf__2023_02.csv': '#intent,3\nB,C\nX,T\nY,X\n#done,3\n',
+                         'hf__2023_03.csv': 'C,B\nT,Y\n',
+                         'hf__2023_04.csv': 'Z,new\n'}
+            for (hf, lines) in histories.items():
+                with open(os.path.join(td, hf), 'w') as f:
+                    f.write('from, to, now\n' + lines)
+            self.assertEqual(undo.compose_history([[('a', 'B')], [('B', 'C')], [('C', 'a')]]), {})
+
+            with mock.patch.object(undo, 'run_renames', wraps=undo.run_renames) as rr:
+                summary = undo.undo_in_dir('hf.csv', td, to_ts='2023_02')
+                done = list(rr.call_args[0][1])
+            self.assertEqual(summary['generations'], 3)
+            self.assertEqual(summary['history_file'], 'hf__2023_02.csv')
+            # B went to C and back (so is untouched); X and Y swap back via a temporary name
+            self.assertEqual(len(done), 4) # 2 swapped + 1 parking + 'new'->'Z'
+            self.assertEqual(sorted(os.listdir(td)), ['B', 'C', 'X', 'Y', 'Z', 'hf__2023_01.csv'])
+            for (n, was) in [('X', 'Y'), ('Y', 'X'), ('Z', 'new'), ('B', 'B')]:
+                with open(os.path.join(td, n)) as f:
+                    self.assertEqual(f.read(), was)
+
     def test_undo_in_dir_if_not_history(self, mock_dr):
         """ensure a directory with no history file is left unchanged"""
         with tempfile.TemporaryDirectory() as td:
@@ -244,5 +311,22 @@ class TestUndo(unittest.TestCase):
             undo.undo_rename(dummy_abs, rename_tgt_abs)
             self.assertFalse(os.path.exists(dummy_abs))
             self.assertTrue(os.path.exists(rename_tgt_abs))
+
+GFR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'grouping_renamer', 'gfr.py')
+
+class TestUndoCommand(unittest.TestCase):
+    def test_file_and_run_need_the_catalog(self):
+        """with csv history, --file or --run is refused rather than ignored
+        (which would undo everything in the dir)"""
+        with tempfile.TemporaryDirectory() as td:
+            helpers.h_create_rename_files(td, 'rename_history', num_files=2)
+            before = sorted(os.listdir(td))
+            for option in [['--file', os.path.join(td, 'A_0.jpg')], ['--run', '1']]:
+                proc = subprocess.run([sys.executable, GFR, 'undo', td, '--no-dryrun'] + option,
+                                      capture_output=True, text=True, stdin=subprocess.DEVNULL)
+                self.assertNotEqual(proc.returncode, 0)
+                self.assertIn('sqlite', proc.stderr)
+                self.assertEqual(sorted(os.listdir(td)), before)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
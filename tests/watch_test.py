@@ -0,0 +1,94 @@
+import unittest
+import sys
+sys.path.append("grouping_renamer") # so modules can import each other
+                                    # when run from tests/
+import os
+import time
+import errno
+import ctypes
+import tempfile
+import threading
+from unittest import mock
+
+import grouping_renamer.watch as watch_mod
+
+class TestWatch(unittest.TestCase):
+    def check_watch(self, use_inotify):
+        """a burst of writes to an orderfile (even in a dir made after watching
+        started) is one change, once left alone; what on_change itself does
+        in the dir doesn't count"""
+        with tempfile.TemporaryDirectory() as td:
+            os.makedirs(os.path.join(td, 'a'))
+            os.makedirs(os.path.join(td, '.git'))
+            changes = []
+            def on_change(folder):
+                changes.append(os.path.relpath(folder, td))
+                os.rename(os.path.join(folder, 'fssort.ini'), os.path.join(folder, 'fssort.ini.bak'))
+                os.rename(os.path.join(folder, 'fssort.ini.bak'), os.path.join(folder, 'fssort.ini'))
+                open(os.path.join(folder, 'rename_history.csv'), 'w').close()
+            stopping = threading.Event()
+            watcher = threading.Thread(target=watch_mod.watch_tree,
+                                       args=(td, ['.git'], True, 'FSSORT.INI', on_change),
+                                       kwargs={'debounce_secs': 0.3, 'poll_secs': 0.05,
+                                               'use_inotify': use_inotify, 'stop': stopping.is_set})
+            watcher.start()
+            try:
+                time.sleep(0.2) # let it take its first look
+                for n in range(3):
+                    with open(os.path.join(td, 'a', 'fssort.ini'), 'a') as of:
+                        of.write('x' * (n + 1) + '\n')
+                    time.sleep(0.05)
+                os.makedirs(os.path.join(td, 'b', 'b1'))
+                with open(os.path.join(td, 'b', 'b1', 'fssort.ini'), 'w') as of:
+                    of.write('y\n')
+                with open(os.path.join(td, '.git', 'fssort.ini'), 'w') as of:
+                    of.write('z\n')
+                time.sleep(1.0)
+            finally:
+                stopping.set()
+                watcher.join()
+            self.assertEqual(sorted(changes), ['a', os.path.join('b', 'b1')])
+
+    def check_settle_keeps_others(self, use_inotify):
+        """settling one dir doesn't lose an orderfile written meanwhile in another"""
+        with tempfile.TemporaryDirectory() as td:
+            for d in ['a', 'b']:
+                os.makedirs(os.path.join(td, d))
+            watcher = watch_mod.make_watcher(td, [], True, 'fssort.ini', use_inotify)
+            try:
+                for d in ['a', 'b']: # a's by on_change, say; b's by someone else
+                    open(os.path.join(td, d, 'fssort.ini'), 'w').close()
+                time.sleep(0.05)
+                watcher.settle(os.path.join(td, 'a'))
+                self.assertEqual(set(watcher.changes(0.05)), {os.path.join(td, 'b')})
+            finally:
+                watcher.close()
+
+    def test_inotify_errors_say_why(self):
+        libc = mock.Mock()
+        def fail(flags):
+            ctypes.set_errno(errno.EMFILE)
+            return -1
+        libc.inotify_init1.side_effect = fail
+        with tempfile.TemporaryDirectory() as td, \
+                mock.patch.object(watch_mod, '_get_inotify_libc', return_value=libc):
+            with self.assertRaises(OSError) as caught:
+                watch_mod.InotifyWatcher(td, [], False, 'fssort.ini')
+        self.assertEqual(caught.exception.errno, errno.EMFILE)
+
+    def test_settle_polling(self):
+        self.check_settle_keeps_others(False)
+
+    @unittest.skipIf(watch_mod._get_inotify_libc() is None, 'no inotify here')
+    def test_settle_inotify(self):
+        self.check_settle_keeps_others(True)
+
+    def test_watch_polling(self):
+        self.check_watch(use_inotify=False)
+
+    @unittest.skipIf(watch_mod._get_inotify_libc() is None, 'no inotify here')
+    def test_watch_inotify(self):
+        self.check_watch(use_inotify=True)
+
+if __name__ == '__main__':
+    unittest.main()